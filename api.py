@@ -1,18 +1,65 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+
 import config
-from config import client, inference_chunk_size
 from log_config import log
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from ml import encode_text_document
+from embedding_batcher import EmbeddingBatcher, INTERACTIVE, BULK
+from embedding_format import get_binary_format, encode_embeddings, MEDIA_TYPES
+from search_cache import LRUCache, ResultCache, normalize_text, get_result_key
+from works_partitions import WORKS_ALIAS, get_partitions_for_years
+from ml import encode_text_document, get_model_key
 
 
 class Embedding(BaseModel):
     vector: list[float]
 
 
-app = FastAPI()
+# fields of the works returned by the searches, the other fields (e.g. the embeddings) are not fetched
+SEARCH_SOURCE_FIELDS = ["id", "display_name", "abstract"]
+
+# the texts of concurrent requests are encoded together
+batcher = EmbeddingBatcher(encode_text_document)
+batcher.start()
+# embeddings of the normalized texts of the searches, and results of the searches
+embedding_cache = LRUCache(config.search_embedding_cache_size)
+result_cache = ResultCache(config.search_result_cache_size, config.search_result_cache_ttl,
+                           config.search_cache_generation_check_interval)
+
+
+# set once the model is loaded and warmed up (see warm_up)
+model_warmed_up = threading.Event()
+
+
+def warm_up():
+    """
+    Load the model and encode a text through the batcher (e.g. to initialize CUDA), in a thread started with the API:
+    /health answers during the warm-up, /ready once it is done.
+    """
+    started = time.perf_counter()
+    try:
+        batcher.submit(["warm up"], INTERACTIVE).result()
+    except Exception as e:
+        log.error(f"Failed to warm up the model: {e!r}")
+        return
+    model_warmed_up.set()
+    log.info(f"Model warmed up in {time.perf_counter() - started:.1f}s.")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if config.api_warm_up:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+    await config.get_async_client().close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     # "http://localhost",
@@ -29,49 +76,282 @@ app.add_middleware(
 )
 
 
+# sync handler, run in the thread pool of FastAPI: waiting for the batcher and serializing large responses (e.g. for
+# the ingestion) don't block the event loop of the searches
 @app.post("/create_embeddings", response_model=list[Embedding])
-def create_embeddings(texts: list[str]):
+def create_embeddings(texts: list[str], accept: str | None = Header(default=None)):
     """
-    Create the embedding from a list of strings.
+    Create the embedding from a list of strings. A request with a single text is handled as an interactive request,
+    before the bulk ones (e.g. from the ingestion).
     :param texts: The texts to create the embeddings from.
+    :param accept: Accept header, the embeddings are returned as a binary matrix if it contains one of the media types
+    of embedding_format.MEDIA_TYPES, as JSON otherwise.
     :return: The embeddings.
     """
-    res = encode_text_document(texts)
+    res = batcher.submit(texts, INTERACTIVE if len(texts) == 1 else BULK).result()
+    binary_format = get_binary_format(accept)
+    if binary_format is not None:
+        return Response(content=encode_embeddings(res, binary_format), media_type=MEDIA_TYPES[binary_format])
     res = [Embedding(vector=vec) for vec in res]
     return res
 
 
+class KnnFilters(BaseModel):
+    """
+    Filters of a KNN search, applied during the search (the k nearest works matching the filters are returned).
+    """
+    publication_year_min: int | None = None
+    publication_year_max: int | None = None
+    types: list[str] | None = None
+    # OpenAlex ids of topics (e.g. T10001 or https://openalex.org/T10001), the works having one of them. topics.id is
+    # mapped as keyword in works_template.json, an index created before needs to be migrated (python vector_mapping.py
+    # migrate)
+    topic_ids: list[str] | None = None
+
+
+class KnnQuery(BaseModel):
+    """
+    A query of a batch KNN search, with a vector or a text. k, num_candidates and the filters default to the ones of
+    the batch.
+    """
+    vector: list[float] | None = None
+    text: str | None = None
+    k: int | None = Field(default=None, gt=0)
+    num_candidates: int | None = Field(default=None, gt=0)
+    filters: KnnFilters | None = None
+
+
+class BatchKnnSearch(BaseModel):
+    queries: list[KnnQuery]
+    k: int = Field(default=10, gt=0)
+    num_candidates: int = Field(default=5000, gt=0)
+    filters: KnnFilters | None = None
+
+
+async def encode_queries(texts: list[str], priority: int = INTERACTIVE) -> list[list[float]]:
+    """
+    Encode the texts of searches in the thread of the batcher, without blocking the event loop. The embeddings of the
+    normalized texts are cached.
+    """
+    texts = [normalize_text(text) for text in texts]
+    vectors = [embedding_cache.get(text) for text in texts]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if len(missing) > 0:
+        embeddings = await asyncio.wrap_future(batcher.submit([texts[i] for i in missing], priority))
+        for i, embedding in zip(missing, embeddings):
+            vectors[i] = Embedding(vector=embedding).vector
+            embedding_cache.put(texts[i], vectors[i])
+    return vectors
+
+
+async def encode_query(text: str) -> list[float]:
+    """
+    Encode the text of a search, see encode_queries.
+    """
+    return (await encode_queries([text]))[0]
+
+
+async def get_works_generation() -> tuple:
+    """
+    :return: The generation of the works index, which changes when a refresh makes changes visible.
+    """
+    stats = await config.get_async_client().indices.stats(index=WORKS_ALIAS, metric=["refresh", "docs"])
+    primaries = stats["_all"]["primaries"]
+    return primaries["refresh"]["external_total"], primaries["docs"]["count"], primaries["docs"]["deleted"]
+
+
+def get_knn_filter(filters: KnnFilters | None) -> list[dict]:
+    """
+    :return: The filter of the KNN query.
+    """
+    if filters is None:
+        return []
+    knn_filter = []
+    if filters.publication_year_min is not None or filters.publication_year_max is not None:
+        publication_year_range = {}
+        if filters.publication_year_min is not None:
+            publication_year_range["gte"] = filters.publication_year_min
+        if filters.publication_year_max is not None:
+            publication_year_range["lte"] = filters.publication_year_max
+        knn_filter.append({"range": {"publication_year": publication_year_range}})
+    if filters.types:
+        knn_filter.append({"terms": {"type": filters.types}})
+    if filters.topic_ids:
+        topic_ids = [topic_id if topic_id.startswith("https://") else f"https://openalex.org/{topic_id}"
+                     for topic_id in filters.topic_ids]
+        knn_filter.append({"terms": {"topics.id": topic_ids}})
+    return knn_filter
+
+
+def get_search_index(filters: KnnFilters | None) -> str:
+    """
+    :return: The indexes searched: only the partitions matching the publication years of the filters if the works are
+    partitioned (see works_partitions.py), the alias of the works otherwise.
+    """
+    if not config.works_partitioned or filters is None or (filters.publication_year_min is None
+                                                           and filters.publication_year_max is None):
+        return WORKS_ALIAS
+    partitions = get_partitions_for_years(filters.publication_year_min, filters.publication_year_max)
+    return ",".join(partitions) if len(partitions) > 0 else WORKS_ALIAS
+
+
+def get_knn(vector: list[float], k: int, num_candidates: int, filters: KnnFilters | None = None) -> dict:
+    knn = {
+        "field": "abstract_embeddings",
+        "query_vector": vector,
+        "k": k,
+        "num_candidates": num_candidates
+    }
+    knn_filter = get_knn_filter(filters)
+    if len(knn_filter) > 0:
+        knn["filter"] = knn_filter
+    return knn
+
+
+def get_hits(resp) -> list[dict]:
+    return [{
+        "id": w["_source"]["id"],
+        "display_name": w["_source"].get("display_name"),
+        "abstract": w["_source"].get("abstract"),
+    } for w in resp["hits"]["hits"]]
+
+
+def get_knn_result_key(vector: list[float], k: int, num_candidates: int, filters: KnnFilters | None = None) -> tuple:
+    return get_result_key(vector, k, num_candidates, filters.model_dump(exclude_none=True) if filters else None)
+
+
+async def knn_search(vector: list[float], k: int = 10, num_candidates: int = 5000,
+                     filters: KnnFilters | None = None) -> list[dict]:
+    """
+    Retrieve the nearest works of a vector with a KNN search, only fetching SEARCH_SOURCE_FIELDS. The results are
+    cached until the works index changes.
+    """
+    await result_cache.check_generation(get_works_generation)
+    key = get_knn_result_key(vector, k, num_candidates, filters)
+    res = result_cache.get(key)
+    if res is not None:
+        return res
+    resp = await config.get_async_client().search(
+        index=get_search_index(filters),
+        knn=get_knn(vector, k, num_candidates, filters),
+        source=SEARCH_SOURCE_FIELDS,
+        ignore_unavailable=True,
+    )
+    res = get_hits(resp)
+    result_cache.put(key, res)
+    return res
+
+
 @app.post("/vector_knn_search")
-def vector_knn_search(embedding: Embedding):
+async def vector_knn_search(embedding: Embedding):
     """
     Retrieve the nearest neighbors of an embedding with a KNN search (fast but approximate).
     :param embedding: The embedding for the search.
     :return: The nearest works.
     """
-    resp = client.search(
-        index="works",
-        knn={
-            "field": "abstract_embeddings",
-            "query_vector": embedding.vector,
-            "k": 10,
-            "num_candidates": 5000
-        }
-    )
-    res = [{
-        "id": w["_source"]["id"],
-        "display_name": w["_source"]["display_name"],
-        "abstract": w["_source"]["abstract"],
-    } for w in resp["hits"]["hits"]]
-    return res
+    return await knn_search(embedding.vector)
 
 
 @app.post("/text_knn_search")
-def text_knn_search(text: str):
+async def text_knn_search(text: str):
     """
     Retrieve the similar abstracts with a KNN search (fast but approximate).
     :param text: The text for the search.
     :return: The similar abstracts.
     """
-    text_embedding = Embedding(vector=encode_text_document(text))
-    res = vector_knn_search(text_embedding)
-    return res
+    return await knn_search(await encode_query(text))
+
+
+@app.get("/health")
+def health():
+    """
+    Liveness of the API, answered as soon as it is started (the model can still be loading).
+    """
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    """
+    Readiness of the API: the model is warmed up (if API_WARM_UP) and Elasticsearch answers. The status code is 503
+    if the API isn't ready.
+    """
+    model_ready = model_warmed_up.is_set() or not config.api_warm_up
+    elasticsearch_ready = await config.get_async_client().ping()
+    if not (model_ready and elasticsearch_ready):
+        response.status_code = 503
+    return {"model": model_ready, "elasticsearch": elasticsearch_ready}
+
+
+@app.get("/cache_stats")
+def cache_stats():
+    """
+    Hit and miss counters of the caches of the searches, to size them.
+    :return: The stats of the cache of the embeddings of the texts and of the cache of the results.
+    """
+    return {
+        "embedding_cache": embedding_cache.get_stats(),
+        "result_cache": result_cache.get_stats(),
+    }
+
+
+@app.get("/model_info")
+def model_info():
+    """
+    The model creating the embeddings of /create_embeddings, e.g. to key the embedding cache of the ingestion with the
+    dtype the model runs with on this host.
+    :return: The key of the model (see ml.get_model_key).
+    """
+    return {"model_key": get_model_key()}
+
+
+@app.post("/batch_knn_search")
+async def batch_knn_search(search: BatchKnnSearch):
+    """
+    Retrieve the nearest works of many vectors or texts with a single multi search request. The texts are encoded
+    together, and the filters are applied during the KNN searches.
+    :param search: The queries, and the default k, num_candidates and filters of the queries.
+    :return: The nearest works of each query, in the order of the queries, or {"error": ...} for the queries which
+    failed.
+    """
+    if len(search.queries) > config.batch_knn_search_max_queries:
+        raise HTTPException(status_code=413, detail=f"At most {config.batch_knn_search_max_queries} queries")
+    if any((query.vector is None) == (query.text is None) for query in search.queries):
+        raise HTTPException(status_code=422, detail="Each query must have either a vector or a text")
+    ks = [query.k if query.k is not None else search.k for query in search.queries]
+    list_num_candidates = [query.num_candidates if query.num_candidates is not None else search.num_candidates
+                           for query in search.queries]
+    invalid_queries = [i for i, (k, num_candidates) in enumerate(zip(ks, list_num_candidates)) if num_candidates < k]
+    if len(invalid_queries) > 0:
+        raise HTTPException(status_code=422, detail=f"num_candidates must be greater than or equal to k, queries "
+                                                    f"{invalid_queries[:10]}")
+    # the texts of the batch are encoded at once
+    text_queries = [i for i, query in enumerate(search.queries) if query.vector is None]
+    vectors = [query.vector for query in search.queries]
+    for i, vector in zip(text_queries, await encode_queries([search.queries[i].text for i in text_queries], BULK)):
+        vectors[i] = vector
+
+    await result_cache.check_generation(get_works_generation)
+    results = [None] * len(search.queries)
+    searches = []
+    searched_queries = []
+    for i, (query, vector, k, num_candidates) in enumerate(zip(search.queries, vectors, ks, list_num_candidates)):
+        filters = query.filters if query.filters is not None else search.filters
+        key = get_knn_result_key(vector, k, num_candidates, filters)
+        results[i] = result_cache.get(key)
+        if results[i] is None:
+            searches.append({"index": get_search_index(filters), "ignore_unavailable": True})
+            searches.append({"knn": get_knn(vector, k, num_candidates, filters), "_source": SEARCH_SOURCE_FIELDS,
+                             "size": k})
+            searched_queries.append((i, key))
+    if len(searched_queries) > 0:
+        resp = await config.get_async_client().msearch(searches=searches)
+        for (i, key), query_resp in zip(searched_queries, resp["responses"]):
+            if "error" in query_resp:
+                # the other queries are answered, the failed ones aren't cached
+                log.warning(f"Query {i} of a batch KNN search failed: {query_resp['error']}")
+                results[i] = {"error": query_resp["error"]}
+                continue
+            results[i] = get_hits(query_resp)
+            result_cache.put(key, results[i])
+    return results
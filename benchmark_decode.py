@@ -0,0 +1,52 @@
+"""
+Benchmark of the backends reading the gzip JSONL files of the dataset (decompression, line splitting and JSON
+parsing), to choose the values of DECODE_DECOMPRESSOR, DECODE_JSON_PARSER and DECODE_BLOCK_SIZE for a host.
+
+python benchmark_decode.py [--file part_000.gz] [--nb-works 50000] [--repeat 3]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from decode import get_available_decompressors, get_available_json_parsers, iter_documents
+from synthetic_data import write_works_file
+
+BLOCK_SIZES = [0, 1 << 20, 8 << 20]
+
+
+def benchmark_backend(file_path, decompressor, json_parser, block_size, repeat):
+    best_duration = None
+    nb_docs = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        nb_docs = sum(1 for _ in iter_documents(file_path, decompressor, json_parser, block_size))
+        duration = time.perf_counter() - started
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    return nb_docs, best_duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="gzip JSONL file to read, a synthetic works file is generated if not set")
+    parser.add_argument("--nb-works", type=int, default=50000, help="number of works in the synthetic file")
+    parser.add_argument("--repeat", type=int, default=3, help="the best duration out of the repetitions is kept")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = args.file
+        if file_path is None:
+            file_path = os.path.join(tmp_dir, "part_000.gz")
+            print(f"Generating {args.nb_works} synthetic works...")
+            write_works_file(file_path, args.nb_works)
+        compressed_mb = os.path.getsize(file_path) / 1e6
+
+        print(f"{'decompressor':<14}{'json parser':<13}{'block size':>12}{'MB/s (gz)':>12}{'docs/s':>12}")
+        for decompressor in get_available_decompressors():
+            for json_parser in get_available_json_parsers():
+                for block_size in BLOCK_SIZES:
+                    nb_docs, duration = benchmark_backend(file_path, decompressor, json_parser, block_size,
+                                                          args.repeat)
+                    print(f"{decompressor:<14}{json_parser:<13}{block_size:>12}{compressed_mb / duration:>12.1f}"
+                          f"{nb_docs / duration:>12.0f}")
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of the formatting of the works (normalization.format_entity_data) against the previous
+implementation, on synthetic works with the shape of the OpenAlex works.
+
+python benchmark_format.py [--nb-works 20000] [--repeat 3]
+"""
+import argparse
+import copy
+import time
+from collections import Counter
+
+from log_config import log
+from normalization import format_entity_data, invert_abstract
+from synthetic_data import generate_works
+
+
+def legacy_invert_abstract(inv_index):
+    if inv_index is not None:
+        l_inv = [(w, p) for w, pos in inv_index.items() for p in pos]
+        return " ".join(map(lambda x: x[0], sorted(l_inv, key=lambda x: x[1])))
+
+
+def legacy_format_works_data(data):
+    data['abstract'] = legacy_invert_abstract(data['abstract_inverted_index'])
+    if 'topics' in data.keys():
+        for topic in data['topics']:
+            if 'subfield' in topic.keys() and type(topic['subfield']['id']) is not str:
+                log.warning(f"Fixing format of topic subfield ({topic['subfield']['id']}) from int to str")
+                topic['subfield']['id'] = "https://openalex.org/subfield/" + str(topic['subfield']['id'])
+            if 'field' in topic.keys() and type(topic['field']['id']) is not str:
+                log.warning(f"Fixing format of topic field ({topic['field']['id']}) from int to str")
+                topic['field']['id'] = "https://openalex.org/field/" + str(topic['field']['id'])
+            if 'domain' in topic.keys() and type(topic['domain']['id']) is not str:
+                log.warning(f"Fixing format of topic domain ({topic['domain']['id']}) from int to str")
+                topic['domain']['id'] = "https://openalex.org/domains/" + str(topic['domain']['id'])
+    if 'primary_topic' in data.keys() and data['primary_topic'] is not None:
+        if 'subfield' in data['primary_topic'].keys() and type(data['primary_topic']['subfield']['id']) is not str:
+            log.warning(f"Fixing format of primary_topic subfield ({data['primary_topic']['subfield']['id']}) from int to str")
+            data['primary_topic']['subfield']['id'] = "https://openalex.org/subfield/" + str(data['primary_topic']['subfield']['id'])
+        if 'field' in data['primary_topic'].keys() and type(data['primary_topic']['field']['id']) is not str:
+            log.warning(f"Fixing format of primary_topic field ({data['primary_topic']['field']['id']}) from int to str")
+            data['primary_topic']['field']['id'] = "https://openalex.org/field/" + str(data['primary_topic']['field']['id'])
+        if 'domain' in data['primary_topic'].keys() and type(data['primary_topic']['domain']['id']) is not str:
+            log.warning(f"Fixing format of primary_topic domain ({data['primary_topic']['domain']['id']}) from int to str")
+            data['primary_topic']['domain']['id'] = "https://openalex.org/domain/" + str(data['primary_topic']['domain']['id'])
+    del data['abstract_inverted_index']
+    return data
+
+
+def time_function(function, inputs, repeat):
+    """
+    :return: The best duration out of the repetitions and the outputs of the last repetition.
+    """
+    best_duration = None
+    outputs = None
+    for _ in range(repeat):
+        # the formatting modifies the documents, each repetition gets its own copy (not timed)
+        inputs_copy = copy.deepcopy(inputs)
+        started = time.perf_counter()
+        outputs = [function(x) for x in inputs_copy]
+        duration = time.perf_counter() - started
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    return best_duration, outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nb-works", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3, help="the best duration out of the repetitions is kept")
+    args = parser.parse_args()
+
+    works = list(generate_works(args.nb_works))
+    inverted_indexes = [work['abstract_inverted_index'] for work in works]
+    fixes = Counter()
+    benchmarks = [
+        ("invert_abstract", inverted_indexes, legacy_invert_abstract, invert_abstract),
+        ("format_entity_data (works)", works, legacy_format_works_data,
+         lambda work: format_entity_data("works", work, fixes)),
+    ]
+    print(f"{'function':<30}{'legacy docs/s':>15}{'new docs/s':>15}{'speedup':>10}{'same output':>13}")
+    for name, inputs, legacy_function, new_function in benchmarks:
+        legacy_duration, legacy_outputs = time_function(legacy_function, inputs, args.repeat)
+        new_duration, new_outputs = time_function(new_function, inputs, args.repeat)
+        print(f"{name:<30}{len(inputs) / legacy_duration:>15.0f}{len(inputs) / new_duration:>15.0f}"
+              f"{legacy_duration / new_duration:>10.2f}{str(legacy_outputs == new_outputs):>13}")
@@ -0,0 +1,65 @@
+"""
+Benchmark of the inference engines of ml.py (TEXT_ENCODING_ENGINE): throughput in sentences/s and drift of the
+embeddings (cosine similarity) against the reference float32 torch model, on synthetic abstracts. The torch engine is
+run with TEXT_ENCODING_TORCH_DTYPE (or --torch-dtype), e.g. float16 on GPU.
+
+python benchmark_inference.py [--engines torch int8 onnx] [--torch-dtype float16] [--nb-texts 2000] [--num-threads 8]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ml import ENGINES, load_model, get_effective_torch_dtype, text_encoding_batch_size, text_encoding_torch_dtype
+from normalization import invert_abstract
+from synthetic_data import generate_works
+
+
+def encode(model, texts):
+    started = time.perf_counter()
+    embeddings = model.encode(texts, batch_size=text_encoding_batch_size, show_progress_bar=False,
+                              convert_to_numpy=True)
+    return np.asarray(embeddings, dtype=np.float32), time.perf_counter() - started
+
+
+def cosine_similarities(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", nargs="+", default=["torch", "int8"], choices=ENGINES)
+    parser.add_argument("--torch-dtype", default=text_encoding_torch_dtype or "float32",
+                        help="dtype of the torch engine, default to TEXT_ENCODING_TORCH_DTYPE")
+    parser.add_argument("--nb-texts", type=int, default=2000)
+    parser.add_argument("--num-threads", type=int, default=0, help="torch threads, 0 to keep the default")
+    args = parser.parse_args()
+
+    texts = [invert_abstract(work['abstract_inverted_index'])
+             for work in generate_works(args.nb_texts, abstract_probability=1)]
+
+    reference_model = load_model("torch", "float32", args.num_threads)
+    # warm up
+    encode(reference_model, texts[:64])
+    reference_embeddings, reference_duration = encode(reference_model, texts)
+    del reference_model
+
+    print(f"{'engine':<20}{'sentences/s':>14}{'speedup':>10}{'mean cosine':>14}{'min cosine':>13}")
+    print(f"{'reference':<20}{len(texts) / reference_duration:>14.1f}{1:>10.2f}{1:>14.5f}{1:>13.5f}")
+    for engine in args.engines:
+        # the other engines run in float32
+        torch_dtype = args.torch_dtype if engine == "torch" else "float32"
+        name = f"{engine} {get_effective_torch_dtype(engine, torch_dtype)}" if engine == "torch" else engine
+        try:
+            model = load_model(engine, torch_dtype, args.num_threads)
+        except Exception as e:
+            print(f"{name:<20}failed to load: {e}")
+            continue
+        encode(model, texts[:64])
+        embeddings, duration = encode(model, texts)
+        similarities = cosine_similarities(reference_embeddings, embeddings)
+        print(f"{name:<20}{len(texts) / duration:>14.1f}{reference_duration / duration:>10.2f}"
+              f"{similarities.mean():>14.5f}{similarities.min():>13.5f}")
+        del model
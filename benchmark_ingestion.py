@@ -0,0 +1,176 @@
+"""
+End-to-end benchmark of the ingestion, without Elasticsearch nor the embedding API: synthetic OpenAlex works (gzip
+JSONL files in updated_date=*/part_*.gz folders) are ingested with ingest_list_of_entities (or ingest_file_bulk, file by
+file in a single process, with --mode file) into a local stand-in of Elasticsearch, with the embeddings created by a
+local stand-in of /create_embeddings with a configurable latency (see fake_services.py).
+
+Each configuration (product of the numbers of processes, of the inference chunk sizes and of the bounds of the size of
+the bulk requests, see bulk_controller.py) is run in a new process, configured with the environment variables of
+.env.template, and reports docs/s, MB/s (of the gzip files), the CPU time and the peak RSS of the ingestion processes.
+
+python benchmark_ingestion.py [--processes 1 4] [--inference-chunk-sizes 500 2000] [--nb-works-per-file 2000]
+                              [--bulk-min-bytes 1048576] [--bulk-max-bytes 10485760 52428800]
+                              [--embedding-latency-per-text 0.001] [--bulk-latency-per-mb 0.05]
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_services import FakeElasticsearch, FakeEmbeddingServer
+from synthetic_data import write_snapshot
+
+ENTITY = "works"
+
+
+def run_ingestion(mode: str, data_path: str, result_file: str):
+    """
+    Ingest the synthetic works, in a process configured by run_configuration, and write the resource usage of the
+    process and of its children (the ingestion processes) in result_file.
+    """
+    import config
+    from utils import ingest_list_of_entities, ingest_file_bulk, list_files_to_ingest
+    from ingested_files_ledger import IngestedFilesLedger
+
+    started = time.perf_counter()
+    if mode == "entities":
+        ingest_list_of_entities([ENTITY], data_path)
+    else:
+        if not config.client.indices.exists(index=ENTITY):
+            from utils import create_index
+            create_index(ENTITY)
+        for _, entity, file_path in list_files_to_ingest([ENTITY], data_path, IngestedFilesLedger({})):
+            ingest_file_bulk(entity, file_path, check_if_ingested=False, record_ingested_file=False)
+    duration = time.perf_counter() - started
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(result_file, "w") as f:
+        json.dump({
+            'duration': duration,
+            'cpu_seconds': usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime,
+            # ru_maxrss is in KB on Linux, the peak of the largest process
+            'peak_rss_mb': max(usage_self.ru_maxrss, usage_children.ru_maxrss) / 1024,
+        }, f)
+
+
+def run_configuration(configuration: dict, args, data_path: str, fake_elasticsearch: FakeElasticsearch,
+                      fake_embedding_server: FakeEmbeddingServer) -> dict:
+    fake_elasticsearch.reset()
+    fake_embedding_server.reset()
+    env = dict(
+        os.environ,
+        OPENALEX_DATA_TO_INGEST_PATH=data_path,
+        ELASTICSEARCH_URL=fake_elasticsearch.url,
+        ELASTIC_PASSWORD="benchmark",
+        CA_CERTS_PATH=".",
+        API_CREATE_EMBEDDINGS_ENDPOINT=fake_embedding_server.url,
+        EMBEDDING_BACKEND="remote",
+        EMBEDDING_RESPONSE_FORMAT=args.embedding_response_format,
+        VECTOR_DIMS=str(args.embedding_dims),
+        # the embeddings are always created
+        EMBEDDING_CACHE_PATH="",
+        INGESTION_FILTER_FILE_PATH=os.getenv('INGESTION_FILTER_FILE_PATH', "ingestion_filter_template"),
+        INGESTED_FILES_INDEX="benchmark_ingested_files",
+        # each configuration ingests all the files
+        INGESTION_CHECKPOINT_PATH="",
+        INGESTION_REQUEST_TIMEOUT="1000",
+        BULK_LOAD_MODE="false",
+        METRICS_PORT="0",
+        LOG_LEVEL="WARNING",
+        NB_INGESTION_PROCESSES=str(configuration['processes']),
+        INFERENCE_CHUNK_SIZE=str(configuration['inference_chunk_size']),
+        # only used by reduce_dimensionality_of_index.py, the bulk requests of the ingestion are sized in bytes
+        INGESTION_CHUNK_SIZE=os.getenv('INGESTION_CHUNK_SIZE', "200"),
+        BULK_MIN_BYTES=str(configuration['bulk_min_bytes']),
+        BULK_MAX_BYTES=str(configuration['bulk_max_bytes']),
+        BULK_INITIAL_BYTES=str(configuration['bulk_initial_bytes']),
+    )
+    with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", args.mode, "--data-path", data_path,
+             "--result-file", result_file.name],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        with open(result_file.name) as f:
+            result = json.load(f)
+    result['docs'] = fake_elasticsearch.docs[ENTITY]
+    result['rejected_docs'] = fake_elasticsearch.counters['rejected_docs']
+    result['bulk_requests'] = fake_elasticsearch.counters['bulk_requests']
+    result['embedded_texts'] = fake_embedding_server.counters['texts']
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["entities", "file"], default="entities",
+                        help="ingest with ingest_list_of_entities or with ingest_file_bulk file by file")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--inference-chunk-sizes", type=int, nargs="+", default=[2000])
+    parser.add_argument("--bulk-min-bytes", type=int, nargs="+", default=[2 ** 20])
+    parser.add_argument("--bulk-max-bytes", type=int, nargs="+", default=[50 * 2 ** 20])
+    parser.add_argument("--bulk-initial-bytes", type=int, default=5 * 2 ** 20,
+                        help="clamped between the minimum and the maximum size of each configuration")
+    parser.add_argument("--data-path", help="existing snapshot to ingest, a synthetic one is generated if not set")
+    parser.add_argument("--nb-partitions", type=int, default=2)
+    parser.add_argument("--nb-files-per-partition", type=int, default=4)
+    parser.add_argument("--nb-works-per-file", type=int, default=2000)
+    parser.add_argument("--embedding-dims", type=int, default=384)
+    parser.add_argument("--embedding-latency", type=float, default=0.01, help="seconds per request")
+    parser.add_argument("--embedding-latency-per-text", type=float, default=0.0005, help="seconds per text")
+    parser.add_argument("--embedding-response-format", choices=["json", "float32", "float16"], default="float32")
+    parser.add_argument("--bulk-latency", type=float, default=0.005, help="seconds per bulk request")
+    parser.add_argument("--bulk-latency-per-mb", type=float, default=0.02, help="seconds per MB of bulk request")
+    parser.add_argument("--reject-rate", type=float, default=0., help="probability of a document being rejected")
+    # internal, the ingestion of a configuration in its own process
+    parser.add_argument("--run", choices=["entities", "file"], help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run_ingestion(args.run, args.data_path, args.result_file)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = args.data_path
+        if data_path is None:
+            data_path = os.path.join(tmp_dir, "data")
+            write_snapshot(data_path, ENTITY, args.nb_partitions, args.nb_files_per_partition, args.nb_works_per_file)
+        n_bytes = sum(os.path.getsize(os.path.join(root, filename))
+                      for root, _, filenames in os.walk(os.path.join(data_path, ENTITY)) for filename in filenames)
+
+        fake_elasticsearch = FakeElasticsearch(bulk_latency=args.bulk_latency,
+                                               bulk_latency_per_mb=args.bulk_latency_per_mb,
+                                               reject_rate=args.reject_rate).start()
+        fake_embedding_server = FakeEmbeddingServer(dims=args.embedding_dims, latency=args.embedding_latency,
+                                                    latency_per_text=args.embedding_latency_per_text).start()
+        print(f"{n_bytes / 2 ** 20:.1f} MB of {ENTITY} to ingest, mode {args.mode}")
+        print(f"{'processes':>10}{'inference':>11}{'bulk min MB':>13}{'bulk max MB':>13}{'docs':>9}{'docs/s':>10}"
+              f"{'MB/s':>8}{'CPU s':>9}{'CPU %':>8}{'RSS MB':>9}{'rejected':>10}")
+        try:
+            for processes, inference_chunk_size, bulk_min_bytes, bulk_max_bytes in itertools.product(
+                    args.processes, args.inference_chunk_sizes, args.bulk_min_bytes, args.bulk_max_bytes):
+                if bulk_min_bytes > bulk_max_bytes:
+                    continue
+                configuration = {
+                    'processes': processes,
+                    'inference_chunk_size': inference_chunk_size,
+                    'bulk_min_bytes': bulk_min_bytes,
+                    'bulk_max_bytes': bulk_max_bytes,
+                    'bulk_initial_bytes': min(max(args.bulk_initial_bytes, bulk_min_bytes), bulk_max_bytes),
+                }
+                result = run_configuration(configuration, args, data_path, fake_elasticsearch, fake_embedding_server)
+                print(f"{processes:>10}{inference_chunk_size:>11}"
+                      f"{bulk_min_bytes / 2 ** 20:>13.1f}{bulk_max_bytes / 2 ** 20:>13.1f}{result['docs']:>9}"
+                      f"{result['docs'] / result['duration']:>10.0f}{n_bytes / 2 ** 20 / result['duration']:>8.2f}"
+                      f"{result['cpu_seconds']:>9.1f}{100 * result['cpu_seconds'] / result['duration']:>8.0f}"
+                      f"{result['peak_rss_mb']:>9.0f}{result['rejected_docs']:>10}")
+        finally:
+            fake_elasticsearch.stop()
+            fake_embedding_server.stop()
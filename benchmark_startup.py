@@ -0,0 +1,143 @@
+"""
+Benchmark of the startup of the entry points: time to import ingest_data.py, api.py and
+reduce_dimensionality_of_index.py (the best of several runs, each in a new process) with their slowest imported
+packages (python -X importtime), and time for the API served by uvicorn to answer /health and /ready (model loaded and
+warmed up), against a local stand-in of Elasticsearch (see fake_services.py). The import of an entry point fails if
+it imports one of the packages of LAZY_PACKAGES, which must only be imported when they are used.
+
+python benchmark_startup.py [--repeat 5] [--no-api-server] [--ready-timeout 300]
+"""
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+from fake_services import FakeElasticsearch
+
+# the entry points and the python code importing them, without running their command
+ENTRY_POINTS = {
+    "ingest_data.py": "import ingest_data",
+    "api.py": "import api",
+    "reduce_dimensionality_of_index.py": "import reduce_dimensionality_of_index",
+}
+# packages slow to import, imported by the functions using them
+LAZY_PACKAGES = ["elasticsearch"]
+_IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def get_env(elasticsearch_url: str) -> dict:
+    env = dict(
+        os.environ,
+        ELASTICSEARCH_URL=elasticsearch_url,
+        ELASTIC_PASSWORD="benchmark",
+        CA_CERTS_PATH=".",
+        LOG_LEVEL="WARNING",
+        METRICS_PORT="0",
+    )
+    # the variables without default value
+    for name, value in [("INFERENCE_CHUNK_SIZE", "2000"), ("INGESTION_CHUNK_SIZE", "200"),
+                        ("INGESTION_REQUEST_TIMEOUT", "1000"), ("NB_INGESTION_PROCESSES", "1"),
+                        ("INGESTION_FILTER_FILE_PATH", "ingestion_filter_template")]:
+        env.setdefault(name, value)
+    return env
+
+
+def time_import(code: str, env: dict) -> tuple[float, list[tuple[str, float]]]:
+    """
+    :return: The wall time of a new process running the code in seconds, and the modules imported by the entry point
+    with their cumulative import time in seconds, from the slowest.
+    :raise RuntimeError: If the code fails or imports one of LAZY_PACKAGES.
+    """
+    check_code = f"import sys; print([package for package in {LAZY_PACKAGES} if package in sys.modules])"
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"{code}\n{check_code}"], env=env,
+                             capture_output=True, text=True)
+    duration = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr[-2000:])
+    imported_lazy_packages = process.stdout.strip().splitlines()[-1]
+    if imported_lazy_packages != "[]":
+        raise RuntimeError(f"imports {imported_lazy_packages}, which must be imported lazily")
+    packages = []
+    for line in process.stderr.splitlines():
+        match = _IMPORT_TIME_PATTERN.match(line)
+        # the entry point has a single space of indentation, the modules it imports three
+        if match is not None and len(match.group(3)) == 3:
+            packages.append((match.group(4), int(match.group(2)) / 1e6))
+    packages.sort(key=lambda package: package[1], reverse=True)
+    return duration, packages
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_api_server(env: dict, ready_timeout: float) -> tuple[float, float | None]:
+    """
+    Start the API with uvicorn and poll /health and /ready.
+    :return: The time to answer /health and to answer /ready with 200 in seconds (None after ready_timeout).
+    """
+    port = get_free_port()
+    url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level",
+                                "warning"], env=env)
+    health_duration = ready_duration = None
+    try:
+        while time.perf_counter() - started < ready_timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"The API exited with the code {process.returncode}")
+            try:
+                if health_duration is None and requests.get(f"{url}/health", timeout=1).status_code == 200:
+                    health_duration = time.perf_counter() - started
+                if health_duration is not None and requests.get(f"{url}/ready", timeout=5).status_code == 200:
+                    ready_duration = time.perf_counter() - started
+                    break
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.05)
+    finally:
+        process.terminate()
+        process.wait()
+    return health_duration, ready_duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="the best duration out of the repetitions is kept")
+    parser.add_argument("--top", type=int, default=5, help="number of slowest imported packages shown")
+    parser.add_argument("--no-api-server", action="store_true", help="don't time /health and /ready")
+    parser.add_argument("--ready-timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    fake_elasticsearch = FakeElasticsearch()
+    fake_elasticsearch.start()
+    failed = False
+    try:
+        env = get_env(fake_elasticsearch.url)
+        print(f"{'entry point':<36}{'import s':>10}  slowest imports")
+        for name, code in ENTRY_POINTS.items():
+            try:
+                results = [time_import(code, env) for _ in range(args.repeat)]
+            except RuntimeError as e:
+                print(f"{name:<36}failed: {e}")
+                failed = True
+                continue
+            duration, packages = min(results, key=lambda result: result[0])
+            slowest = ", ".join(f"{package} {seconds:.2f}s" for package, seconds in packages[:args.top])
+            print(f"{name:<36}{duration:>10.2f}  {slowest}")
+
+        if not args.no_api_server:
+            health_duration, ready_duration = time_api_server(env, args.ready_timeout)
+            print(f"\nAPI /health: {health_duration:.2f}s" if health_duration is not None else "\nAPI /health: timeout")
+            print(f"API /ready: {ready_duration:.2f}s" if ready_duration is not None else "API /ready: timeout")
+    finally:
+        fake_elasticsearch.stop()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,120 @@
+"""
+Benchmark of the KNN searches of the embeddings of the abstracts: recall@k against the exact nearest neighbors
+(brute-force script_score search on the float vectors) and latency, for several num_candidates, on a random sample of
+the embeddings of the index used as queries. The off-heap memory needed by the vectors of each index is estimated from
+its mapping (see vector_mapping.py), to compare the index types (e.g. an index migrated with
+'VECTOR_INDEX_TYPE=int4_hnsw python vector_mapping.py migrate --target works-int4' against the current one).
+
+python benchmark_vector_search.py [--indexes works works-int4] [--nb-queries 100] [--k 10] [--num-candidates 50 100 500]
+"""
+import argparse
+import time
+
+import numpy as np
+
+import config
+from vector_mapping import VECTOR_FIELD, estimate_vector_memory
+
+# scripts of the exact scores, non-negative as required by script_score, in the same order as the KNN scores
+EXACT_SCORE_SCRIPTS = {
+    "cosine": f"cosineSimilarity(params.query_vector, '{VECTOR_FIELD}') + 1.0",
+    "dot_product": f"dotProduct(params.query_vector, '{VECTOR_FIELD}') + 1.0",
+    "max_inner_product": f"double s = dotProduct(params.query_vector, '{VECTOR_FIELD}'); "
+                         f"return s < 0 ? 1 / (1 - s) : s + 1;",
+    "l2_norm": f"1 / (1 + l2norm(params.query_vector, '{VECTOR_FIELD}'))",
+}
+
+
+def get_vector_mapping_of_index(index: str) -> dict:
+    mappings = config.client.indices.get_mapping(index=index)
+    return next(iter(mappings.values()))['mappings']['properties'][VECTOR_FIELD]
+
+
+def sample_query_vectors(index: str, nb_queries: int, seed: int = 42) -> list[list[float]]:
+    """
+    :return: The embeddings of a random sample of the documents of the index.
+    """
+    resp = config.client.search(
+        index=index,
+        size=nb_queries,
+        query={"function_score": {
+            "query": {"exists": {"field": VECTOR_FIELD}},
+            "random_score": {"seed": seed, "field": "_seq_no"},
+        }},
+        source=[VECTOR_FIELD],
+    )
+    return [hit['_source'][VECTOR_FIELD] for hit in resp['hits']['hits']]
+
+
+def exact_search(index: str, query_vector: list[float], k: int, similarity: str) -> list[str]:
+    """
+    :return: The _ids of the exact k nearest neighbors, by scoring all the embeddings.
+    """
+    resp = config.client.options(request_timeout=600).search(
+        index=index,
+        size=k,
+        query={"script_score": {
+            "query": {"exists": {"field": VECTOR_FIELD}},
+            "script": {"source": EXACT_SCORE_SCRIPTS[similarity], "params": {"query_vector": query_vector}},
+        }},
+        source=False,
+    )
+    return [hit['_id'] for hit in resp['hits']['hits']]
+
+
+def knn_search(index: str, query_vector: list[float], k: int, num_candidates: int) -> tuple[list[str], float, float]:
+    """
+    :return: The _ids of the approximate k nearest neighbors, the latency measured by the client and by Elasticsearch
+    (took) in milliseconds.
+    """
+    started = time.perf_counter()
+    resp = config.client.search(
+        index=index,
+        knn={"field": VECTOR_FIELD, "query_vector": query_vector, "k": k, "num_candidates": num_candidates},
+        size=k,
+        source=False,
+        request_cache=False,
+    )
+    latency = (time.perf_counter() - started) * 1000
+    return [hit['_id'] for hit in resp['hits']['hits']], latency, resp['took']
+
+
+def benchmark_index(index: str, nb_queries: int, k: int, list_num_candidates: list[int], seed: int):
+    mapping = get_vector_mapping_of_index(index)
+    index_type = mapping.get('index_options', {}).get('type', "hnsw")
+    m = mapping.get('index_options', {}).get('m', 16)
+    nb_vectors = config.client.count(index=index, query={"exists": {"field": VECTOR_FIELD}})['count']
+    memory = estimate_vector_memory(nb_vectors, mapping['dims'], index_type, m)
+    print(f"\n{index}: {nb_vectors} vectors, {mapping['dims']} dims, {mapping.get('similarity')}, "
+          f"{mapping.get('index_options')}, estimated off-heap memory: {memory / 2 ** 30:.2f} GiB "
+          f"(float32 hnsw: {estimate_vector_memory(nb_vectors, mapping['dims'], 'hnsw', m) / 2 ** 30:.2f} GiB)")
+
+    query_vectors = sample_query_vectors(index, nb_queries, seed)
+    exact_neighbors = [set(exact_search(index, query_vector, k, mapping.get('similarity', "cosine")))
+                       for query_vector in query_vectors]
+    # warm up
+    for query_vector in query_vectors[:10]:
+        knn_search(index, query_vector, k, max(list_num_candidates))
+
+    print(f"{'num_candidates':>16}{f'recall@{k}':>12}{'p50 ms':>10}{'p95 ms':>10}{'p50 took':>10}{'p95 took':>10}")
+    for num_candidates in list_num_candidates:
+        recalls, latencies, tooks = [], [], []
+        for query_vector, neighbors in zip(query_vectors, exact_neighbors):
+            ids, latency, took = knn_search(index, query_vector, k, max(num_candidates, k))
+            recalls.append(len(neighbors.intersection(ids)) / max(len(neighbors), 1))
+            latencies.append(latency)
+            tooks.append(took)
+        print(f"{num_candidates:>16}{np.mean(recalls):>12.4f}{np.percentile(latencies, 50):>10.1f}"
+              f"{np.percentile(latencies, 95):>10.1f}{np.percentile(tooks, 50):>10.1f}{np.percentile(tooks, 95):>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--indexes", nargs="+", default=["works"])
+    parser.add_argument("--nb-queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, nargs="+", default=[20, 50, 100, 500, 1000, 5000])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    for index in args.indexes:
+        benchmark_index(index, args.nb_queries, args.k, args.num_candidates, args.seed)
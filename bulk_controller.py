@@ -0,0 +1,174 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from ingestion_metrics import IngestionMetrics
+from log_config import log
+
+
+class AdaptiveBulkController:
+    """
+    Send bulk requests sized in bytes instead of in documents, and adapt their size to the cluster.
+
+    The target size of the requests is decreased when the cluster rejects documents (429) or when the latency of the
+    requests is above target_latency, and increased when the latency is well below it. The rejected documents are
+    retried with an exponential backoff, and up to max_in_flight requests are sent concurrently. run() yields the
+    results like elasticsearch.helpers.streaming_bulk.
+    """
+
+    def __init__(
+            self,
+            client,
+            initial_bytes: int = config.bulk_initial_bytes,
+            min_bytes: int = config.bulk_min_bytes,
+            max_bytes: int = config.bulk_max_bytes,
+            max_docs: int = config.bulk_max_docs,
+            target_latency: float = config.bulk_target_latency,
+            max_in_flight: int = config.bulk_max_in_flight_requests,
+            max_retries: int = config.bulk_max_retries,
+            retry_backoff: float = config.bulk_retry_backoff,
+            request_timeout: float = config.ingestion_request_timeout,
+            metrics: IngestionMetrics = None
+        ):
+        """
+        :param client: The Elasticsearch client.
+        :param initial_bytes: Initial target size of the requests in bytes.
+        :param min_bytes: Minimum target size of the requests in bytes.
+        :param max_bytes: Maximum target size of the requests in bytes.
+        :param max_docs: Maximum number of documents per request.
+        :param target_latency: Latency of the requests in seconds above which their size is decreased.
+        :param max_in_flight: Maximum number of concurrent requests.
+        :param max_retries: Maximum number of retries of the rejected documents.
+        :param retry_backoff: Delay in seconds before the first retry, doubled at each retry.
+        :param request_timeout: Timeout of the requests in seconds.
+        :param metrics: The metrics of the bulk stage (duration, latency, rejections).
+        """
+        self.client = client.options(request_timeout=request_timeout)
+        self.serializer = client.transport.serializers.get_serializer("application/json")
+        self.target_bytes = initial_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.target_latency = target_latency
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.metrics = metrics if metrics is not None else IngestionMetrics()
+
+    def _serialize(self, action):
+        """
+        :return: (op_type, _id, serialized lines) of the action.
+        """
+        # import here, elasticsearch is slow to import and the API doesn't use this module
+        from elasticsearch.helpers import expand_action
+        action_line, data = expand_action(action)
+        op_type, metadata = next(iter(action_line.items()))
+        lines = [self.serializer.dumps(action_line)]
+        if data is not None:
+            lines.append(self.serializer.dumps(data))
+        return op_type, metadata.get("_id"), lines
+
+    def _chunks(self, actions):
+        chunk = []
+        chunk_bytes = 0
+        for action in actions:
+            serialized_action = self._serialize(action)
+            # +1 for each line break
+            action_bytes = sum(len(line) + 1 for line in serialized_action[2])
+            if len(chunk) > 0 and (chunk_bytes + action_bytes > self.target_bytes or len(chunk) >= self.max_docs):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(serialized_action)
+            chunk_bytes += action_bytes
+        if len(chunk) > 0:
+            yield chunk
+
+    def _send(self, chunk):
+        """
+        Send a chunk, retrying the rejected documents.
+        :return: The results [(ok, item)], the latency of the first request, the number of rejected documents and
+        the size of the chunk in bytes.
+        """
+        from elasticsearch import ApiError, TransportError
+        send_started = time.perf_counter()
+        results = []
+        latency = None
+        nb_rejected = 0
+        chunk_bytes = sum(len(line) + 1 for _, _, lines in chunk for line in lines)
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                resp = self.client.bulk(operations=[line for _, _, lines in chunk for line in lines])
+            except (ApiError, TransportError) as e:
+                status = getattr(e, "status_code", None)
+                if (isinstance(e, ApiError) and status != 429 and status < 500) or attempt == self.max_retries:
+                    results.extend((False, {op_type: {"_id": _id, "status": status, "error": str(e)}})
+                                   for op_type, _id, _ in chunk)
+                    break
+                # the whole request was rejected or failed, retry it
+                retried = chunk
+            else:
+                retried = []
+                for serialized_action, item in zip(chunk, resp["items"]):
+                    item_result = next(iter(item.values()))
+                    if item_result.get("status") == 429 and attempt < self.max_retries:
+                        retried.append(serialized_action)
+                    else:
+                        results.append((200 <= item_result.get("status", 500) < 300, item))
+            if latency is None:
+                latency = time.perf_counter() - started
+            if len(retried) == 0:
+                break
+            nb_rejected += len(retried)
+            delay = self.retry_backoff * 2 ** attempt
+            log.debug(f"{len(retried)} documents rejected, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+            chunk = retried
+        self.metrics.add_stage("bulk", time.perf_counter() - send_started, len(results), chunk_bytes)
+        return results, latency, nb_rejected, chunk_bytes
+
+    def _adapt(self, latency, nb_rejected, nb_docs, chunk_bytes):
+        self.metrics.increment('bulk_requests')
+        self.metrics.increment('bulk_rejections', nb_rejected)
+        if latency is not None:
+            self.metrics.observe('bulk_latency_seconds', latency)
+        previous_target_bytes = self.target_bytes
+        if nb_rejected > 0:
+            self.target_bytes = max(self.min_bytes, self.target_bytes // 2)
+            reason = f"{nb_rejected} out of {nb_docs} documents rejected"
+        elif latency is not None and latency > self.target_latency:
+            self.target_bytes = max(self.min_bytes, int(self.target_bytes * 0.8))
+            reason = f"latency {latency:.2f}s above {self.target_latency:.2f}s"
+        elif latency is not None and latency < self.target_latency / 2 and chunk_bytes >= self.target_bytes * 0.9:
+            self.target_bytes = min(self.max_bytes, int(self.target_bytes * 1.25))
+            reason = f"latency {latency:.2f}s below {self.target_latency / 2:.2f}s"
+        else:
+            return
+        if self.target_bytes != previous_target_bytes:
+            log.info(f"Bulk request size {previous_target_bytes} -> {self.target_bytes} Bytes ({reason})")
+
+    def run(self, actions):
+        """
+        Index the actions.
+        :param actions: The bulk actions, like for elasticsearch.helpers.streaming_bulk.
+        :return: A generator of (ok, item) for each action. The results are in the order of the actions, except for
+        the retried documents which come after the other documents of their request.
+        """
+        in_flight = deque()
+
+        def collect():
+            future, nb_docs = in_flight.popleft()
+            results, latency, nb_rejected, chunk_bytes = future.result()
+            self._adapt(latency, nb_rejected, nb_docs, chunk_bytes)
+            return results
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for chunk in self._chunks(actions):
+                in_flight.append((executor.submit(self._send, chunk), len(chunk)))
+                # the next chunk is prepared while max_in_flight requests are sent
+                while len(in_flight) > self.max_in_flight:
+                    yield from collect()
+            while len(in_flight) > 0:
+                yield from collect()
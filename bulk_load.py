@@ -0,0 +1,113 @@
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import config
+from log_config import log
+
+# settings of the indexes during the bulk load: no refresh, no replica and asynchronous translog
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.auto_expand_replicas": "false",
+    "index.number_of_replicas": 0,
+    "index.translog.durability": "async",
+}
+
+
+def _get_settings(index: str) -> dict:
+    """
+    :return: The current values of the settings of BULK_LOAD_SETTINGS for the index (the default values if they are not
+    set).
+    """
+    resp = config.client.indices.get_settings(index=index, include_defaults=True, flat_settings=True)
+    settings = resp[index]['settings']
+    defaults = resp[index].get('defaults', {})
+    return {name: settings.get(name, defaults.get(name)) for name in BULK_LOAD_SETTINGS}
+
+
+def _resolve_indexes(indexes: list[str]) -> list[str]:
+    """
+    :return: The concrete indexes of the indexes and aliases (e.g. the partitions of the works).
+    """
+    return sorted(config.client.indices.get_alias(index=",".join(indexes)).keys())
+
+
+def _read_state() -> dict:
+    if not os.path.exists(config.bulk_load_state_file):
+        return {}
+    with open(config.bulk_load_state_file) as f:
+        return json.load(f)
+
+
+def _write_state(state: dict):
+    with open(config.bulk_load_state_file, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def enter_bulk_load_mode(indexes: list[str]):
+    """
+    Set the settings of the indexes for a bulk load (BULK_LOAD_SETTINGS). Their previous settings are saved in
+    BULK_LOAD_STATE_FILE before, to be restored with exit_bulk_load_mode (also after a crash).
+    :param indexes: The indexes (or aliases) to bulk load.
+    """
+    state = _read_state()
+    indexes = _resolve_indexes(indexes)
+    for index in indexes:
+        if index in state:
+            # still in bulk load mode after a crash, keep the settings saved before the first bulk load
+            log.warning(f"Index {index} already in bulk load mode since {state[index]['started']}")
+        else:
+            state[index] = {
+                'started': datetime.now().isoformat(),
+                'settings_before': _get_settings(index),
+                'settings_bulk_load': BULK_LOAD_SETTINGS,
+            }
+            # the state is saved before changing the settings
+            _write_state(state)
+        config.client.indices.put_settings(index=index, settings=BULK_LOAD_SETTINGS)
+        log.info(f"Index {index} in bulk load mode: {BULK_LOAD_SETTINGS}")
+
+
+def exit_bulk_load_mode(indexes: list[str] = None, force_merge_segments: int = config.bulk_load_force_merge_segments):
+    """
+    Restore the settings saved by enter_bulk_load_mode, refresh the indexes and optionally force merge them.
+    :param indexes: The indexes (or aliases) to restore, all the indexes saved in BULK_LOAD_STATE_FILE if None.
+    :param force_merge_segments: Maximum number of segments per shard after the force merge, 0 to skip it.
+    """
+    state = _read_state()
+    if indexes is None:
+        indexes = list(state.keys())
+    else:
+        indexes = _resolve_indexes(indexes)
+    for index in indexes:
+        if index not in state:
+            log.warning(f"Index {index} not in bulk load mode, nothing to restore")
+            continue
+        settings_before = state[index]['settings_before']
+        config.client.indices.put_settings(index=index, settings=settings_before)
+        log.info(f"Restored the settings of the index {index}: {settings_before}")
+        config.client.indices.refresh(index=index)
+        if force_merge_segments > 0:
+            log.info(f"Force merging the index {index} to {force_merge_segments} segments per shard...")
+            config.client.options(request_timeout=None).indices.forcemerge(
+                index=index,
+                max_num_segments=force_merge_segments,
+            )
+        del state[index]
+        _write_state(state)
+        log.info(f"Index {index} out of bulk load mode.")
+    if len(state) == 0 and os.path.exists(config.bulk_load_state_file):
+        os.remove(config.bulk_load_state_file)
+
+
+@contextmanager
+def bulk_load_mode(indexes: list[str]):
+    """
+    Context manager putting the indexes in bulk load mode (see enter_bulk_load_mode and exit_bulk_load_mode).
+    """
+    enter_bulk_load_mode(indexes)
+    try:
+        yield
+    finally:
+        exit_bulk_load_mode(indexes)
@@ -1,7 +1,10 @@
 import os
 from dotenv import load_dotenv
-from elasticsearch import Elasticsearch
 import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from elasticsearch import Elasticsearch, AsyncElasticsearch
 
 load_dotenv()  # take environment variables from .env.
 
@@ -13,14 +16,135 @@ elastic_ca_certs_path = os.getenv('CA_CERTS_PATH')
 inference_chunk_size = int(os.getenv('INFERENCE_CHUNK_SIZE'))
 ingestion_chunk_size = int(os.getenv('INGESTION_CHUNK_SIZE'))
 ingestion_request_timeout = int(os.getenv('INGESTION_REQUEST_TIMEOUT'))
+# size of the bulk requests of the ingestion in bytes, adapted between the minimum and the maximum (see
+# bulk_controller.py)
+bulk_initial_bytes = int(os.getenv('BULK_INITIAL_BYTES', 5 * 2 ** 20))
+bulk_min_bytes = int(os.getenv('BULK_MIN_BYTES', 2 ** 20))
+bulk_max_bytes = int(os.getenv('BULK_MAX_BYTES', 50 * 2 ** 20))
+bulk_max_docs = int(os.getenv('BULK_MAX_DOCS', 10000))
+# the size of the bulk requests is decreased when their latency is above this target
+bulk_target_latency = float(os.getenv('BULK_TARGET_LATENCY_SECONDS', 2))
+bulk_max_in_flight_requests = int(os.getenv('BULK_MAX_IN_FLIGHT_REQUESTS', 2))
+# the documents rejected by the cluster (429) are retried with an exponential backoff
+bulk_max_retries = int(os.getenv('BULK_MAX_RETRIES', 5))
+bulk_retry_backoff = float(os.getenv('BULK_RETRY_BACKOFF_SECONDS', 1))
+
+# the metrics of the ingestion are served in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+# during the ingestion, 0 to disable (e.g. 9108)
+metrics_host = os.getenv('METRICS_HOST', "127.0.0.1")
+metrics_port = int(os.getenv('METRICS_PORT', 0))
+# the ingestion processes push the metrics of the file being ingested to the parent process at this interval
+metrics_push_interval = float(os.getenv('METRICS_PUSH_INTERVAL_SECONDS', 5))
+
+# set the indexes to no refresh, no replica and asynchronous translog during the ingestion (see bulk_load.py)
+bulk_load_mode = os.getenv('BULK_LOAD_MODE', "false").lower() in ("true", "1", "yes")
+# settings of the indexes before the bulk load, restored after it or with 'python ingest_data.py
+# --restore-index-settings' after a crash
+bulk_load_state_file = os.getenv('BULK_LOAD_STATE_FILE', "bulk_load_state.json")
+# maximum number of segments per shard after the bulk load, 0 to skip the force merge
+bulk_load_force_merge_segments = int(os.getenv('BULK_LOAD_FORCE_MERGE_SEGMENTS', 0))
 
 ingested_files_index = os.getenv('INGESTED_FILES_INDEX')
 nb_ingestion_processes = int(os.getenv('NB_INGESTION_PROCESSES'))
+# number of times a file is ingested again after the death of the process ingesting it (e.g. killed by the OOM killer)
+# before it is counted as failed
+ingestion_max_file_attempts = int(os.getenv('INGESTION_MAX_FILE_ATTEMPTS', 3))
+# the ingested files are recorded in batches, when one of these limits is reached
+ingested_files_flush_size = int(os.getenv('INGESTED_FILES_FLUSH_SIZE', 100))
+ingested_files_flush_interval = float(os.getenv('INGESTED_FILES_FLUSH_INTERVAL_SECONDS', 30))
+# the progress of the ingestion of each file is saved in this directory, to resume a file from its last acknowledged line
+# after a crash (see ingestion_checkpoint.py), the checkpoints are disabled if empty
+ingestion_checkpoint_path = os.getenv('INGESTION_CHECKPOINT_PATH', "ingestion_checkpoints")
+ingestion_checkpoint_interval = float(os.getenv('INGESTION_CHECKPOINT_INTERVAL_SECONDS', 30))
+# exports of the indexes (see export.py): number of slices exported in parallel, documents per request, keep alive of
+# the point in time between two requests, and folder of the exports
+export_nb_slices = int(os.getenv('EXPORT_NB_SLICES', 8))
+export_batch_size = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+export_pit_keep_alive = os.getenv('EXPORT_PIT_KEEP_ALIVE', "5m")
+export_path = os.getenv('EXPORT_PATH', "exports")
+# 2D projection of the embeddings (see reduce_dimensionality_of_index.py): number of embeddings the projection is fitted
+# on, number of embeddings projected at once, file of the fitted projection and threads sending the bulk updates
+reduce_sample_size = int(os.getenv('REDUCE_SAMPLE_SIZE', 1000000))
+reduce_batch_size = int(os.getenv('REDUCE_BATCH_SIZE', 100000))
+reduce_model_path = os.getenv('REDUCE_MODEL_PATH', "umap_model.joblib")
+reduce_nb_bulk_threads = int(os.getenv('REDUCE_NB_BULK_THREADS', 4))
+# index storing the high-water marks of the incremental sync of each entity (see snapshot_sync.py)
+sync_state_index = os.getenv('SYNC_STATE_INDEX', "sync_state")
+
+# mapping of the embeddings of the abstracts (see vector_mapping.py): dimension (0 for the known dimension of the model
+# TEXT_ENCODING_MODEL_NAME, see vector_mapping.MODEL_DIMS), similarity, type of the index (quantization of the vectors
+# in memory: int8_hnsw, int4_hnsw, bbq_hnsw, hnsw, flat...), parameters of the HNSW graph and quantile of the int8 and
+# int4 quantization (the default of Elasticsearch if empty)
+vector_dims = int(os.getenv('VECTOR_DIMS', 0))
+text_encoding_model_name = os.getenv('TEXT_ENCODING_MODEL_NAME')
+vector_similarity = os.getenv('VECTOR_SIMILARITY', "dot_product")
+vector_index_type = os.getenv('VECTOR_INDEX_TYPE', "int8_hnsw")
+vector_hnsw_m = int(os.getenv('VECTOR_HNSW_M', 16))
+vector_hnsw_ef_construction = int(os.getenv('VECTOR_HNSW_EF_CONSTRUCTION', 100))
+vector_confidence_interval = float(os.getenv('VECTOR_CONFIDENCE_INTERVAL')) if os.getenv('VECTOR_CONFIDENCE_INTERVAL') \
+    else None
 
+# partitioned layout of the works (see works_partitions.py): one index per bucket of publication years, the buckets start
+# at the years of WORKS_PARTITION_YEARS, searched through the alias works
+works_partitioned = os.getenv('WORKS_PARTITIONED', "false").lower() in ("true", "1", "yes")
+works_partition_years = sorted(int(year) for year in
+                               os.getenv('WORKS_PARTITION_YEARS', "1990,2000,2010,2015,2020").split(",") if year.strip())
+
+# backends reading the gzip JSONL files, 'auto' selects the fastest installed one (see decode.py and
+# benchmark_decode.py)
+decode_decompressor = os.getenv('DECODE_DECOMPRESSOR', "auto")
+decode_json_parser = os.getenv('DECODE_JSON_PARSER', "auto")
+# size of the decompressed blocks split in lines at once, 0 to read the files line by line
+decode_block_size = int(os.getenv('DECODE_BLOCK_SIZE', 1048576))
+
+# 'remote' to create the embeddings with the API (API_CREATE_EMBEDDINGS_ENDPOINT), 'local' to create them in a process
+# started by the ingestion, loading the model (TEXT_ENCODING_MODEL_NAME) once for all the ingestion processes
+embedding_backend = os.getenv('EMBEDDING_BACKEND', "remote")
+if embedding_backend not in ("remote", "local"):
+    raise ValueError(f"EMBEDDING_BACKEND must be 'remote' or 'local', not '{embedding_backend}'")
 api_create_embeddings_endpoint = os.getenv('API_CREATE_EMBEDDINGS_ENDPOINT')
+# model of the API (see the endpoint /model_info), default to the endpoint next to API_CREATE_EMBEDDINGS_ENDPOINT
+api_model_info_endpoint = os.getenv('API_MODEL_INFO_ENDPOINT') or (
+    api_create_embeddings_endpoint.rsplit("/", 1)[0] + "/model_info" if api_create_embeddings_endpoint else None)
+# format of the embeddings returned by the API: 'json', or the binary 'float32' or 'float16'
+embedding_response_format = os.getenv('EMBEDDING_RESPONSE_FORMAT', "float32")
+# directory of the persistent cache of the embeddings (see embedding_cache.py), the cache is disabled if not set
+embedding_cache_path = os.getenv('EMBEDDING_CACHE_PATH')
+# the oldest segments of the cache are deleted when the cache is larger
+embedding_cache_max_bytes = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 50 * 10 ** 9))
+# the keys of the cache contain the model, the engine and the effective dtype of the embeddings (see ml.get_model_key
+# if not set, requested to the API with EMBEDDING_BACKEND=remote)
+embedding_cache_model_key = os.getenv('EMBEDDING_CACHE_MODEL_KEY')
+# number of inference chunks being embedded while the previous chunks are indexed (1 to disable the pipelining)
+embedding_max_in_flight_chunks = int(os.getenv('EMBEDDING_MAX_IN_FLIGHT_CHUNKS', 2))
+embedding_request_timeout = float(os.getenv('EMBEDDING_REQUEST_TIMEOUT', 600))
+embedding_max_retries = int(os.getenv('EMBEDDING_MAX_RETRIES', 5))
+# delay before the first retry in seconds, doubled at each retry
+embedding_retry_backoff = float(os.getenv('EMBEDDING_RETRY_BACKOFF_SECONDS', 1))
 ingestion_filter_file_path = os.getenv('INGESTION_FILTER_FILE_PATH')
+# declarative filters of the ingestion evaluated before parsing the documents (see ingestion_filter_rules.py), applied
+# before the Python filter of INGESTION_FILTER_FILE_PATH, disabled if not set
+ingestion_filter_rules_path = os.getenv('INGESTION_FILTER_RULES_PATH')
 
-ingestion_filter = importlib.import_module(ingestion_filter_file_path)
+# batching of the texts encoded by the API (see embedding_batcher.py)
+embedding_batch_max_size = int(os.getenv('EMBEDDING_BATCH_MAX_SIZE', 128))
+embedding_batch_max_wait = float(os.getenv('EMBEDDING_BATCH_MAX_WAIT_MS', 5)) / 1000
+# caches of the searches of the API (see search_cache.py): embeddings of the normalized texts (LRU) and results of the
+# KNN searches (LRU with a TTL, cleared when the works index is refreshed with changes, checked at most every
+# SEARCH_CACHE_GENERATION_CHECK_SECONDS), 0 to disable
+search_embedding_cache_size = int(os.getenv('SEARCH_EMBEDDING_CACHE_SIZE', 10000))
+search_result_cache_size = int(os.getenv('SEARCH_RESULT_CACHE_SIZE', 10000))
+search_result_cache_ttl = float(os.getenv('SEARCH_RESULT_CACHE_TTL_SECONDS', 300))
+search_cache_generation_check_interval = float(os.getenv('SEARCH_CACHE_GENERATION_CHECK_SECONDS', 5))
+# the texts are lowercased before being encoded, for uncased models (like all-MiniLM-L6-v2)
+search_cache_lowercase = os.getenv('SEARCH_CACHE_LOWERCASE', "true").lower() in ("true", "1", "yes")
+# maximum number of queries of a request to /batch_knn_search
+batch_knn_search_max_queries = int(os.getenv('BATCH_KNN_SEARCH_MAX_QUERIES', 10000))
+# load the model and encode a text when the API starts, the API is ready (/ready) once it is done, else the model is
+# loaded by the first request
+api_warm_up = os.getenv('API_WARM_UP', "true").lower() in ("true", "1", "yes")
+# maximum number of connections of the API to each Elasticsearch node, shared by the concurrent searches
+api_elasticsearch_connections = int(os.getenv('API_ELASTICSEARCH_CONNECTIONS', 32))
 
 entities_to_ingest = [
     # "authors",
@@ -36,10 +160,62 @@ entities_to_ingest = [
     "works",
 ]
 
-# Create the client instance
-client = Elasticsearch(
-    elasticsearch_url,
-    ca_certs=os.path.join(elastic_ca_certs_path, "ca/ca.crt"),
-    basic_auth=("elastic", elastic_password),
-    # retry_on_status=[408, 502, 503, 504], # https://elasticsearch-py.readthedocs.io/en/7.x/connection.html
-)
\ No newline at end of file
+# the CA certificate is only used with https (e.g. not with the local stand-in of benchmark_ingestion.py)
+elastic_ca_certs = os.path.join(elastic_ca_certs_path, "ca/ca.crt") if elasticsearch_url.startswith("https") else None
+
+# the client (config.client) and the ingestion filter (config.ingestion_filter) are created on their first use (see
+# __getattr__), the commands and the API which don't need them start faster
+_client = None
+_client_pid = None
+_async_client = None
+
+
+def get_client() -> "Elasticsearch":
+    """
+    Get the client of Elasticsearch of the process, created on the first call. A forked process (e.g. an ingestion or
+    an export process) creates its own client instead of using the one it inherited: the kept-alive connections of the
+    parent can't be shared, the responses of the concurrent requests on a shared socket would be mixed up.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        from elasticsearch import Elasticsearch
+        _client = Elasticsearch(
+            elasticsearch_url,
+            ca_certs=elastic_ca_certs,
+            basic_auth=("elastic", elastic_password),
+            # retry_on_status=[408, 502, 503, 504], # https://elasticsearch-py.readthedocs.io/en/7.x/connection.html
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+def get_async_client() -> "AsyncElasticsearch":
+    """
+    Get the client of the search endpoints of the API, created on the first call (the ingestion doesn't need aiohttp).
+    Its connections are shared by the concurrent requests.
+    """
+    global _async_client
+    if _async_client is None:
+        from elasticsearch import AsyncElasticsearch
+        _async_client = AsyncElasticsearch(
+            elasticsearch_url,
+            ca_certs=elastic_ca_certs,
+            basic_auth=("elastic", elastic_password),
+            connections_per_node=api_elasticsearch_connections,
+        )
+    return _async_client
+
+
+def __getattr__(name: str):
+    """
+    Lazy attributes of the module: client, the client of the process (see get_client), and ingestion_filter, set as
+    a global on the first access (__getattr__ is only called for the missing attributes).
+    """
+    if name == "client":
+        return get_client()
+    if name == "ingestion_filter":
+        value = importlib.import_module(ingestion_filter_file_path)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -0,0 +1,112 @@
+import gzip
+import json
+
+import config
+from log_config import log
+
+# optional faster backends, used when they are installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+
+# name -> function opening a gzip file in binary mode, from the fastest to the slowest
+DECOMPRESSORS = {
+    "isal": igzip.open if igzip is not None else None,
+    "zlib_ng": gzip_ng.open if gzip_ng is not None else None,
+    "gzip": gzip.open,
+}
+
+# name -> function parsing a JSON document from bytes, from the fastest to the slowest
+JSON_PARSERS = {
+    "orjson": orjson.loads if orjson is not None else None,
+    "json": json.loads,
+}
+
+
+def get_available_decompressors() -> list[str]:
+    return [name for name, open_function in DECOMPRESSORS.items() if open_function is not None]
+
+
+def get_available_json_parsers() -> list[str]:
+    return [name for name, parse_function in JSON_PARSERS.items() if parse_function is not None]
+
+
+def _get_backend(backends: dict, name: str, kind: str):
+    if name == "auto":
+        return next(function for function in backends.values() if function is not None)
+    if name not in backends:
+        raise ValueError(f"Unknown {kind} '{name}', must be 'auto' or one of {list(backends.keys())}")
+    if backends[name] is None:
+        log.warning(f"The {kind} '{name}' is not installed, using the default one")
+        return _get_backend(backends, "auto", kind)
+    return backends[name]
+
+
+def get_json_parser(json_parser: str = config.decode_json_parser):
+    """
+    :param json_parser: 'auto' (the fastest installed) or one of JSON_PARSERS.
+    :return: The function parsing a JSON document from bytes.
+    """
+    return _get_backend(JSON_PARSERS, json_parser, "JSON parser")
+
+
+def iter_lines(
+        file_path: str,
+        decompressor: str = config.decode_decompressor,
+        block_size: int = config.decode_block_size
+    ):
+    """
+    Read the lines of a gzip JSONL file.
+    :param file_path: The path of the file.
+    :param decompressor: 'auto' (the fastest installed) or one of DECOMPRESSORS.
+    :param block_size: Size in bytes of the decompressed blocks split in lines at once. If 0, the file is read line by
+    line.
+    :return: A generator of the non-empty lines (bytes), the line breaks are not always removed.
+    """
+    open_function = _get_backend(DECOMPRESSORS, decompressor, "decompressor")
+    with open_function(file_path, 'rb') as f:
+        if block_size <= 0:
+            for line in f:
+                if line != b"\n":
+                    yield line
+            return
+        remainder = b""
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            lines = (remainder + block).split(b"\n")
+            # the last line may continue in the next block
+            remainder = lines.pop()
+            yield from filter(None, lines)
+        if remainder:
+            yield remainder
+
+
+def iter_documents(
+        file_path: str,
+        decompressor: str = config.decode_decompressor,
+        json_parser: str = config.decode_json_parser,
+        block_size: int = config.decode_block_size
+    ):
+    """
+    Read and parse the documents of a gzip JSONL file (one document per line).
+    :param file_path: The path of the file.
+    :param decompressor: 'auto' (the fastest installed) or one of DECOMPRESSORS.
+    :param json_parser: 'auto' (the fastest installed) or one of JSON_PARSERS.
+    :param block_size: Size in bytes of the decompressed blocks split in lines at once. If 0, the file is read line by
+    line.
+    :return: A generator of the documents (dict).
+    """
+    parse = get_json_parser(json_parser)
+    for line in iter_lines(file_path, decompressor, block_size):
+        yield parse(line)
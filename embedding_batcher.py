@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import config
+from log_config import log
+
+# priorities of the requests, the interactive requests (e.g. a search) are encoded before the bulk ones (ingestion)
+INTERACTIVE = 0
+BULK = 1
+
+
+class _Request:
+    def __init__(self, texts: list[str]):
+        self.future = Future()
+        self.results = [None] * len(texts)
+        self.remaining = len(texts)
+
+
+class EmbeddingBatcher:
+    """
+    Encode the texts of concurrent requests together, in batches of up to max_batch_size texts.
+
+    The texts are queued per priority. A batch is started as soon as it is full, when an interactive text is waiting,
+    or after max_wait_seconds. The texts of a batch are sorted by length before being encoded to reduce the padding, and
+    each request gets its own embeddings back through a Future.
+    """
+
+    def __init__(
+            self,
+            encode,
+            max_batch_size: int = config.embedding_batch_max_size,
+            max_wait_seconds: float = config.embedding_batch_max_wait
+        ):
+        """
+        :param encode: Function encoding a list of texts, returning one embedding per text.
+        :param max_batch_size: Maximum number of texts encoded together.
+        :param max_wait_seconds: Maximum time waiting for other texts before starting a batch.
+        """
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        # one queue of (request, index of the text in the request, text) per priority
+        self._queues = (deque(), deque())
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+            self._thread.start()
+
+    def submit(self, texts: list[str], priority: int = BULK) -> Future:
+        """
+        Queue texts to encode.
+        :param texts: The texts.
+        :param priority: INTERACTIVE or BULK.
+        :return: A Future of the list of the embeddings, in the same order as the texts.
+        """
+        request = _Request(texts)
+        if len(texts) == 0:
+            request.future.set_result([])
+            return request.future
+        with self._condition:
+            self._queues[priority].extend((request, i, text) for i, text in enumerate(texts))
+            self._condition.notify()
+        return request.future
+
+    def _nb_queued(self):
+        return len(self._queues[INTERACTIVE]) + len(self._queues[BULK])
+
+    def _next_batch(self):
+        with self._condition:
+            while self._nb_queued() == 0:
+                self._condition.wait()
+            # wait for the texts of other requests, unless an interactive text is waiting
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(self._queues[INTERACTIVE]) == 0 and self._nb_queued() < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = []
+            for queue in self._queues:
+                while len(queue) > 0 and len(batch) < self.max_batch_size:
+                    batch.append(queue.popleft())
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # similar lengths in the same batch to reduce the padding
+            batch.sort(key=lambda item: len(item[2]))
+            try:
+                embeddings = self.encode([text for _, _, text in batch])
+            except Exception as e:
+                log.error(f"Failed to encode a batch of {len(batch)} texts: {e}")
+                for request, _, _ in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for (request, i, _), embedding in zip(batch, embeddings):
+                if request.future.done():
+                    # failed in a previous batch
+                    continue
+                request.results[i] = embedding
+                request.remaining -= 1
+                if request.remaining == 0:
+                    request.future.set_result(request.results)
@@ -0,0 +1,205 @@
+import glob
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+
+import config
+from embedding_client import get_remote_model_key
+from log_config import log
+
+_KEY_SIZE = 16
+_KEY_DTYPE = np.dtype(f"S{_KEY_SIZE}")
+
+
+class _Segment:
+    """
+    Embeddings written by one process: <name>.keys (keys of 16 bytes) and <name>.<dims>.f32 (float32 matrix, one row
+    per key). The keys are sorted in memory to be searched with a binary search, the vectors are memory-mapped.
+    """
+
+    def __init__(self, keys_path: str, vectors_path: str, dims: int):
+        keys = np.fromfile(keys_path, dtype=_KEY_DTYPE)
+        nb_rows = min(len(keys), os.path.getsize(vectors_path) // (dims * 4))
+        self.order = np.argsort(keys[:nb_rows], kind="stable")
+        self.sorted_keys = keys[:nb_rows][self.order]
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(nb_rows, dims)) \
+            if nb_rows > 0 else np.zeros((0, dims), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.sorted_keys)
+
+    def find(self, keys: np.ndarray):
+        """
+        :return: The mask of the keys found and the rows of their vectors.
+        """
+        if len(self) == 0:
+            return np.zeros(len(keys), dtype=bool), np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_keys, keys), len(self) - 1)
+        found = self.sorted_keys[positions] == keys
+        return found, self.order[positions[found]]
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of the embeddings, keyed by a hash of (model, dtype, text), so the abstracts which didn't change
+    between two snapshots are not embedded again.
+
+    The cache is a directory of append-only segments, one per process and per run. The segments present when the cache
+    is opened are searched, the embeddings created by the process are appended to its own segment. The oldest segments
+    are deleted when the cache is larger than max_bytes (see evict), when it is opened and while the segments grow.
+    """
+
+    def __init__(self, directory: str, model_key: str = config.embedding_cache_model_key,
+                 max_bytes: int = config.embedding_cache_max_bytes):
+        """
+        :param directory: The directory of the segments.
+        :param model_key: The model, the engine and the dtype of the embeddings, part of the keys, default to the key
+        of the model of the API with EMBEDDING_BACKEND=remote, to ml.get_model_key otherwise.
+        :param max_bytes: Maximum size of the directory.
+        """
+        if not model_key and config.embedding_backend == "remote":
+            # the effective dtype depends on the host of the API
+            model_key = get_remote_model_key()
+        elif not model_key:
+            # import here, ml imports torch to check the effective dtype of the half precision models
+            from ml import get_model_key
+            model_key = get_model_key()
+        self.directory = directory
+        self.model_key = model_key.encode() + b"\0"
+        self.max_bytes = max_bytes
+        self.segments = []
+        self._writer = None
+        self._writer_pid = None
+        # bytes appended by the process since the size of the cache was last checked, and whether the cache is full
+        self._nb_bytes_unchecked = 0
+        self._full = False
+        self._opened_at = time.time()
+        self._lock = threading.Lock()
+
+    def open(self):
+        """
+        Load the segments of the directory.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._opened_at = time.time()
+        self.segments = []
+        for keys_path in sorted(glob.glob(os.path.join(self.directory, "*.keys"))):
+            vectors_paths = glob.glob(keys_path[:-len(".keys")] + ".*.f32")
+            if len(vectors_paths) != 1:
+                continue
+            dims = int(vectors_paths[0].split(".")[-2])
+            self.segments.append(_Segment(keys_path, vectors_paths[0], dims))
+        log.info(f"Loaded {sum(len(segment) for segment in self.segments)} cached embeddings from {self.directory}.")
+        return self
+
+    def evict(self, max_bytes: int = None, modified_before: float = None) -> int:
+        """
+        Delete the oldest segments until the cache is smaller than max_bytes. The loaded segments stay readable, their
+        files are only unlinked.
+        :param max_bytes: Maximum size of the directory, default to self.max_bytes.
+        :param modified_before: Only delete the segments modified before this timestamp, e.g. to keep the segments being
+        written.
+        :return: The size of the directory after the eviction.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        segments = []
+        for keys_path in glob.glob(os.path.join(self.directory, "*.keys")):
+            paths = [keys_path] + glob.glob(keys_path[:-len(".keys")] + ".*.f32")
+            try:
+                segments.append((os.path.getmtime(keys_path), sum(os.path.getsize(path) for path in paths), paths))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+        total_bytes = sum(size for _, size, _ in segments)
+        for mtime, size, paths in sorted(segments):
+            if total_bytes <= max_bytes or (modified_before is not None and mtime >= modified_before):
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+            log.info(f"Evicted the embedding cache segment {paths[0]} ({size} Bytes).")
+        return total_bytes
+
+    def get_keys(self, texts: list[str]) -> np.ndarray:
+        return np.array(
+            [hashlib.blake2b(self.model_key + text.encode(), digest_size=_KEY_SIZE).digest() for text in texts],
+            dtype=_KEY_DTYPE,
+        )
+
+    def get(self, keys: np.ndarray) -> list:
+        """
+        :param keys: The keys of the texts (see get_keys).
+        :return: The cached embeddings (float32 arrays), None for the texts not in the cache.
+        """
+        embeddings = [None] * len(keys)
+        missing = np.arange(len(keys))
+        for segment in self.segments:
+            if len(missing) == 0:
+                break
+            found, rows = segment.find(keys[missing])
+            for i, row in zip(missing[found], rows):
+                embeddings[i] = np.array(segment.vectors[row])
+            missing = missing[~found]
+        return embeddings
+
+    def put(self, keys: np.ndarray, embeddings):
+        """
+        Append embeddings to the segment of the process.
+        :param keys: The keys of the texts (see get_keys).
+        :param embeddings: The embeddings of the texts.
+        """
+        if len(keys) == 0 or self._full:
+            return
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock:
+            if self._writer is None or self._writer_pid != os.getpid():
+                self._nb_bytes_unchecked = 0
+                # new segment for each process
+                name = os.path.join(self.directory, f"{time.time_ns()}-{os.getpid()}")
+                self._writer = (open(f"{name}.keys", "ab"), open(f"{name}.{matrix.shape[1]}.f32", "ab"))
+                self._writer_pid = os.getpid()
+            keys_file, vectors_file = self._writer
+            # the keys are written first, the rows without their full vector are ignored when the segment is loaded
+            keys_file.write(keys.tobytes())
+            keys_file.flush()
+            vectors_file.write(matrix.tobytes())
+            vectors_file.flush()
+            # the size of the cache is checked each time the processes may have appended 1% of max_bytes
+            self._nb_bytes_unchecked += keys.nbytes + matrix.nbytes
+            if self._nb_bytes_unchecked * config.nb_ingestion_processes >= self.max_bytes / 100:
+                self._nb_bytes_unchecked = 0
+                # the segments written since the cache was opened are kept
+                if self.evict(modified_before=self._opened_at) > self.max_bytes:
+                    self._full = True
+                    log.warning(f"The embedding cache {self.directory} is full ({self.max_bytes} Bytes), the new "
+                                f"embeddings of the process are not cached anymore.")
+
+
+# cache opened by the parent process and inherited by the ingestion processes
+_embedding_cache = None
+
+
+def open_embedding_cache() -> EmbeddingCache | None:
+    """
+    Open the embedding cache configured with EMBEDDING_CACHE_PATH, evicting its oldest segments first. The cache is
+    then returned by get_embedding_cache, also in the processes forked afterward.
+    :return: The cache, None if EMBEDDING_CACHE_PATH is not set.
+    """
+    global _embedding_cache
+    if not config.embedding_cache_path:
+        return None
+    _embedding_cache = EmbeddingCache(config.embedding_cache_path)
+    os.makedirs(config.embedding_cache_path, exist_ok=True)
+    _embedding_cache.evict()
+    return _embedding_cache.open()
+
+
+def get_embedding_cache() -> EmbeddingCache | None:
+    return _embedding_cache
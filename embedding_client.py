@@ -0,0 +1,275 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+from embedding_format import MEDIA_TYPES, decode_embeddings
+from log_config import log
+
+# one HTTP session per process, created after the fork of the ingestion processes
+_session = None
+_session_pid = None
+# client of the local embedding server in the ingestion processes (EMBEDDING_BACKEND=local)
+_local_client = None
+
+
+def get_session() -> requests.Session:
+    """
+    Get the HTTP session of the process. The connections to the embedding API are pooled and kept alive.
+    :return: The session.
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(config.embedding_max_in_flight_chunks, 1))
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def _parse_embeddings_response(resp: requests.Response):
+    if resp.headers.get("Content-Type", "").split(";")[0] in MEDIA_TYPES.values():
+        return decode_embeddings(resp.content)
+    # JSON, also returned by the API versions without the binary format
+    return [vec['vector'] for vec in resp.json()]
+
+
+def get_remote_model_key() -> str:
+    """
+    Get the key of the model of the embedding API (see ml.get_model_key), e.g. its effective dtype depends on the GPU of
+    the host of the API, not of the ingestion.
+    :return: The key of the model.
+    """
+    try:
+        resp = get_session().get(config.api_model_info_endpoint, timeout=config.embedding_request_timeout)
+        resp.raise_for_status()
+        return resp.json()['model_key']
+    except (requests.RequestException, KeyError, ValueError) as e:
+        raise RuntimeError(f"Failed to get the model of the embedding API from {config.api_model_info_endpoint} ({e}), "
+                           f"set EMBEDDING_CACHE_MODEL_KEY") from e
+
+
+def create_embeddings(texts: list[str]):
+    """
+    Create the embeddings of a list of texts, with the local embedding server if the process was initialized with
+    init_local_embedding_client, with the API (API_CREATE_EMBEDDINGS_ENDPOINT) otherwise. The failed requests to the
+    API are retried with an exponential backoff.
+    :param texts: The texts to create the embeddings from.
+    :return: The embeddings, in the same order as the texts. A float32 matrix with one row per text if the local server
+    or the binary format (EMBEDDING_RESPONSE_FORMAT) is used, a list of lists of floats otherwise.
+    """
+    if _local_client is not None:
+        return _local_client.create_embeddings(texts)
+    headers = {}
+    if config.embedding_response_format in MEDIA_TYPES:
+        headers["Accept"] = f"{MEDIA_TYPES[config.embedding_response_format]}, application/json;q=0.5"
+    for attempt in range(config.embedding_max_retries + 1):
+        try:
+            resp = get_session().post(
+                url=config.api_create_embeddings_endpoint,
+                json=texts,
+                headers=headers,
+                timeout=config.embedding_request_timeout,
+            )
+            resp.raise_for_status()
+            return _parse_embeddings_response(resp)
+        except requests.RequestException as e:
+            if attempt == config.embedding_max_retries:
+                raise
+            delay = config.embedding_retry_backoff * 2 ** attempt
+            log.warning(f"Failed to create {len(texts)} embeddings ({e}), retrying in {delay:.1f}s "
+                        f"({attempt + 1}/{config.embedding_max_retries})")
+            time.sleep(delay)
+
+
+class EmbeddingPipeline:
+    """
+    Embed chunks of documents in background threads while the previous chunks are consumed (e.g. bulk indexed).
+
+    At most max_in_flight chunks are submitted and not yet returned, the chunks are returned in the order in which
+    they were submitted. With max_in_flight <= 1, the chunks are embedded synchronously.
+    """
+
+    def __init__(self, embed_chunk, max_in_flight: int = config.embedding_max_in_flight_chunks):
+        """
+        :param embed_chunk: Function embedding a chunk, its return value is returned by submit and drain.
+        :param max_in_flight: Maximum number of chunks being embedded.
+        """
+        self.embed_chunk = embed_chunk
+        self.max_in_flight = max_in_flight
+        self._in_flight = deque()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight) if max_in_flight > 1 else None
+
+    def submit(self, chunk):
+        """
+        Submit a chunk and yield the embedded chunks which must be consumed to respect max_in_flight.
+        :param chunk: The chunk to embed.
+        """
+        if self._executor is None:
+            yield self.embed_chunk(chunk)
+            return
+        self._in_flight.append(self._executor.submit(self.embed_chunk, chunk))
+        while len(self._in_flight) >= self.max_in_flight:
+            yield self._in_flight.popleft().result()
+
+    def drain(self):
+        """
+        Yield all the remaining embedded chunks.
+        """
+        while len(self._in_flight) > 0:
+            yield self._in_flight.popleft().result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _run_local_embedding_server(request_queue, response_queues, max_batch_size):
+    # the model is only loaded in the server process
+    from ml import encode_text_document, get_model
+    get_model()
+
+    log.info("Local embedding server ready.")
+    stopping = False
+    while not stopping:
+        requests_batch = [request_queue.get()]
+        if requests_batch[0] is None:
+            break
+        # encode the requests waiting in the queue together
+        nb_texts = len(requests_batch[0][2])
+        while nb_texts < max_batch_size:
+            try:
+                request = request_queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                stopping = True
+                break
+            requests_batch.append(request)
+            nb_texts += len(request[2])
+        try:
+            embeddings = np.asarray(
+                encode_text_document([text for _, _, texts in requests_batch for text in texts]),
+                dtype=np.float32,
+            )
+        except Exception as e:
+            log.error(f"Failed to encode {nb_texts} texts: {e}")
+            for client_id, request_id, _ in requests_batch:
+                response_queues[client_id].put((request_id, None, str(e)))
+            continue
+        start = 0
+        for client_id, request_id, texts in requests_batch:
+            response_queues[client_id].put((request_id, embeddings[start:start + len(texts)], None))
+            start += len(texts)
+
+
+class LocalEmbeddingServer:
+    """
+    Process loading the model (ml.py) once and encoding the texts sent by the ingestion processes through
+    multiprocessing queues (EMBEDDING_BACKEND=local).
+
+    Each ingestion process gets a client id and its own response queue when it is initialized with
+    init_local_embedding_client (initializer of the pool, with get_client_args() as arguments).
+    """
+
+    def __init__(self, nb_clients: int, max_batch_size: int = config.inference_chunk_size):
+        """
+        :param nb_clients: Number of processes using the server, one response queue is created per process. A new
+        server is started if the pool is rebuilt.
+        :param max_batch_size: Number of texts from which the queued requests are not grouped anymore.
+        """
+        self.request_queue = multiprocessing.Queue()
+        self.response_queues = [multiprocessing.Queue() for _ in range(nb_clients)]
+        self.client_ids = multiprocessing.Queue()
+        for client_id in range(nb_clients):
+            self.client_ids.put(client_id)
+        self.process = multiprocessing.Process(
+            target=_run_local_embedding_server,
+            args=(self.request_queue, self.response_queues, max_batch_size),
+            name="local-embedding-server",
+            daemon=True,
+        )
+
+    def start(self):
+        self.process.start()
+
+    def stop(self, timeout: float = 60):
+        self.request_queue.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            # e.g. the queue was left locked by a killed ingestion process
+            log.warning("The local embedding server didn't stop, terminating it")
+            self.process.terminate()
+            self.process.join()
+
+    def get_client_args(self):
+        return self.request_queue, self.response_queues, self.client_ids
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _LocalEmbeddingClient:
+    def __init__(self, request_queue, response_queue, client_id):
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.client_id = client_id
+        self._request_ids = itertools.count()
+        # request id -> Future, several requests can be in flight (see EmbeddingPipeline)
+        self._futures = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._dispatch_responses, name="local-embedding-client", daemon=True).start()
+
+    def _dispatch_responses(self):
+        while True:
+            request_id, embeddings, error = self.response_queue.get()
+            with self._lock:
+                future = self._futures.pop(request_id)
+            if error is not None:
+                future.set_exception(RuntimeError(f"The local embedding server failed: {error}"))
+            else:
+                future.set_result(embeddings)
+
+    def create_embeddings(self, texts: list[str]) -> np.ndarray:
+        future = Future()
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._futures[request_id] = future
+        self.request_queue.put((self.client_id, request_id, texts))
+        return future.result(timeout=config.embedding_request_timeout)
+
+
+def init_local_embedding_client(request_queue, response_queues, client_ids):
+    """
+    Initialize the process to create the embeddings with a LocalEmbeddingServer.
+    :param request_queue: See LocalEmbeddingServer.get_client_args.
+    :param response_queues: See LocalEmbeddingServer.get_client_args.
+    :param client_ids: See LocalEmbeddingServer.get_client_args.
+    """
+    global _local_client
+    try:
+        client_id = client_ids.get_nowait()
+    except queue.Empty:
+        raise RuntimeError("No response queue left for the local embedding server")
+    _local_client = _LocalEmbeddingClient(request_queue, response_queues[client_id], client_id)
@@ -0,0 +1,55 @@
+import struct
+
+import numpy as np
+
+# binary format of the embeddings returned by /create_embeddings when requested with the Accept header: a header
+# (magic, dtype code, number of embeddings, dimension) followed by the row-major little-endian matrix
+MEDIA_TYPES = {
+    "float32": "application/x-embeddings-float32",
+    "float16": "application/x-embeddings-float16",
+}
+_MAGIC = b"EMB1"
+# 16 bytes, the matrix is aligned for its dtype
+_HEADER = struct.Struct("<4sIII")
+_DTYPE_CODES = {"float32": 1, "float16": 2}
+_DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f2")}
+
+
+def get_binary_format(accept: str | None) -> str | None:
+    """
+    :param accept: The Accept header of the request.
+    :return: 'float32' or 'float16' if a binary format is accepted, None otherwise.
+    """
+    if accept is None:
+        return None
+    for media_range in accept.split(","):
+        media_type = media_range.split(";")[0].strip()
+        for binary_format, binary_media_type in MEDIA_TYPES.items():
+            if media_type == binary_media_type:
+                return binary_format
+    return None
+
+
+def encode_embeddings(embeddings, binary_format: str = "float32") -> bytes:
+    """
+    :param embeddings: The embeddings, a matrix or a list of vectors of the same dimension.
+    :param binary_format: 'float32' or 'float16'.
+    :return: The embeddings in the binary format.
+    """
+    dtype_code = _DTYPE_CODES[binary_format]
+    matrix = np.ascontiguousarray(embeddings, dtype=_DTYPES[dtype_code])
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1) if matrix.size > 0 else matrix.reshape(0, 0)
+    return _HEADER.pack(_MAGIC, dtype_code, matrix.shape[0], matrix.shape[1]) + matrix.tobytes()
+
+
+def decode_embeddings(content: bytes) -> np.ndarray:
+    """
+    :param content: The embeddings in the binary format.
+    :return: The embeddings, a float32 matrix with one row per embedding.
+    """
+    magic, dtype_code, nb_rows, nb_dims = _HEADER.unpack_from(content)
+    if magic != _MAGIC or dtype_code not in _DTYPES:
+        raise ValueError("Invalid binary embeddings")
+    matrix = np.frombuffer(content, dtype=_DTYPES[dtype_code], count=nb_rows * nb_dims, offset=_HEADER.size)
+    return matrix.reshape(nb_rows, nb_dims).astype(np.float32, copy=False)
@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+from typing import TYPE_CHECKING
+
+import config
+from log_config import log
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+# fields exported as float32 matrices even if they are not mapped as dense_vector (e.g. mapped dynamically as float)
+VECTOR_FIELDS = ["abstract_embeddings", "abstract_embeddings_2d"]
+# arrow types (functions of pyarrow) of the scalar field types of Elasticsearch, the other fields are exported as JSON
+# strings
+_ARROW_TYPES = {
+    "keyword": "string",
+    "text": "string",
+    "match_only_text": "string",
+    "wildcard": "string",
+    "long": "int64",
+    "integer": "int64",
+    "short": "int64",
+    "byte": "int64",
+    "double": "float64",
+    "float": "float64",
+    "half_float": "float64",
+    "scaled_float": "float64",
+    "boolean": "bool_",
+}
+METADATA_FILE = "export.json"
+
+
+def _get_field_types(index: str, fields: list[str]) -> dict:
+    """
+    :return: field -> type in the mapping of the index, for the leaf fields (None for the objects and unmapped fields).
+    """
+    resp = config.client.indices.get_field_mapping(index=index, fields=fields)
+    field_types = {field: None for field in fields}
+    for index_mappings in resp.values():
+        for field, field_mapping in index_mappings['mappings'].items():
+            if field in field_types:
+                field_types[field] = next(iter(field_mapping['mapping'].values())).get('type')
+    return field_types
+
+
+def _get_vector_dims(index: str, field: str, pit: dict) -> int:
+    """
+    :return: The dimension of a vector field, from its mapping or from the first document having it.
+    """
+    resp = config.client.indices.get_field_mapping(index=index, fields=[field])
+    for index_mappings in resp.values():
+        mapping = index_mappings['mappings'].get(field, {}).get('mapping', {})
+        dims = next(iter(mapping.values()), {}).get('dims')
+        if dims is not None:
+            return dims
+    resp = config.client.search(pit=pit, size=1, query={"exists": {"field": field}}, source_includes=[field])
+    if len(resp['hits']['hits']) == 0:
+        return 0
+    return len(resp['hits']['hits'][0]['_source'][field])
+
+
+def _get_json_fields(fields: list[str], field_types: dict, pit: dict, sample_size: int = 1000) -> list[str]:
+    """
+    :return: The fields exported as JSON strings: the objects and unmapped fields, and the scalar fields having arrays
+    in a sample of the documents (the mapping doesn't tell if a field is an array).
+    """
+    json_fields = {field for field in fields if field_types[field] not in _ARROW_TYPES}
+    resp = config.client.search(pit=pit, size=sample_size, source_includes=fields)
+    for hit in resp['hits']['hits']:
+        json_fields.update(field for field, value in hit['_source'].items()
+                           if field in field_types and isinstance(value, (list, dict)))
+    return [field for field in fields if field in json_fields]
+
+
+def _get_slice_query(query: dict, slice_id: int, nb_slices: int) -> dict:
+    kwargs = {"query": query}
+    if nb_slices > 1:
+        kwargs["slice"] = {"id": slice_id, "max": nb_slices}
+    return kwargs
+
+
+def _get_slice_count(pit: dict, query: dict, slice_id: int, nb_slices: int) -> int:
+    resp = config.client.search(pit=pit, size=0, track_total_hits=True,
+                                **_get_slice_query(query, slice_id, nb_slices))
+    return resp['hits']['total']['value']
+
+
+def _export_slice(
+        pit: dict,
+        query: dict,
+        slice_id: int,
+        nb_slices: int,
+        offset: int,
+        count: int,
+        output_path: str,
+        schema: "pa.Schema",
+        json_fields: list[str],
+        vector_fields: list[str],
+        batch_size: int
+    ) -> tuple[int, list[str]]:
+    """
+    Export a slice of the point in time to a Parquet file and to its rows of the vector matrices.
+    :return: The number of exported documents, and the scalar fields having arrays or objects which were not seen in
+    the sample of _get_json_fields. If there are such fields, the export of the slice is stopped, as the type of their
+    column can't change in the Parquet file, and the slice must be exported again with these fields as JSON strings.
+    """
+    # import here, numpy and pyarrow are slow to import and only needed by the exports
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    fields = [field for field in schema.names if field not in ("_id", "_index")]
+    vectors = {field: np.load(os.path.join(output_path, f"{field}.npy"), mmap_mode="r+") for field in vector_fields}
+    nb_docs = 0
+    search_after = None
+    with pq.ParquetWriter(os.path.join(output_path, f"part-{slice_id:05d}.parquet"), schema) as writer:
+        while True:
+            resp = config.client.search(
+                pit=pit,
+                size=batch_size,
+                sort=["_shard_doc"],
+                search_after=search_after,
+                source_includes=fields + vector_fields,
+                track_total_hits=False,
+                **_get_slice_query(query, slice_id, nb_slices),
+            )
+            hits = resp['hits']['hits']
+            if len(hits) == 0:
+                break
+            # the id of the point in time can change between the requests
+            pit = {"id": resp.get('pit_id', pit['id']), "keep_alive": pit['keep_alive']}
+            search_after = hits[-1]['sort']
+            if nb_docs + len(hits) > count:
+                log.error(f"Slice {slice_id} has more documents than counted, the vectors of the last ones are not "
+                          f"exported.")
+            columns = {"_id": [hit['_id'] for hit in hits], "_index": [hit['_index'] for hit in hits]}
+            array_fields = []
+            for field in fields:
+                values = [hit['_source'].get(field) for hit in hits]
+                if field in json_fields:
+                    values = [json.dumps(value) if value is not None else None for value in values]
+                elif any(isinstance(value, (list, dict)) for value in values):
+                    # an array not seen in the sample of _get_json_fields
+                    array_fields.append(field)
+                columns[field] = values
+            if len(array_fields) > 0:
+                return nb_docs, array_fields
+            writer.write_table(pa.table(columns, schema=schema))
+            for field in vector_fields:
+                rows = [(j, hit['_source'][field]) for j, hit in enumerate(hits)
+                        if hit['_source'].get(field) is not None and nb_docs + j < count]
+                if len(rows) > 0:
+                    positions, matrix = zip(*rows)
+                    vectors[field][offset + nb_docs + np.asarray(positions)] = np.asarray(matrix, dtype=np.float32)
+            nb_docs += len(hits)
+    for matrix in vectors.values():
+        matrix.flush()
+    return nb_docs, []
+
+
+def export_index(
+        index: str,
+        output_path: str,
+        fields: list[str] = None,
+        vector_fields: list[str] = None,
+        query: dict = None,
+        nb_slices: int = config.export_nb_slices,
+        batch_size: int = config.export_batch_size,
+        keep_alive: str = config.export_pit_keep_alive
+    ) -> dict:
+    """
+    Export the documents of an index with parallel sliced searches on a point in time (a consistent view of the index),
+    only requesting the exported fields. Each slice is streamed into a Parquet file of output_path, in batches of
+    batch_size documents, and the vector fields are written into float32 matrices (<field>.npy, to open with
+    np.load(mmap_mode="r")), so the memory used doesn't depend on the size of the index.
+
+    The row i of the matrices is the document of the row i of the Parquet files read in order (see read_export). The
+    rows of the documents without the vector are NaN. The fields which are not scalar in the mapping (objects, unmapped
+    fields) or which are arrays in a sample of the documents are exported as JSON strings. If a scalar field has arrays
+    which were not in the sample, the slices are exported again with this field as JSON strings.
+    :param index: The index (or alias) to export, the concrete index of each document is exported with its _id.
+    :param output_path: The folder of the export.
+    :param fields: The fields to export (besides the _id and the _index), default to ['id', 'display_name', 'abstract'].
+    :param vector_fields: The fields exported as matrices, default to the fields mapped as dense_vector or in
+    VECTOR_FIELDS.
+    :param query: The query selecting the documents, all the documents by default.
+    :param nb_slices: The number of slices, exported in parallel by as many processes.
+    :param batch_size: The number of documents per search request.
+    :param keep_alive: How long the point in time is kept between two requests.
+    :return: The metadata of the export, also saved in output_path/export.json.
+    """
+    import numpy as np
+    import pyarrow as pa
+    from rich.progress import Progress
+    if fields is None:
+        fields = ['id', 'display_name', 'abstract']
+    if query is None:
+        query = {"match_all": {}}
+    field_types = _get_field_types(index, fields)
+    if vector_fields is None:
+        vector_fields = [field for field in fields if field_types[field] == "dense_vector" or field in VECTOR_FIELDS]
+    fields = [field for field in fields if field not in vector_fields]
+    os.makedirs(output_path, exist_ok=True)
+
+    pit = {"id": config.client.open_point_in_time(index=index, keep_alive=keep_alive)['id'], "keep_alive": keep_alive}
+    try:
+        json_fields = _get_json_fields(fields, field_types, pit)
+        # the slices are counted first to give each slice its rows in the matrices
+        counts = [_get_slice_count(pit, query, slice_id, nb_slices) for slice_id in range(nb_slices)]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        nb_docs = offsets[-1]
+        log.info(f"{nb_docs} documents of {index} to export in {nb_slices} slices.")
+        vector_dims = {}
+        for field in vector_fields:
+            vector_dims[field] = _get_vector_dims(index, field, pit)
+            matrix = np.lib.format.open_memmap(os.path.join(output_path, f"{field}.npy"), mode="w+",
+                                               dtype=np.float32, shape=(nb_docs, vector_dims[field]))
+            matrix[:] = np.nan
+            matrix.flush()
+            del matrix
+
+        array_fields = set()
+        while True:
+            json_fields = [field for field in fields if field in json_fields or field in array_fields]
+            schema = pa.schema([("_id", pa.string()), ("_index", pa.string())] + [
+                (field, pa.string() if field in json_fields else getattr(pa, _ARROW_TYPES[field_types[field]])())
+                for field in fields
+            ])
+            with Progress(expand=True) as progress:
+                task = progress.add_task(f"Exporting {index}...", total=nb_docs)
+                nb_exported = [0] * nb_slices
+
+                def on_slice_exported(slice_id, result):
+                    nb_exported[slice_id], slice_array_fields = result
+                    array_fields.update(slice_array_fields)
+                    progress.update(task, advance=counts[slice_id])
+
+                def on_slice_failed(slice_id, e):
+                    log.error(f"Failed to export the slice {slice_id} of {index}")
+                    log.error(e)
+                    progress.update(task, advance=counts[slice_id])
+
+                # each process creates its own client, the kept-alive connections of the parent can't be shared
+                with Pool(processes=min(nb_slices, os.cpu_count()), initializer=config.get_client) as pool:
+                    results = [pool.apply_async(
+                        _export_slice,
+                        args=(pit, query, slice_id, nb_slices, offsets[slice_id], counts[slice_id], output_path,
+                              schema, json_fields, vector_fields, batch_size),
+                        callback=partial(on_slice_exported, slice_id),
+                        error_callback=partial(on_slice_failed, slice_id),
+                    ) for slice_id in range(nb_slices)]
+                    pool.close()
+                    pool.join()
+            failed_slices = [slice_id for slice_id, result in enumerate(results) if not result.successful()]
+            if len(failed_slices) > 0:
+                raise RuntimeError(f"Failed to export the slices {failed_slices} of {index}")
+            if array_fields.issubset(json_fields):
+                break
+            # the columns of all the Parquet files must have the same types
+            log.warning(f"The fields {sorted(array_fields.difference(json_fields))} have arrays or objects which were "
+                        f"not in the sample, exporting {index} again with these fields as JSON strings.")
+    finally:
+        config.client.close_point_in_time(id=pit['id'])
+
+    metadata = {
+        'index': index,
+        'query': query,
+        'fields': fields,
+        'json_fields': json_fields,
+        'vector_fields': vector_dims,
+        'nb_docs': nb_docs,
+        'slices': [{'file': f"part-{slice_id:05d}.parquet", 'offset': offsets[slice_id], 'count': counts[slice_id],
+                    'nb_exported': nb_exported[slice_id]} for slice_id in range(nb_slices)],
+    }
+    with open(os.path.join(output_path, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+    log.info(f"Exported {sum(nb_exported)} documents of {index} to {output_path}.")
+    return metadata
+
+
+def read_export(output_path: str, columns: list[str] = None) -> tuple["pa.Table", dict]:
+    """
+    Read an export of export_index.
+    :param output_path: The folder of the export.
+    :param columns: The columns to read from the Parquet files, all by default.
+    :return: The table of the fields, and field -> memory-mapped float32 matrix for the vector fields (row i is the
+    document of the row i of the table).
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    with open(os.path.join(output_path, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    table = pa.concat_tables([pq.read_table(os.path.join(output_path, export_slice['file']), columns=columns)
+                              for export_slice in metadata['slices']])
+    vectors = {field: np.load(os.path.join(output_path, f"{field}.npy"), mmap_mode="r")
+               for field in metadata['vector_fields']}
+    return table, vectors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export an index to Parquet files and float32 matrices (.npy).")
+    parser.add_argument("index")
+    parser.add_argument("--output-path", help="default to EXPORT_PATH/<index>")
+    parser.add_argument("--fields", nargs="+", default=['id', 'display_name', 'abstract'])
+    parser.add_argument("--vector-fields", nargs="*", help="default to the dense_vector fields and VECTOR_FIELDS")
+    parser.add_argument("--nb-slices", type=int, default=config.export_nb_slices)
+    parser.add_argument("--batch-size", type=int, default=config.export_batch_size)
+    args = parser.parse_args()
+    export_index(args.index, args.output_path or os.path.join(config.export_path, args.index), args.fields,
+                 args.vector_fields, nb_slices=args.nb_slices, batch_size=args.batch_size)
@@ -0,0 +1,271 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from embedding_format import get_binary_format, encode_embeddings, MEDIA_TYPES
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    # keep-alive, like the real services
+    protocol_version = "HTTP/1.1"
+    extra_headers = {}
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send_content(self, status: int, content: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in self.extra_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def send_json(self, status: int, body):
+        self.send_content(status, json.dumps(body).encode(), "application/json")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeElasticsearch:
+    """
+    Stand-in of Elasticsearch for the ingestion benchmarks (benchmark_ingestion.py), in a background thread.
+
+    It answers the requests of the ingestion (indexes, settings, bulk, scroll search and single documents) without
+    storing the documents, and counts the indexed documents and bytes. The bulk requests can be slowed down
+    (bulk_latency_per_mb) and their documents rejected with a 429 (reject_rate) to exercise the adaptive bulk requests.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, bulk_latency: float = 0.,
+                 bulk_latency_per_mb: float = 0., reject_rate: float = 0., seed: int = 42):
+        """
+        :param host: The host to listen on.
+        :param port: The port to listen on, 0 for a free port.
+        :param bulk_latency: Latency of each bulk request in seconds.
+        :param bulk_latency_per_mb: Additional latency of the bulk requests in seconds per MB.
+        :param reject_rate: Probability of a document of a bulk request being rejected (429).
+        :param seed: The seed of the rejections.
+        """
+        self.bulk_latency = bulk_latency
+        self.bulk_latency_per_mb = bulk_latency_per_mb
+        self.reject_rate = reject_rate
+        self.indexes = set()
+        self.counters = Counter()
+        # number of indexed documents per index
+        self.docs = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._get_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-elasticsearch", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.indexes.clear()
+            self.counters.clear()
+            self.docs.clear()
+
+    def _bulk(self, body: bytes, default_index: str = None) -> dict:
+        time.sleep(self.bulk_latency + self.bulk_latency_per_mb * len(body) / 2 ** 20)
+        lines = body.splitlines()
+        items = []
+        i = 0
+        with self._lock:
+            while i < len(lines):
+                op_type, metadata = next(iter(json.loads(lines[i]).items()))
+                # delete is the only action without a source line
+                i += 1 if op_type == "delete" else 2
+                index = metadata.get("_index", default_index)
+                if self._rng.random() < self.reject_rate:
+                    items.append({op_type: {"_index": index, "_id": metadata.get("_id"), "status": 429,
+                                            "error": {"type": "es_rejected_execution_exception"}}})
+                    self.counters['rejected_docs'] += 1
+                    continue
+                self.indexes.add(index)
+                self.counters[f"{op_type}_docs"] += 1
+                self.docs[index] += op_type != "delete"
+                items.append({op_type: {"_index": index, "_id": metadata.get("_id"), "result": "created",
+                                        "status": 200 if op_type == "delete" else 201}})
+            self.counters['bulk_requests'] += 1
+            self.counters['bulk_bytes'] += len(body)
+        return {"took": 1, "errors": any(next(iter(item.values()))['status'] >= 300 for item in items),
+                "items": items}
+
+    def _get_handler(self):
+        fake = self
+
+        class Handler(_JSONHandler):
+            # the Elasticsearch client checks that it is connected to Elasticsearch
+            extra_headers = {"X-Elastic-Product": "Elasticsearch"}
+
+            def route(self):
+                url = urlsplit(self.path)
+                parts = [part for part in url.path.split("/") if part != ""]
+                return parts, parse_qs(url.query)
+
+            def do_HEAD(self):
+                parts, _ = self.route()
+                self.read_body()
+                # HEAD / is the ping of the client
+                exists = len(parts) == 0 or (len(parts) == 1 and parts[0] in fake.indexes)
+                self.send_json(200 if exists else 404, {})
+
+            def do_GET(self):
+                parts, _ = self.route()
+                self.read_body()
+                if len(parts) == 0:
+                    self.send_json(200, {"name": "fake", "cluster_name": "fake", "tagline": "You Know, for Search",
+                                         "version": {"number": "8.15.0", "build_flavor": "default"}})
+                elif len(parts) == 2 and parts[1] == "_settings":
+                    self.send_json(200, {parts[0]: {"settings": {}, "defaults": {}}})
+                elif parts[-1:] == ["_search"] or parts == ["_search", "scroll"]:
+                    self.send_empty_search()
+                else:
+                    self.send_json(404, {"error": f"Unsupported request GET {self.path}", "status": 404})
+
+            def do_PUT(self):
+                parts, _ = self.route()
+                body = self.read_body()
+                if parts[-1:] == ["_bulk"]:
+                    self.send_json(200, fake._bulk(body, parts[0] if len(parts) == 2 else None))
+                elif len(parts) == 1:
+                    with fake._lock:
+                        fake.indexes.add(parts[0])
+                    self.send_json(200, {"acknowledged": True, "shards_acknowledged": True, "index": parts[0]})
+                elif len(parts) == 2 and parts[1] == "_settings":
+                    self.send_json(200, {"acknowledged": True})
+                elif len(parts) == 3 and parts[1] in ("_doc", "_create"):
+                    self.index_document(parts, body)
+                else:
+                    self.send_json(404, {"error": f"Unsupported request PUT {self.path}", "status": 404})
+
+            def do_POST(self):
+                parts, _ = self.route()
+                body = self.read_body()
+                if parts[-1:] == ["_bulk"]:
+                    self.send_json(200, fake._bulk(body, parts[0] if len(parts) == 2 else None))
+                elif parts[-1:] == ["_search"] or parts == ["_search", "scroll"]:
+                    self.send_empty_search()
+                elif parts[-1:] in (["_refresh"], ["_forcemerge"]):
+                    self.send_json(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+                elif len(parts) >= 2 and parts[1] in ("_doc", "_create"):
+                    self.index_document(parts, body)
+                else:
+                    self.send_json(404, {"error": f"Unsupported request POST {self.path}", "status": 404})
+
+            def do_DELETE(self):
+                parts, _ = self.route()
+                self.read_body()
+                if parts[:2] == ["_search", "scroll"]:
+                    self.send_json(200, {"succeeded": True, "num_freed": 1})
+                elif len(parts) == 1:
+                    with fake._lock:
+                        fake.indexes.discard(parts[0])
+                    self.send_json(200, {"acknowledged": True})
+                else:
+                    self.send_json(404, {"error": f"Unsupported request DELETE {self.path}", "status": 404})
+
+            def send_empty_search(self):
+                # no document is stored
+                self.send_json(200, {"took": 1, "timed_out": False, "_scroll_id": "fake",
+                                     "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                                     "hits": {"total": {"value": 0, "relation": "eq"}, "max_score": None,
+                                              "hits": []}})
+
+            def index_document(self, parts, body):
+                with fake._lock:
+                    fake.indexes.add(parts[0])
+                    fake.counters['index_docs'] += 1
+                    fake.docs[parts[0]] += 1
+                    fake.counters['bulk_bytes'] += len(body)
+                self.send_json(201, {"_index": parts[0], "_id": parts[2] if len(parts) > 2 else "fake",
+                                     "result": "created", "_version": 1})
+
+        return Handler
+
+
+class FakeEmbeddingServer:
+    """
+    Stand-in of the /create_embeddings endpoint of the API for the ingestion benchmarks (benchmark_ingestion.py), in
+    a background thread. It returns random unit vectors after a configurable latency, as JSON or in the binary format
+    of embedding_format.py depending on the Accept header.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, dims: int = 384, latency: float = 0.,
+                 latency_per_text: float = 0.):
+        """
+        :param host: The host to listen on.
+        :param port: The port to listen on, 0 for a free port.
+        :param dims: The dimension of the embeddings.
+        :param latency: Latency of each request in seconds.
+        :param latency_per_text: Additional latency of the requests in seconds per text.
+        """
+        self.dims = dims
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._get_handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/create_embeddings"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-embedding-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+
+    def _get_handler(self):
+        fake = self
+
+        class Handler(_JSONHandler):
+            def do_POST(self):
+                texts = json.loads(self.read_body())
+                if urlsplit(self.path).path != "/create_embeddings":
+                    self.send_json(404, {"detail": "Not Found"})
+                    return
+                time.sleep(fake.latency + fake.latency_per_text * len(texts))
+                embeddings = np.random.default_rng(len(texts)).standard_normal((len(texts), fake.dims),
+                                                                                dtype=np.float32)
+                embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+                with fake._lock:
+                    fake.counters['requests'] += 1
+                    fake.counters['texts'] += len(texts)
+                binary_format = get_binary_format(self.headers.get("Accept"))
+                if binary_format is not None:
+                    self.send_content(200, encode_embeddings(embeddings, binary_format), MEDIA_TYPES[binary_format])
+                else:
+                    self.send_json(200, [{"vector": vector} for vector in embeddings.tolist()])
+
+        return Handler
@@ -1,22 +1,28 @@
 import sys
 
-from config import *
+import config
 from utils import reset_indexes, create_index, ingest_list_of_entities
+from bulk_load import exit_bulk_load_mode
 from log_config import log
 
 
 
 if __name__ == "__main__":
+    if "--restore-index-settings" in sys.argv:
+        # restore the settings of the indexes left in bulk load mode (e.g. after a crash)
+        exit_bulk_load_mode()
+        sys.exit()
     if "--reset-indexes" in sys.argv:
-        reset_indexes(entities_to_ingest)
+        reset_indexes(config.entities_to_ingest)
     else:
-        for entity in entities_to_ingest:
-            if client.indices.exists(index=entity):
+        for entity in config.entities_to_ingest:
+            if config.client.indices.exists(index=entity):
                 log.info(f"Index {entity} already exists.")
             else:
                 log.info(f"Index {entity} doesn't already exists.")
                 create_index(entity)
 
-    ingest_list_of_entities()
+    # only ingest the new partitions of the manifests and delete the merged entities
+    ingest_list_of_entities(incremental="--incremental" in sys.argv)
 
 
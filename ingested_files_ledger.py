@@ -0,0 +1,112 @@
+import threading
+import time
+
+import config
+from ingestion_checkpoint import remove_checkpoint
+from log_config import log
+
+
+class IngestedFilesLedger:
+    """
+    In-memory view of the index storing the ingested files (config.ingested_files_index).
+
+    The index is read once with a scroll when the ledger is loaded, then the lookups are done in memory, so checking
+    thousands of files doesn't cost thousands of requests. The ledger is inherited by the ingestion processes when they
+    are forked. The completed files are buffered and written to the index in batches with the bulk API.
+    """
+
+    def __init__(self, records: dict = None):
+        # relative file path -> (file size, file modification time). The size and the modification time are None for
+        # the files ingested before they were recorded
+        self.records = records if records is not None else {}
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        """
+        Read the full index of the ingested files once.
+        :return: The ledger.
+        """
+        # import here, elasticsearch is slow to import
+        from elasticsearch.helpers import scan
+        records = {}
+        if config.client.indices.exists(index=config.ingested_files_index):
+            for hit in scan(
+                config.client,
+                index=config.ingested_files_index,
+                query={"query": {"match_all": {}}, "_source": ["file", "file_size", "file_mtime"]},
+                size=5000,
+            ):
+                record = hit['_source']
+                file_size = record.get('file_size')
+                if record['file'] in records:
+                    log.error(f"The file {record['file']} was ingested multiple times")
+                    # keep the record with the size and the modification time if there is one
+                    if file_size is None:
+                        continue
+                records[record['file']] = (file_size, record.get('file_mtime'))
+        log.info(f"Loaded {len(records)} ingested files from the index {config.ingested_files_index}.")
+        return cls(records)
+
+    def is_ingested(self, relative_file_path: str, file_size: int = None, file_mtime: float = None) -> bool:
+        """
+        Check if a file was already ingested. If the size or the modification time of the file changed since its
+        ingestion, the file is considered as not ingested.
+        :param relative_file_path: The path of the file relative to the dataset (see get_dataset_relative_file_path).
+        :param file_size: The size of the file in bytes.
+        :param file_mtime: The modification time of the file (timestamp in seconds).
+        :return: Whether the file was already ingested.
+        """
+        if relative_file_path not in self.records:
+            return False
+        recorded_size, recorded_mtime = self.records[relative_file_path]
+        if file_size is not None and recorded_size is not None and recorded_size != file_size:
+            return False
+        if file_mtime is not None and recorded_mtime is not None and recorded_mtime != file_mtime:
+            return False
+        return True
+
+    def record(self, doc_ingested_file: dict):
+        """
+        Record an ingested file. The record is written to the index with the next batch.
+        :param doc_ingested_file: The document describing the ingestion of the file, 'file' is the relative path.
+        """
+        with self._lock:
+            self.records[doc_ingested_file['file']] = (
+                doc_ingested_file.get('file_size'),
+                doc_ingested_file.get('file_mtime'),
+            )
+            self._pending.append({
+                "_index": config.ingested_files_index,
+                # one document per file, a re-ingested file replaces its previous record
+                "_id": doc_ingested_file['file'],
+                "_source": doc_ingested_file,
+            })
+            flush_needed = (len(self._pending) >= config.ingested_files_flush_size or
+                            time.monotonic() - self._last_flush >= config.ingested_files_flush_interval)
+        if flush_needed:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending records to the index.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._last_flush = time.monotonic()
+        if len(pending) == 0:
+            return
+        from elasticsearch.helpers import bulk
+        successes, errors = bulk(config.client, pending, raise_on_error=False, raise_on_exception=False)
+        failed_files = set()
+        for error in errors:
+            log.error(f"Failed to record an ingested file: {error}")
+            failed_files.update(item.get('_id') for item in error.values())
+        # the checkpoints of the recorded files are not needed anymore
+        for action in pending:
+            if action['_id'] not in failed_files:
+                remove_checkpoint(action['_id'])
+        log.debug(f"Recorded {successes} ingested files.")
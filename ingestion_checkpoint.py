@@ -0,0 +1,183 @@
+import json
+import os
+import shutil
+import time
+
+import config
+from log_config import log
+
+
+def _get_checkpoint_path(relative_file_path: str) -> str:
+    # one JSON file per ingested file, e.g. works__updated_date=2024-01-01__part_000.gz.json
+    return os.path.join(config.ingestion_checkpoint_path, relative_file_path.replace(os.sep, "__") + ".json")
+
+
+class FileCheckpoint:
+    """
+    Checkpoint of the ingestion of a file, to resume it after a crash from the last acknowledged line instead of from
+    the beginning of the file.
+
+    The checkpoint is the number of lines of the file from the beginning whose documents were all acknowledged by the
+    bulk API (or ignored by the filter). The documents are acknowledged out of order (the documents with an abstract
+    are indexed first, the rejected documents are retried later), so the lines of the documents sent and not yet
+    acknowledged are kept by _id, and the checkpoint is the first of these lines. As the _ids of the documents are
+    deterministic, the documents of the lines after the checkpoint are replaced when the file is resumed.
+
+    The numbers of indexed and failed documents saved with the checkpoint only count the lines before the checkpoint,
+    the documents acknowledged after it are sent again and counted again when the file is resumed. nb_successes and
+    nb_errors count the documents of the whole file (the runs before the resumed line, resumed_nb_successes and
+    resumed_nb_errors, and this run).
+
+    The checkpoints are saved in INGESTION_CHECKPOINT_PATH every INGESTION_CHECKPOINT_INTERVAL_SECONDS and when the
+    file is complete, and removed when the file is recorded in the index of the ingested files.
+    """
+
+    def __init__(self, relative_file_path: str, file_size: int, file_mtime: float, line: int = 0,
+                 nb_successes: int = 0, nb_errors: int = 0, complete: bool = False):
+        """
+        :param relative_file_path: The path of the file relative to the dataset (see get_dataset_relative_file_path).
+        :param file_size: The size of the file in bytes, the checkpoint is ignored if the file changed.
+        :param file_mtime: The modification time of the file, the checkpoint is ignored if the file changed.
+        :param line: The number of lines acknowledged from the beginning of the file.
+        :param nb_successes: The number of documents of the lines before the checkpoint which were indexed.
+        :param nb_errors: The number of documents of the lines before the checkpoint which failed to be indexed.
+        :param complete: Whether all the lines of the file were acknowledged.
+        """
+        self.relative_file_path = relative_file_path
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.start_line = line
+        self.resumed_nb_successes = nb_successes
+        self.resumed_nb_errors = nb_errors
+        self.complete = complete
+        # next line read from the file
+        self._next_line = line
+        # _id -> lines of the documents sent and not yet acknowledged
+        self._pending = {}
+        # the acknowledged documents of the lines before the last saved checkpoint are counted, the other ones are
+        # kept by line (line -> ok) until they are before the checkpoint
+        self._nb_successes_before_line = nb_successes
+        self._nb_errors_before_line = nb_errors
+        self._acknowledged = {}
+        self._last_save = time.monotonic()
+
+    @property
+    def nb_successes(self) -> int:
+        """
+        :return: The number of documents of the file indexed, by the previous runs and this one.
+        """
+        return self._nb_successes_before_line + sum(self._acknowledged.values())
+
+    @property
+    def nb_errors(self) -> int:
+        """
+        :return: The number of documents of the file which failed to be indexed, by the previous runs and this one.
+        """
+        return self._nb_errors_before_line + len(self._acknowledged) - sum(self._acknowledged.values())
+
+    @classmethod
+    def load(cls, relative_file_path: str, file_size: int, file_mtime: float):
+        """
+        Read the checkpoint of a file.
+        :return: The checkpoint, starting from the beginning of the file if there is no checkpoint for this version of
+        the file.
+        """
+        checkpoint_path = _get_checkpoint_path(relative_file_path)
+        if config.ingestion_checkpoint_path and os.path.exists(checkpoint_path):
+            try:
+                with open(checkpoint_path) as f:
+                    state = json.load(f)
+                if state['file_size'] == file_size and state['file_mtime'] == file_mtime:
+                    log.info(f"Resuming {relative_file_path} from line {state['line']}")
+                    return cls(relative_file_path, file_size, file_mtime, state['line'], state['nb_successes'],
+                               state['nb_errors'], state['complete'])
+                log.info(f"{relative_file_path} changed since its checkpoint, ingesting it from the beginning")
+            except (OSError, ValueError, KeyError) as e:
+                log.warning(f"Ignoring the invalid checkpoint {checkpoint_path}: {e}")
+        return cls(relative_file_path, file_size, file_mtime)
+
+    def add(self, line: int, _id: str = None):
+        """
+        Add a line read from the file.
+        :param line: The number of the line, from 0.
+        :param _id: The _id of the document of the line, None if the line is ignored (acknowledged immediately).
+        """
+        self._next_line = line + 1
+        if _id is not None:
+            self._pending.setdefault(_id, []).append(line)
+
+    def ack(self, _id: str, ok: bool):
+        """
+        Acknowledge a document indexed (or failed to be indexed) by the bulk API, and save the checkpoint if
+        INGESTION_CHECKPOINT_INTERVAL_SECONDS elapsed since the last save.
+        """
+        lines = self._pending.get(_id)
+        if lines is not None:
+            self._acknowledged[lines.pop(0)] = ok
+            if len(lines) == 0:
+                del self._pending[_id]
+        else:
+            # unknown document, counted as before the checkpoint
+            self._nb_successes_before_line += ok
+            self._nb_errors_before_line += not ok
+        if time.monotonic() - self._last_save >= config.ingestion_checkpoint_interval:
+            self.save()
+
+    def get_line(self) -> int:
+        """
+        :return: The number of lines acknowledged from the beginning of the file.
+        """
+        if len(self._pending) == 0:
+            return self._next_line
+        return min(min(lines) for lines in self._pending.values())
+
+    def save(self, complete: bool = False):
+        """
+        Write the checkpoint in INGESTION_CHECKPOINT_PATH.
+        :param complete: Whether all the lines of the file were acknowledged.
+        """
+        self._last_save = time.monotonic()
+        line = self.get_line()
+        for acknowledged_line in [acknowledged_line for acknowledged_line in self._acknowledged
+                                  if acknowledged_line < line]:
+            ok = self._acknowledged.pop(acknowledged_line)
+            self._nb_successes_before_line += ok
+            self._nb_errors_before_line += not ok
+        if not config.ingestion_checkpoint_path:
+            return
+        self.complete = complete
+        os.makedirs(config.ingestion_checkpoint_path, exist_ok=True)
+        checkpoint_path = _get_checkpoint_path(self.relative_file_path)
+        # the previous checkpoint is replaced atomically, a crash while writing doesn't corrupt it
+        with open(checkpoint_path + ".tmp", "w") as f:
+            json.dump({
+                'file': self.relative_file_path,
+                'file_size': self.file_size,
+                'file_mtime': self.file_mtime,
+                'line': line,
+                'nb_successes': self._nb_successes_before_line,
+                'nb_errors': self._nb_errors_before_line,
+                'complete': complete,
+            }, f)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def remove_checkpoint(relative_file_path: str):
+    """
+    Remove the checkpoint of a file, once the file is recorded in the index of the ingested files.
+    """
+    if not config.ingestion_checkpoint_path:
+        return
+    try:
+        os.remove(_get_checkpoint_path(relative_file_path))
+    except FileNotFoundError:
+        pass
+
+
+def remove_all_checkpoints():
+    """
+    Remove the checkpoints of all the files (e.g. when the index of the ingested files is reset).
+    """
+    if config.ingestion_checkpoint_path and os.path.isdir(config.ingestion_checkpoint_path):
+        shutil.rmtree(config.ingestion_checkpoint_path)
+        log.info(f"Removed the ingestion checkpoints in {config.ingestion_checkpoint_path}.")
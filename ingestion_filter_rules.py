@@ -0,0 +1,183 @@
+"""
+Declarative filters of the ingestion (INGESTION_FILTER_RULES_PATH, see ingestion_filter_rules_template.json): for each
+entity, predicates on the fields of the raw OpenAlex documents (before format_entity_data), combined with "all", "any"
+and "not". For example, to keep the English articles published since 2015:
+
+{"works": {"all": [{"field": "publication_year", "gte": 2015}, {"field": "type", "in": ["article"]},
+                   {"field": "language", "eq": "en"}]}}
+
+The operators of a predicate are eq, ne, in, not_in, gt, gte, lt, lte and exists (true or false). The fields are dotted
+paths (e.g. primary_topic.domain.id), a predicate on a list (e.g. topics.id) matches if one of its values matches (ne and
+not_in if none of its values is excluded), like the queries of Elasticsearch.
+
+The rules are compiled once and evaluated on the raw lines first: the value of a field whose top-level key appears once
+in the line is decoded alone, without parsing the document, so most of the dropped documents are neither parsed nor
+formatted nor embedded. The documents which can't be decided from the raw line (e.g. the key "type" also appears in the
+nested objects) are evaluated once parsed. The Python filter (INGESTION_FILTER_FILE_PATH) is applied after the rules.
+"""
+import json
+import re
+
+import config
+from log_config import log
+
+OPERATORS = ["eq", "ne", "in", "not_in", "gt", "gte", "lt", "lte", "exists"]
+# a JSON scalar at the start of the value of a key
+_SCALAR_PATTERN = re.compile(rb'\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|null|true|false|"(?:[^"\\]|\\.)*")')
+_DECODER = json.JSONDecoder()
+# value of a field which can't be decoded from the raw line
+_UNKNOWN = object()
+
+
+def _get_values(value, path: tuple[str, ...]) -> list:
+    """
+    :return: The values of a dotted path in a document, the lists are flattened and the None values are removed.
+    """
+    if isinstance(value, list):
+        return [leaf for item in value for leaf in _get_values(item, path)]
+    if len(path) == 0:
+        return [] if value is None else [value]
+    if not isinstance(value, dict):
+        return []
+    return _get_values(value.get(path[0]), path[1:])
+
+
+def _compile_predicate(rule: dict):
+    """
+    :return: The function testing the values of the field of a predicate.
+    """
+    operators = [operator for operator in rule if operator != "field"]
+    if len(operators) != 1 or operators[0] not in OPERATORS:
+        raise ValueError(f"A predicate must have a field and one operator of {OPERATORS}: {rule}")
+    operator = operators[0]
+    operand = rule[operator]
+    if operator == "eq":
+        return lambda values: operand in values
+    if operator == "ne":
+        return lambda values: operand not in values
+    if operator in ("in", "not_in"):
+        operand = frozenset(operand)
+        if operator == "in":
+            return lambda values: any(value in operand for value in values)
+        return lambda values: not any(value in operand for value in values)
+    if operator == "exists":
+        return lambda values: (len(values) > 0) == operand
+    compare = {
+        "gt": lambda value: value > operand,
+        "gte": lambda value: value >= operand,
+        "lt": lambda value: value < operand,
+        "lte": lambda value: value <= operand,
+    }[operator]
+    return lambda values: any(compare(value) for value in values
+                              if isinstance(value, (int, float)) and not isinstance(value, bool))
+
+
+def _compile(rule: dict) -> tuple:
+    """
+    Compile a rule to a tree of ("all" | "any", children), ("not", child) and ("field", path, key, predicate) nodes.
+    """
+    if "all" in rule or "any" in rule:
+        operator = "all" if "all" in rule else "any"
+        return operator, [_compile(child) for child in rule[operator]]
+    if "not" in rule:
+        return "not", _compile(rule["not"])
+    if "field" not in rule:
+        raise ValueError(f"Unknown filter rule: {rule}")
+    path = tuple(rule["field"].split("."))
+    return "field", path, f'"{path[0]}":'.encode(), _compile_predicate(rule)
+
+
+def _decode_raw_value(line: bytes, key: bytes, path: tuple[str, ...]):
+    """
+    :return: The values of the field in the raw line, _UNKNOWN if its top-level key doesn't appear exactly once (e.g.
+    it is also the key of nested objects). A key appearing once is the top-level one, as the OpenAlex documents have all
+    their top-level keys (null if there is no value).
+    """
+    nb_keys = line.count(key)
+    if nb_keys == 0:
+        return []
+    if nb_keys > 1:
+        return _UNKNOWN
+    start = line.find(key) + len(key)
+    match = _SCALAR_PATTERN.match(line, start)
+    try:
+        if match is not None:
+            value = json.loads(match.group(1))
+        else:
+            # an object or a list, decoded until its end
+            text = line[start:].decode()
+            value = _DECODER.raw_decode(text, len(text) - len(text.lstrip()))[0]
+    except ValueError:
+        return _UNKNOWN
+    return _get_values(value, path[1:])
+
+
+class FilterRules:
+    """
+    The compiled rules of an entity.
+    """
+
+    def __init__(self, rule: dict):
+        self._root = _compile(rule)
+
+    def _evaluate_line(self, node: tuple, line: bytes, raw_values: dict):
+        if node[0] == "field":
+            _, path, key, predicate = node
+            # the values are decoded once per field
+            if path not in raw_values:
+                raw_values[path] = _decode_raw_value(line, key, path)
+            values = raw_values[path]
+            return None if values is _UNKNOWN else predicate(values)
+        if node[0] == "not":
+            result = self._evaluate_line(node[1], line, raw_values)
+            return None if result is None else not result
+        # "all" is decided by a False child, "any" by a True child
+        deciding_result = node[0] == "any"
+        undecided = False
+        for child in node[1]:
+            result = self._evaluate_line(child, line, raw_values)
+            if result is deciding_result:
+                return result
+            undecided = undecided or result is None
+        return None if undecided else not deciding_result
+
+    def match_line(self, line: bytes) -> bool | None:
+        """
+        Evaluate the rules on a raw line, without parsing the document.
+        :return: Whether the document is kept, None if it can't be decided without parsing it (see match_document).
+        """
+        return self._evaluate_line(self._root, line, {})
+
+    def _evaluate_document(self, node: tuple, doc: dict) -> bool:
+        if node[0] == "field":
+            return node[3](_get_values(doc, node[1]))
+        if node[0] == "not":
+            return not self._evaluate_document(node[1], doc)
+        if node[0] == "all":
+            return all(self._evaluate_document(child, doc) for child in node[1])
+        return any(self._evaluate_document(child, doc) for child in node[1])
+
+    def match_document(self, doc: dict) -> bool:
+        """
+        Evaluate the rules on a parsed raw document.
+        :return: Whether the document is kept.
+        """
+        return self._evaluate_document(self._root, doc)
+
+
+_rules = None
+
+
+def get_filter_rules(entity: str, rules_path: str = config.ingestion_filter_rules_path) -> FilterRules | None:
+    """
+    :return: The compiled rules of an entity (read and compiled on the first call), None if there are no rules for the
+    entity.
+    """
+    global _rules
+    if _rules is None:
+        _rules = {}
+        if rules_path:
+            with open(rules_path) as f:
+                _rules = {entity: FilterRules(rule) for entity, rule in json.load(f).items()}
+            log.info(f"Loaded the ingestion filter rules of {', '.join(_rules) or 'no entity'} from {rules_path}.")
+    return _rules.get(entity)
@@ -0,0 +1,227 @@
+import bisect
+import copy
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from log_config import log
+
+# upper bounds in seconds of the buckets of the latency histograms (the last bucket is unbounded)
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+METRICS_PREFIX = "openalex_ingestion"
+
+
+class IngestionMetrics:
+    """
+    Timings and counters of the stages of the ingestion (decompression, parsing, formatting, filter, embedding, bulk).
+
+    Each ingestion process collects the metrics of a file in its own instance, which is saved with the record of the
+    file (to_dict). Its increments are pushed periodically to the instance of the parent process (see push_metrics and
+    MetricsCollector), exposed in the Prometheus text format (to_prometheus, start_metrics_server).
+    """
+
+    def __init__(self):
+        # stage -> {'seconds': wall time, 'docs': number of documents, 'bytes': number of bytes}
+        self.stages = {}
+        self.counters = Counter()
+        # name -> counts per bucket of LATENCY_BUCKETS (+ the unbounded one), plus their sum
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float, docs: int = 0, nb_bytes: int = 0):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {'seconds': 0., 'docs': 0, 'bytes': 0})
+            totals['seconds'] += seconds
+            totals['docs'] += docs
+            totals['bytes'] += nb_bytes
+
+    @contextmanager
+    def time_stage(self, stage: str, docs: int = 0, nb_bytes: int = 0):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, time.perf_counter() - started, docs, nb_bytes)
+
+    def increment(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def observe(self, histogram: str, value: float):
+        with self._lock:
+            counts = self.histograms.setdefault(histogram, {'counts': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.})
+            counts['counts'][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            counts['sum'] += value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'stages': {stage: dict(totals) for stage, totals in self.stages.items()},
+                'counters': dict(self.counters),
+                'histograms': {name: {'buckets': LATENCY_BUCKETS, 'counts': list(histogram['counts']),
+                                      'sum': histogram['sum']}
+                               for name, histogram in self.histograms.items()},
+            }
+
+    def merge(self, metrics: dict):
+        """
+        Add metrics of another instance.
+        :param metrics: The metrics, as returned by to_dict.
+        """
+        for stage, totals in metrics.get('stages', {}).items():
+            self.add_stage(stage, totals['seconds'], totals['docs'], totals['bytes'])
+        with self._lock:
+            self.counters.update(metrics.get('counters', {}))
+            for name, histogram in metrics.get('histograms', {}).items():
+                counts = self.histograms.setdefault(name, {'counts': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.})
+                counts['counts'] = [a + b for a, b in zip(counts['counts'], histogram['counts'])]
+                counts['sum'] += histogram['sum']
+
+    def get_delta(self, previous: dict) -> tuple[dict, dict]:
+        """
+        :param previous: Metrics of this instance returned by to_dict (or get_delta) earlier.
+        :return: The current metrics (like to_dict) and the metrics added since previous, in the format of to_dict.
+        """
+        current = self.to_dict()
+        delta = copy.deepcopy(current)
+        for stage, totals in delta['stages'].items():
+            previous_totals = previous['stages'].get(stage, {})
+            for field in totals:
+                totals[field] -= previous_totals.get(field, 0)
+        for counter in delta['counters']:
+            delta['counters'][counter] -= previous['counters'].get(counter, 0)
+        for name, histogram in delta['histograms'].items():
+            previous_histogram = previous['histograms'].get(name)
+            if previous_histogram is not None:
+                histogram['counts'] = [a - b for a, b in zip(histogram['counts'], previous_histogram['counts'])]
+                histogram['sum'] -= previous_histogram['sum']
+        return current, delta
+
+    def to_prometheus(self) -> str:
+        metrics = self.to_dict()
+        lines = []
+        for field in ('seconds', 'docs', 'bytes'):
+            name = f"{METRICS_PREFIX}_stage_{field}_total"
+            lines.append(f"# TYPE {name} counter")
+            for stage, totals in metrics['stages'].items():
+                lines.append(f'{name}{{stage="{stage}"}} {totals[field]}')
+        for counter, value in metrics['counters'].items():
+            name = f"{METRICS_PREFIX}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for histogram_name, histogram in metrics['histograms'].items():
+            name = f"{METRICS_PREFIX}_{histogram_name}"
+            lines.append(f"# TYPE {name} histogram")
+            cumulative_count = 0
+            for bucket, count in zip(LATENCY_BUCKETS + ["+Inf"], histogram['counts']):
+                cumulative_count += count
+                lines.append(f'{name}_bucket{{le="{bucket}"}} {cumulative_count}')
+            lines.append(f"{name}_sum {histogram['sum']}")
+            lines.append(f"{name}_count {cumulative_count}")
+        return "\n".join(lines) + "\n"
+
+
+# queue of the metrics pushed by the ingestion processes, inherited when they are forked (see MetricsCollector)
+_metrics_queue = None
+
+
+class MetricsCollector:
+    """
+    Merge in the metrics of the parent process the increments pushed by the ingestion processes (see push_metrics)
+    through a queue, in a background thread. The collector must be started before the ingestion processes are forked.
+    """
+
+    def __init__(self, metrics: IngestionMetrics):
+        self.metrics = metrics
+        self._queue = None
+        self._thread = None
+
+    def _collect(self):
+        while True:
+            delta = self._queue.get()
+            if delta is None:
+                break
+            self.metrics.merge(delta)
+
+    def start(self):
+        global _metrics_queue
+        self._queue = _metrics_queue = multiprocessing.Queue()
+        self._thread = threading.Thread(target=self._collect, name="metrics-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Merge the remaining increments, once the ingestion processes exited.
+        """
+        global _metrics_queue
+        _metrics_queue = None
+        self._queue.put(None)
+        self._thread.join()
+        self._queue.close()
+
+
+@contextmanager
+def push_metrics(metrics: IngestionMetrics, interval: float = config.metrics_push_interval):
+    """
+    Push the increments of the metrics to the collector of the parent process every interval seconds, and when the
+    context exits. Nothing is pushed if there is no collector (e.g. a file ingested alone).
+    """
+    queue = _metrics_queue
+    if queue is None:
+        yield
+        return
+    previous = IngestionMetrics().to_dict()
+    stopped = threading.Event()
+
+    def push():
+        nonlocal previous
+        previous, delta = metrics.get_delta(previous)
+        queue.put(delta)
+
+    def push_periodically():
+        while not stopped.wait(interval):
+            push()
+
+    thread = threading.Thread(target=push_periodically, name="metrics-push", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+        push()
+
+
+def start_metrics_server(metrics: IngestionMetrics, host: str, port: int) -> ThreadingHTTPServer | None:
+    """
+    Serve the metrics in the Prometheus text format on http://host:port/metrics, in a background thread.
+    :return: The server, to shut it down, None if the port can't be bound (the ingestion continues without it).
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            content = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log.warning(f"Can't serve the ingestion metrics on http://{host}:{port}/metrics: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    log.info(f"Serving the ingestion metrics on http://{host}:{port}/metrics")
+    return server
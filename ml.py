@@ -1,27 +1,131 @@
 import os
-from sentence_transformers import SentenceTransformer
-import torch
+import threading
+from typing import TYPE_CHECKING
+
 from dotenv import load_dotenv
 from log_config import log
 
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
 load_dotenv()  # take environment variables from .env.
 
 text_encoding_model_name = os.getenv('TEXT_ENCODING_MODEL_NAME')
 text_encoding_torch_dtype = os.getenv('TEXT_ENCODING_TORCH_DTYPE')
-# Load or create a SentenceTransformer model.
-model = SentenceTransformer(text_encoding_model_name, model_kwargs={"torch_dtype": text_encoding_torch_dtype})
+# 'torch', 'int8' (dynamic int8 quantization of the linear layers, CPU), 'onnx' or 'openvino' (exported optimized
+# graphs, CPU, need sentence-transformers[onnx] or sentence-transformers[openvino])
+text_encoding_engine = os.getenv('TEXT_ENCODING_ENGINE', "torch")
+# number of threads used by torch on CPU, 0 to keep the default
+text_encoding_num_threads = int(os.getenv('TEXT_ENCODING_NUM_THREADS', 0))
+text_encoding_batch_size = int(os.getenv('TEXT_ENCODING_BATCH_SIZE', 32))
+# file of the ONNX/OpenVINO model to load (e.g. onnx/model_qint8_avx512_vnni.onnx), the default one if not set
+text_encoding_model_file_name = os.getenv('TEXT_ENCODING_MODEL_FILE_NAME')
+
+ENGINES = ["torch", "int8", "onnx", "openvino"]
+
+
+def get_effective_torch_dtype(engine: str = text_encoding_engine, torch_dtype: str = text_encoding_torch_dtype) -> str:
+    """
+    :return: The dtype the model is run with: the half precision dtypes fall back to float32 without GPU, the other
+    engines than 'torch' run in float32 (int8 only quantizes the weights of the linear layers).
+    """
+    if engine != "torch":
+        return "float32"
+    if torch_dtype in ("float16", "bfloat16"):
+        try:
+            import torch
+        except ImportError:
+            # the model can't be loaded on this host
+            return torch_dtype
+        if not torch.cuda.is_available():
+            return "float32"
+    return str(torch_dtype)
+
+
+def get_model_key(
+        engine: str = text_encoding_engine,
+        torch_dtype: str = text_encoding_torch_dtype,
+        model_file_name: str = text_encoding_model_file_name
+    ) -> str:
+    """
+    :return: The key of the model and of its configuration creating the embeddings (model, engine, file of the
+    ONNX/OpenVINO model and effective dtype), e.g. to key the cached embeddings (see embedding_cache.py).
+    """
+    model_file_name = model_file_name if engine in ("onnx", "openvino") and model_file_name else "default"
+    return f"{text_encoding_model_name}:{engine}:{model_file_name}:{get_effective_torch_dtype(engine, torch_dtype)}"
+
+
+def load_model(
+        engine: str = text_encoding_engine,
+        torch_dtype: str = text_encoding_torch_dtype,
+        num_threads: int = text_encoding_num_threads
+    ) -> "SentenceTransformer":
+    """
+    Load the model (TEXT_ENCODING_MODEL_NAME) with an inference engine. torch and sentence_transformers are imported
+    on the first load.
+    :param engine: One of ENGINES.
+    :param torch_dtype: The dtype of the weights for the 'torch' engine.
+    :param num_threads: Number of threads used by torch on CPU, 0 to keep the default.
+    :return: The model.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if engine == "torch":
+        effective_torch_dtype = get_effective_torch_dtype(engine, torch_dtype)
+        if effective_torch_dtype != torch_dtype:
+            # the half precision matmuls are slow or emulated on most CPUs
+            log.warning(f"No GPU available, loading the model in float32 instead of {torch_dtype}")
+            torch_dtype = effective_torch_dtype
+        model = SentenceTransformer(text_encoding_model_name, model_kwargs={"torch_dtype": torch_dtype})
+        if torch.cuda.is_available():
+            model = model.to(torch.device("cuda"))
+    elif engine == "int8":
+        model = SentenceTransformer(text_encoding_model_name, device="cpu", model_kwargs={"torch_dtype": "float32"})
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif engine in ("onnx", "openvino"):
+        model_kwargs = {}
+        if text_encoding_model_file_name:
+            model_kwargs["file_name"] = text_encoding_model_file_name
+        model = SentenceTransformer(text_encoding_model_name, device="cpu", backend=engine, model_kwargs=model_kwargs)
+    else:
+        raise ValueError(f"Unknown inference engine '{engine}', must be one of {ENGINES}")
+    log.debug(f"Loaded {text_encoding_model_name} with the engine {engine} on {model.device}")
+    return model
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model() -> "SentenceTransformer":
+    """
+    Get the model, loaded on the first call (e.g. by the warm-up of the API), so that importing this module is fast.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_model()
+    return _model
+
+
+def __getattr__(name: str):
+    # ml.model is loaded on its first access
+    if name == "model":
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-if torch.cuda.is_available():
-    model = model.to(torch.device("cuda"))
-log.debug(model.device)
 
 def encode_text_document(document):
     """
-    Infer a document or a list of documents.
+    Infer a document or a list of documents. The documents are sorted by length and encoded in batches of
+    TEXT_ENCODING_BATCH_SIZE documents (by SentenceTransformer.encode).
     :param document: str | list[str]
     :return: str | list[str]
     """
-    embedding = model.encode(document, show_progress_bar=False)
+    embedding = get_model().encode(document, batch_size=text_encoding_batch_size, show_progress_bar=False)
     # log.debug(f"Vector dimension: {len(embedding)}")
     # print(document)
-    return embedding
\ No newline at end of file
+    return embedding
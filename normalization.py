@@ -0,0 +1,125 @@
+from collections import Counter
+
+from log_config import log
+
+
+def _sort_abstract(inv_index):
+    l_inv = [(w, p) for w, pos in inv_index.items() for p in pos]
+    return " ".join(map(lambda x: x[0], sorted(l_inv, key=lambda x: x[1])))
+
+
+def invert_abstract(inv_index):
+    """
+    Rebuild an abstract from its inverted index (word -> positions).
+    :param inv_index: The inverted index of the abstract (abstract_inverted_index in OpenAlex), can be None.
+    :return: The abstract, None if inv_index is None.
+    """
+    if inv_index is None:
+        return None
+    # the positions are usually dense unique integers, each word is then put directly in its slot, else (gaps,
+    # duplicated or negative positions) the words are sorted by position
+    nb_words = sum(map(len, inv_index.values()))
+    words = [None] * nb_words
+    try:
+        for word, positions in inv_index.items():
+            for position in positions:
+                if position < 0 or position >= nb_words or words[position] is not None:
+                    return _sort_abstract(inv_index)
+                words[position] = word
+    except TypeError:
+        # positions which are not integers
+        return _sort_abstract(inv_index)
+    # all the slots are filled, as the positions are unique and in range
+    return " ".join(words)
+
+
+def _float_fixer(field, sub_field):
+    def fix(data, fixes):
+        if field in data and sub_field in data[field]:
+            data[field][sub_field] = float(data[field][sub_field])
+    return fix
+
+
+def _abstract_fixer(data, fixes):
+    data['abstract'] = invert_abstract(data['abstract_inverted_index'])
+    del data['abstract_inverted_index']
+
+
+def _topic_ids_fixer(field, prefixes):
+    """
+    Fix the ids of the subfield, field and domain of the topics written as integers instead of strings in the OpenAlex
+    dataset.
+    :param field: 'topics' (list of topics) or 'primary_topic'.
+    :param prefixes: List of (sub field, prefix added to the integer id).
+    """
+    def fix_topic(topic, fixes):
+        for sub_field, prefix in prefixes:
+            value = topic.get(sub_field)
+            if value is not None and type(value['id']) is not str:
+                value['id'] = prefix + str(value['id'])
+                fixes[f"{field}.{sub_field}.id"] += 1
+
+    if field == "topics":
+        def fix(data, fixes):
+            topics = data.get('topics')
+            if topics is not None:
+                for topic in topics:
+                    fix_topic(topic, fixes)
+    else:
+        def fix(data, fixes):
+            topic = data.get(field)
+            if topic is not None:
+                fix_topic(topic, fixes)
+    return fix
+
+
+# entity -> functions fixing the format of a document of the entity, applied in order
+ENTITY_FIXERS = {
+    # needed to avoid the error: BadRequestError(400, 'illegal_argument_exception', 'mapper
+    # [summary_stats.2yr_mean_citedness] cannot be changed from type [long] to [float]')
+    "authors": [
+        _float_fixer('summary_stats', '2yr_mean_citedness'),
+    ],
+    "concepts": [
+        _float_fixer('summary_stats', '2yr_mean_citedness'),
+        _float_fixer('summary_stats', 'oa_percent'),
+    ],
+    "works": [
+        _abstract_fixer,
+        # fix errors in OpenAlex dataset
+        _topic_ids_fixer('topics', [
+            ('subfield', "https://openalex.org/subfield/"),
+            ('field', "https://openalex.org/field/"),
+            ('domain', "https://openalex.org/domains/"),
+        ]),
+        _topic_ids_fixer('primary_topic', [
+            ('subfield', "https://openalex.org/subfield/"),
+            ('field', "https://openalex.org/field/"),
+            ('domain', "https://openalex.org/domain/"),
+        ]),
+        # the embeddings are computed and added later
+    ],
+}
+
+
+def format_entity_data(entity, data, fixes: Counter = None):
+    """
+    Format a document of the OpenAlex dataset before its ingestion (abstract rebuilt, errors of the dataset fixed...).
+    :param entity: The entity of the document (works, authors...).
+    :param data: The document, modified in place.
+    :param fixes: Counter of the fixes applied (e.g. 'topics.field.id'), to report them once per file.
+    :return: The formatted document.
+    """
+    if fixes is None:
+        fixes = Counter()
+    for fixer in ENTITY_FIXERS.get(entity, ()):
+        fixer(data, fixes)
+    return data
+
+
+def log_fixes(fixes: Counter, file_path: str):
+    """
+    Log the fixes counted by format_entity_data for a file.
+    """
+    for fix, count in fixes.items():
+        log.warning(f"Fixed the format of {fix} from int to str in {count} documents of {file_path}")
@@ -1,60 +1,162 @@
-#from cuml.manifold import UMAP # for NVIDIA GPU, needs CUDA drivers with CUDA capability 7.0 (RTX 20xx) or newer
-from umap import UMAP
-from elasticsearch.helpers import streaming_bulk
-from rich.progress import Progress
+"""
+Project the embeddings of the abstracts of the works in 2D (abstract_embeddings_2d) with UMAP.
+
+The embeddings are exported with export.py (float32 memory-mapped matrix), the projection is fitted on a random sample
+of REDUCE_SAMPLE_SIZE embeddings and saved (REDUCE_MODEL_PATH), then all the embeddings are projected in batches of
+REDUCE_BATCH_SIZE and written back with parallel bulk updates. With --incremental, only the works without
+abstract_embeddings_2d (e.g. added since the last run) are projected, with the saved projection.
+
+python reduce_dimensionality_of_index.py [--index works] [--incremental] [--sample-size 1000000]
+"""
+import argparse
+import os
+from typing import TYPE_CHECKING
+
+import numpy as np
 
-from config import client
 import config
+from export import export_index, read_export
 from log_config import log
-from utils import get_full_index
 
-index = "works"
+if TYPE_CHECKING:
+    from umap import UMAP
 
-# get the embeddings from ElasticSearch
-df = get_full_index(index=index, fields_to_export=['id', 'abstract_embeddings'])
-df = df.dropna()
-embeddings = df['abstract_embeddings'].to_list()
-log.info(f"Number of embeddings for the dimensionality reduction: {len(embeddings)}")
+EMBEDDINGS_FIELD = "abstract_embeddings"
+PROJECTION_FIELD = "abstract_embeddings_2d"
 
-# Reduce the dimensionality of the embeddings
-log.info("Starting dimensionality reduction...")
-umap_model = UMAP(n_components=2, n_neighbors=15, random_state=42, metric="cosine", verbose=True)
-reduced_embeddings_2d = umap_model.fit_transform(embeddings)
-log.info("Finished dimensionality reduction.")
 
-log.info("Saving abstract_embeddings_2d to ElasticSearch...")
-df['abstract_embeddings_2d'] = reduced_embeddings_2d.tolist()
-# keep only id and abstract_embeddings_2d for ingestion into ElasticSearch
-df = df[['id', 'abstract_embeddings_2d']]
+def get_valid_rows(embeddings: np.ndarray, batch_size: int = config.reduce_batch_size) -> np.ndarray:
+    """
+    :param embeddings: The exported embeddings, NaN for the documents without embedding.
+    :return: The indices of the rows with an embedding, read in batches.
+    """
+    return np.concatenate([start + np.flatnonzero(~np.isnan(embeddings[start:start + batch_size]).any(axis=1))
+                           for start in range(0, len(embeddings), batch_size)] + [np.empty(0, dtype=np.int64)])
 
-def yield_data():
-    with Progress(expand=True) as progress:
-        task = progress.add_task(f"Ingesting abstract_embeddings_2d...", total=len(df.index))
-        for row in df.to_dict(orient="records"):
-            progress.update(task, advance=1)
+
+def fit_projection(embeddings: np.ndarray, rows: np.ndarray, sample_size: int = config.reduce_sample_size,
+                   seed: int = 42) -> "UMAP":
+    """
+    Fit the 2D projection on a random sample of the embeddings.
+    :param embeddings: The embeddings (memory-mapped matrix).
+    :param rows: The rows of the embeddings to sample from.
+    :param sample_size: The number of embeddings of the sample.
+    :param seed: The seed of the sample and of UMAP.
+    :return: The fitted projection.
+    """
+    # import here, umap (numba) is slow to import
+    #from cuml.manifold import UMAP # for NVIDIA GPU, needs CUDA drivers with CUDA capability 7.0 (RTX 20xx) or newer
+    from umap import UMAP
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(rows, size=min(sample_size, len(rows)), replace=False))
+    log.info(f"Fitting the projection on {len(sample_rows)} embeddings out of {len(rows)}...")
+    umap_model = UMAP(n_components=2, n_neighbors=15, random_state=seed, metric="cosine", verbose=True)
+    umap_model.fit(np.asarray(embeddings[sample_rows]))
+    log.info("Finished fitting the projection.")
+    return umap_model
+
+
+def yield_projection_updates(umap_model: "UMAP", indexes, ids, embeddings: np.ndarray, rows: np.ndarray,
+                             batch_size: int = config.reduce_batch_size):
+    """
+    Project the embeddings in batches and yield the bulk updates of the projections.
+    :param umap_model: The fitted projection.
+    :param indexes: The concrete indexes of the rows of the embeddings (e.g. the partitions of the works).
+    :param ids: The _ids of the rows of the embeddings.
+    :param embeddings: The embeddings (memory-mapped matrix).
+    :param rows: The rows of the embeddings to project.
+    :param batch_size: The number of embeddings projected at once.
+    """
+    for start in range(0, len(rows), batch_size):
+        batch_rows = rows[start:start + batch_size]
+        projections = umap_model.transform(np.asarray(embeddings[batch_rows]))
+        for row, projection in zip(batch_rows, projections.tolist()):
             yield {
-                "_index": index,
-                "_id":row['id'][21:],
-                # "_type": "doc",
-                "_source": {'doc': row},
-                "_op_type": "update"
+                "_op_type": "update",
+                "_index": indexes[row],
+                "_id": ids[row],
+                "doc": {PROJECTION_FIELD: projection},
             }
 
-successes = 0
-errors = 0
-for status_ok, response in streaming_bulk(
-    client=client,
-    actions=yield_data(),
-    raise_on_error=False,
-    raise_on_exception=False,
-    # max_retries=5,
-    chunk_size=config.ingestion_chunk_size,
-    # request_timeout=config.ingestion_request_timeout, # DeprecationWarning: Passing transport options in the API
-                                                        # method is deprecated. Use 'Elasticsearch.options()' instead.
-):
-    successes += status_ok
-    if not status_ok:
-        log.error(response)
-        errors += 1
-# warning : this doesn't display the number of failed document ingestion
-log.info(f"Successfully indexed {successes} {index} documents with {errors} errors.")
+
+def reduce_dimensionality_of_index(
+        index: str = "works",
+        incremental: bool = False,
+        refit: bool = False,
+        sample_size: int = config.reduce_sample_size,
+        batch_size: int = config.reduce_batch_size,
+        model_path: str = config.reduce_model_path,
+        nb_bulk_threads: int = config.reduce_nb_bulk_threads
+    ):
+    """
+    Project the embeddings of an index in 2D and write the projections back to the index.
+    :param index: The index (or alias) of the documents.
+    :param incremental: Only project the documents without a projection, with the saved projection (fitted if there
+    is no saved projection).
+    :param refit: Fit the projection again even if there is a saved one.
+    :param sample_size: The number of embeddings of the sample the projection is fitted on.
+    :param batch_size: The number of embeddings projected at once.
+    :param model_path: The file of the saved projection.
+    :param nb_bulk_threads: The number of threads sending the bulk updates.
+    """
+    # import here, the command line help doesn't need them (elasticsearch is slow to import)
+    import joblib
+    from elasticsearch.helpers import parallel_bulk
+    from rich.progress import Progress
+    query = {"bool": {"filter": [{"exists": {"field": EMBEDDINGS_FIELD}}]}}
+    if incremental:
+        query["bool"]["must_not"] = [{"exists": {"field": PROJECTION_FIELD}}]
+    # get the embeddings from Elasticsearch
+    output_path = os.path.join(config.export_path, f"{index}_{EMBEDDINGS_FIELD}")
+    export_index(index, output_path, ['id'], vector_fields=[EMBEDDINGS_FIELD], query=query)
+    table, vectors = read_export(output_path, columns=["_id", "_index"])
+    ids = table.column("_id").to_pylist()
+    indexes = table.column("_index").to_pylist()
+    embeddings = vectors[EMBEDDINGS_FIELD]
+    rows = get_valid_rows(embeddings, batch_size)
+    log.info(f"Number of embeddings to project: {len(rows)}")
+    if len(rows) == 0:
+        return
+
+    if incremental and not refit and os.path.exists(model_path):
+        log.info(f"Loading the projection from {model_path}...")
+        umap_model = joblib.load(model_path)
+    else:
+        umap_model = fit_projection(embeddings, rows, sample_size)
+        joblib.dump(umap_model, model_path)
+        log.info(f"Saved the projection to {model_path}.")
+
+    log.info(f"Saving {PROJECTION_FIELD} to Elasticsearch...")
+    successes = 0
+    errors = 0
+    with Progress(expand=True) as progress:
+        task = progress.add_task(f"Projecting and ingesting {PROJECTION_FIELD}...", total=len(rows))
+        for status_ok, response in parallel_bulk(
+            client=config.client.options(request_timeout=config.ingestion_request_timeout),
+            actions=yield_projection_updates(umap_model, indexes, ids, embeddings, rows, batch_size),
+            thread_count=nb_bulk_threads,
+            chunk_size=config.ingestion_chunk_size,
+            raise_on_error=False,
+            raise_on_exception=False,
+        ):
+            successes += status_ok
+            if not status_ok:
+                log.error(response)
+                errors += 1
+            progress.update(task, advance=1)
+    log.info(f"Successfully updated {successes} {index} documents with {errors} errors.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index", default="works")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"only project the documents without {PROJECTION_FIELD}, with the saved projection")
+    parser.add_argument("--refit", action="store_true", help="fit the projection again in incremental mode")
+    parser.add_argument("--sample-size", type=int, default=config.reduce_sample_size)
+    parser.add_argument("--batch-size", type=int, default=config.reduce_batch_size)
+    parser.add_argument("--model-path", default=config.reduce_model_path)
+    parser.add_argument("--nb-bulk-threads", type=int, default=config.reduce_nb_bulk_threads)
+    args = parser.parse_args()
+    reduce_dimensionality_of_index(args.index, args.incremental, args.refit, args.sample_size, args.batch_size,
+                                   args.model_path, args.nb_bulk_threads)
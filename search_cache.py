@@ -0,0 +1,124 @@
+import hashlib
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+import config
+
+
+def normalize_text(text: str, lowercase: bool = config.search_cache_lowercase) -> str:
+    """
+    Normalize the text of a search, so that near-identical texts share their embedding: unicode normalization (NFKC),
+    whitespaces collapsed and optionally lowercased (the default model is uncased).
+    """
+    text = " ".join(unicodedata.normalize("NFKC", text).split())
+    return text.lower() if lowercase else text
+
+
+def get_result_key(vector, k: int, num_candidates: int, filters: dict = None) -> tuple:
+    """
+    :return: The key of the results of a KNN search: hash of the float32 vector, k, num_candidates and the filters.
+    """
+    vector_hash = hashlib.blake2b(np.asarray(vector, dtype=np.float32).tobytes(), digest_size=16).digest()
+    return vector_hash, k, num_candidates, json.dumps(filters, sort_keys=True) if filters else None
+
+
+class LRUCache:
+    """
+    Cache of at most max_size entries, the least recently used entry is removed first. Used from the event loop of the
+    API, so it isn't thread-safe. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: The value of the key, None if it isn't in the cache.
+        """
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> dict:
+        nb_lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / nb_lookups if nb_lookups > 0 else None,
+        }
+
+
+class ResultCache(LRUCache):
+    """
+    LRU cache of the results of the searches, whose entries expire after ttl seconds. The cache is cleared when the
+    generation of the searched index changes (e.g. a refresh made new documents visible), checked at most every
+    check_interval seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: float, check_interval: float):
+        super().__init__(max_size)
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.generation = None
+        self.invalidations = 0
+        self._last_check = None
+
+    def get(self, key):
+        entry = super().get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            # counted as a miss
+            self.hits -= 1
+            self.misses += 1
+            return None
+        return value
+
+    def put(self, key, value):
+        super().put(key, (time.monotonic() + self.ttl, value))
+
+    async def check_generation(self, get_generation):
+        """
+        Clear the cache if the generation of the index changed since the last check.
+        :param get_generation: Coroutine function returning the generation of the index.
+        """
+        if self.max_size <= 0:
+            return
+        now = time.monotonic()
+        if self._last_check is not None and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        generation = await get_generation()
+        if self.generation is not None and generation != self.generation:
+            self.clear()
+            self.invalidations += 1
+        self.generation = generation
+
+    def get_stats(self) -> dict:
+        return dict(super().get_stats(), invalidations=self.invalidations, generation=self.generation)
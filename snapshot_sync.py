@@ -0,0 +1,250 @@
+import csv
+import gzip
+import json
+import os
+import re
+from datetime import datetime
+
+import config
+from ingested_files_ledger import IngestedFilesLedger
+from log_config import log
+
+# e.g. s3://openalex/data/works/updated_date=2024-06-01/part_000.gz
+_MANIFEST_URL_PATTERN = re.compile(r"updated_date=(\d{4}-\d{2}-\d{2})/([^/]+)$")
+# e.g. merged_ids/works/2024-06-01.csv.gz
+_MERGED_IDS_FILE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})\.csv\.gz$")
+
+
+def get_sync_state(entity: str) -> dict:
+    """
+    Read the high-water marks of an entity in the index of the sync state (config.sync_state_index).
+    :return: The state: 'updated_date', the last partition fully ingested, and 'merged_ids_date', the last merged ids
+    file applied. Empty if the entity was never synced.
+    """
+    # import here, elasticsearch is slow to import
+    from elasticsearch import NotFoundError
+    try:
+        return config.client.get(index=config.sync_state_index, id=entity)['_source']
+    except NotFoundError:
+        return {}
+
+
+def save_sync_state(entity: str, state: dict):
+    state = dict(state, entity=entity, synced_at=datetime.now())
+    config.client.index(index=config.sync_state_index, id=entity, document=state)
+
+
+def read_manifest(openalex_data_to_ingest_path: str, entity: str) -> list[tuple[str, str, int]]:
+    """
+    Read the manifest of an entity of the snapshot.
+    :param openalex_data_to_ingest_path: Path of the folder containing the folders of each entity.
+    :param entity: The entity, its folder name.
+    :return: The files of the manifest, (updated_date, local file path, size in bytes), None if the entity has no
+    manifest.
+    """
+    manifest_path = os.path.join(openalex_data_to_ingest_path, entity, "manifest")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    files = []
+    for entry in manifest['entries']:
+        match = _MANIFEST_URL_PATTERN.search(entry['url'])
+        if match is None:
+            log.warning(f"Unexpected file in the manifest of {entity}: {entry['url']}")
+            continue
+        updated_date, filename = match.groups()
+        file_path = os.path.join(openalex_data_to_ingest_path, entity, f"updated_date={updated_date}", filename)
+        files.append((updated_date, file_path, entry['meta']['content_length']))
+    return files
+
+
+def list_files_to_sync(
+        entities_to_ingest: list[str],
+        openalex_data_to_ingest_path: str,
+        ledger: IngestedFilesLedger
+    ) -> list[tuple[int, str, str]]:
+    """
+    List the files of the partitions (updated_date folders) at or after the high-water mark of each entity, from the
+    manifests of the snapshot, which are not already ingested. The partitions before the high-water mark are not read.
+    The entities without a manifest are listed like a full ingestion (see utils.list_files_to_ingest).
+    :param entities_to_ingest: List of the entities, the strings must correspond to their folder names.
+    :param openalex_data_to_ingest_path: Path of the folder containing the folders of each entity.
+    :param ledger: The ledger of the ingested files.
+    :return: A list of (size in bytes, entity, file path), sorted from the biggest to the smallest file.
+    """
+    # import here as utils imports this module
+    from utils import get_dataset_relative_file_path, list_files_to_ingest
+    files_to_ingest = []
+    for entity in entities_to_ingest:
+        manifest_files = read_manifest(openalex_data_to_ingest_path, entity)
+        if manifest_files is None:
+            log.warning(f"No manifest for {entity}, listing all its files.")
+            files_to_ingest.extend(list_files_to_ingest([entity], openalex_data_to_ingest_path, ledger))
+            continue
+        # the partition of the high-water mark is listed again, in case it was extended
+        high_water_mark = get_sync_state(entity).get('updated_date', "")
+        nb_new_partitions = len({updated_date for updated_date, _, _ in manifest_files
+                                 if updated_date > high_water_mark})
+        nb_files = 0
+        for updated_date, file_path, file_size in manifest_files:
+            if updated_date < high_water_mark:
+                continue
+            if ledger.is_ingested(str(get_dataset_relative_file_path(file_path)), file_size):
+                continue
+            if not os.path.exists(file_path):
+                log.warning(f"File of the manifest not downloaded: {file_path}")
+                continue
+            files_to_ingest.append((file_size, entity, file_path))
+            nb_files += 1
+        log.info(f"{nb_files} {entity} files to sync in {nb_new_partitions} new partitions (high-water mark: "
+                 f"{high_water_mark or 'none'}).")
+    files_to_ingest.sort(key=lambda f: f[0], reverse=True)
+    return files_to_ingest
+
+
+def update_high_water_marks(entities_to_ingest: list[str], openalex_data_to_ingest_path: str,
+                            ledger: IngestedFilesLedger):
+    """
+    Move the high-water mark of each entity to the last partition of its manifest whose files and the files of all the
+    previous partitions are ingested.
+    """
+    # import here as utils imports this module
+    from utils import get_dataset_relative_file_path
+    for entity in entities_to_ingest:
+        manifest_files = read_manifest(openalex_data_to_ingest_path, entity)
+        if manifest_files is None:
+            continue
+        state = get_sync_state(entity)
+        high_water_mark = state.get('updated_date', "")
+        partitions_ingested = {}
+        for updated_date, file_path, file_size in manifest_files:
+            if updated_date >= high_water_mark:
+                partitions_ingested[updated_date] = partitions_ingested.get(updated_date, True) and ledger.is_ingested(
+                    str(get_dataset_relative_file_path(file_path)), file_size)
+        new_high_water_mark = high_water_mark
+        for updated_date in sorted(partitions_ingested):
+            if not partitions_ingested[updated_date]:
+                break
+            new_high_water_mark = updated_date
+        if new_high_water_mark != high_water_mark:
+            save_sync_state(entity, dict(state, updated_date=new_high_water_mark))
+            log.info(f"High-water mark of {entity}: {high_water_mark or 'none'} -> {new_high_water_mark}")
+
+
+def _read_merged_ids(file_path: str, batch_size: int):
+    """
+    :return: The ids of a merged ids file, in batches.
+    """
+    batch = []
+    with gzip.open(file_path, 'rt', newline="") as f:
+        for row in csv.DictReader(f):
+            batch.append(row['id'])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _delete_merged_ids_bulk(entity: str, file_path: str) -> tuple[int, int, int]:
+    """
+    Delete the merged entities of a file with bulk delete actions.
+    :return: The number of deleted, not found and failed documents.
+    """
+    # import here, elasticsearch is slow to import
+    from elasticsearch.helpers import streaming_bulk
+    nb_deleted = nb_not_found = nb_errors = 0
+    actions = ({"_op_type": "delete", "_index": entity, "_id": _id}
+               for ids in _read_merged_ids(file_path, config.bulk_max_docs) for _id in ids)
+    for ok, item in streaming_bulk(config.client, actions, chunk_size=config.bulk_max_docs,
+                                   raise_on_error=False, raise_on_exception=False):
+        if ok:
+            nb_deleted += 1
+        elif item['delete'].get('status') == 404:
+            # not ingested or already deleted
+            nb_not_found += 1
+        else:
+            nb_errors += 1
+            log.error(item)
+    return nb_deleted, nb_not_found, nb_errors
+
+
+def _delete_merged_ids_by_query(index: str, file_path: str) -> tuple[int, int, int]:
+    """
+    Delete the merged entities of a file with delete by query requests, for an alias of several indexes (the
+    partitions of the works) where the index of each document isn't known. The index must be refreshed first, the
+    delete by query requests only see the refreshed documents.
+    :return: The number of deleted, not found and failed documents.
+    """
+    nb_deleted = nb_not_found = nb_errors = 0
+    for ids in _read_merged_ids(file_path, config.bulk_max_docs):
+        resp = config.client.options(request_timeout=config.ingestion_request_timeout).delete_by_query(
+            index=index,
+            query={"ids": {"values": ids}},
+            conflicts="proceed",
+        )
+        nb_deleted += resp['deleted']
+        # not ingested or already deleted
+        nb_not_found += len(ids) - resp['deleted'] - len(resp['failures'])
+        if len(resp['failures']) > 0:
+            nb_errors += len(resp['failures'])
+            log.error(resp['failures'][:10])
+    return nb_deleted, nb_not_found, nb_errors
+
+
+def apply_merged_ids(entities_to_ingest: list[str], openalex_data_to_ingest_path: str):
+    """
+    Delete the merged entities, listed in the merged_ids/<entity>/<date>.csv.gz files of the snapshot, with bulk delete
+    actions, or with delete by query requests for the partitioned works (WORKS_PARTITIONED). Only the files after the
+    last applied one (its date is saved in the sync state) are read.
+    """
+    for entity in entities_to_ingest:
+        merged_ids_path = os.path.join(openalex_data_to_ingest_path, "merged_ids", entity)
+        if not os.path.isdir(merged_ids_path):
+            continue
+        state = get_sync_state(entity)
+        last_merged_ids_date = state.get('merged_ids_date', "")
+        merged_ids_files = sorted(
+            (match.group(1), filename) for filename in os.listdir(merged_ids_path)
+            if (match := _MERGED_IDS_FILE_PATTERN.match(filename)) is not None and match.group(1) > last_merged_ids_date
+        )
+        partitioned = entity == "works" and config.works_partitioned
+        if partitioned and len(merged_ids_files) > 0:
+            config.client.indices.refresh(index=entity)
+        for merged_ids_date, filename in merged_ids_files:
+            file_path = os.path.join(merged_ids_path, filename)
+            if partitioned:
+                nb_deleted, nb_not_found, nb_errors = _delete_merged_ids_by_query(entity, file_path)
+            else:
+                nb_deleted, nb_not_found, nb_errors = _delete_merged_ids_bulk(entity, file_path)
+            log.info(f"Deleted {nb_deleted} merged {entity} from {filename} ({nb_not_found} not found, "
+                     f"{nb_errors} errors).")
+            if nb_errors > 0:
+                # the file is applied again by the next sync
+                break
+            state['merged_ids_date'] = merged_ids_date
+            save_sync_state(entity, state)
+
+
+def create_sync_state_index():
+    config.client.indices.create(
+        index=config.sync_state_index,
+        mappings={
+            "properties": {
+                "entity": {
+                    "type": "keyword"
+                },
+                "updated_date": {
+                    "type": "keyword"
+                },
+                "merged_ids_date": {
+                    "type": "keyword"
+                },
+                "synced_at": {
+                    "type": "date"
+                },
+            }
+        },
+    )
+    log.info(f"Created index: {config.sync_state_index}.")
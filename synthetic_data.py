@@ -0,0 +1,171 @@
+import gzip
+import json
+import os
+import random
+
+# vocabulary of the synthetic abstracts
+WORDS = ("the of and to in a is that for with as on by this we are from be an was which our these at using results "
+         "model data analysis study method based approach between two different effect high new show used also can "
+         "between protein cell patients network learning system energy temperature growth treatment evidence").split()
+WORK_TYPES = ["article", "article", "article", "book-chapter", "dataset", "preprint", "review", "dissertation"]
+LANGUAGES = ["en", "en", "en", "fr", "de", "es", "zh", None]
+
+
+def generate_abstract_inverted_index(rng: random.Random, nb_words: int) -> dict:
+    inverted_index = {}
+    for position in range(nb_words):
+        inverted_index.setdefault(rng.choice(WORDS), []).append(position)
+    return inverted_index
+
+
+def generate_topic(rng: random.Random, int_ids: bool = False) -> dict:
+    topic_id = rng.randint(10000, 14000)
+    subfield_id, field_id, domain_id = rng.randint(1100, 3600), rng.randint(11, 36), rng.randint(1, 4)
+    return {
+        "id": f"https://openalex.org/T{topic_id}",
+        "display_name": f"Topic {topic_id}",
+        "score": round(rng.random(), 4),
+        # some works of the OpenAlex dataset have integer ids for the subfields, fields and domains
+        "subfield": {"id": subfield_id if int_ids else f"https://openalex.org/subfields/{subfield_id}",
+                     "display_name": f"Subfield {subfield_id}"},
+        "field": {"id": field_id if int_ids else f"https://openalex.org/fields/{field_id}",
+                  "display_name": f"Field {field_id}"},
+        "domain": {"id": domain_id if int_ids else f"https://openalex.org/domains/{domain_id}",
+                   "display_name": f"Domain {domain_id}"},
+    }
+
+
+def generate_work(rng: random.Random, work_id: int, abstract_probability: float = 0.7,
+                  int_topic_ids_probability: float = 0.01) -> dict:
+    """
+    Generate a synthetic work with the shape of an OpenAlex work.
+    :param rng: The random generator.
+    :param work_id: The number of the work, used in its id.
+    :param abstract_probability: Probability of the work having an abstract.
+    :param int_topic_ids_probability: Probability of the work having integer ids in its topics.
+    :return: The work.
+    """
+    year = rng.randint(1950, 2024)
+    int_ids = rng.random() < int_topic_ids_probability
+    topics = [generate_topic(rng, int_ids) for _ in range(rng.randint(0, 3))]
+    source_id = rng.randint(1, 10 ** 8)
+    return {
+        "id": f"https://openalex.org/W{work_id}",
+        "doi": f"https://doi.org/10.{rng.randint(1000, 9999)}/{work_id}",
+        "title": " ".join(rng.choices(WORDS, k=rng.randint(4, 15))),
+        "display_name": " ".join(rng.choices(WORDS, k=rng.randint(4, 15))),
+        "publication_year": year,
+        "publication_date": f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "ids": {"openalex": f"https://openalex.org/W{work_id}", "mag": str(rng.randint(10 ** 9, 10 ** 10))},
+        "language": rng.choice(LANGUAGES),
+        "primary_location": {
+            "is_oa": rng.random() < 0.4,
+            "landing_page_url": f"https://example.org/{work_id}",
+            "source": {"id": f"https://openalex.org/S{source_id}", "display_name": f"Source {source_id}",
+                       "type": "journal"},
+        },
+        "type": rng.choice(WORK_TYPES),
+        "open_access": {"is_oa": rng.random() < 0.4, "oa_status": rng.choice(["gold", "green", "closed"]),
+                        "oa_url": None},
+        "authorships": [{
+            "author_position": "first" if k == 0 else "middle",
+            "author": {"id": f"https://openalex.org/A{rng.randint(1, 10 ** 10)}",
+                       "display_name": f"Author {k}", "orcid": None},
+            "institutions": [{"id": f"https://openalex.org/I{rng.randint(1, 10 ** 9)}",
+                              "display_name": "Institution", "ror": None, "country_code": "FR",
+                              "type": "education"}],
+        } for k in range(rng.randint(1, 8))],
+        "cited_by_count": rng.randint(0, 500),
+        "biblio": {"volume": str(rng.randint(1, 90)), "issue": str(rng.randint(1, 12)), "first_page": "1",
+                   "last_page": str(rng.randint(2, 30))},
+        "is_retracted": False,
+        "is_paratext": False,
+        "concepts": [{"id": f"https://openalex.org/C{rng.randint(1, 10 ** 9)}", "wikidata": None,
+                      "display_name": "Concept", "level": rng.randint(0, 5), "score": round(rng.random(), 4)}
+                     for _ in range(rng.randint(0, 10))],
+        "topics": topics,
+        "primary_topic": topics[0] if len(topics) > 0 else None,
+        "mesh": [],
+        "referenced_works": [f"https://openalex.org/W{rng.randint(1, 10 ** 10)}" for _ in range(rng.randint(0, 40))],
+        "related_works": [f"https://openalex.org/W{rng.randint(1, 10 ** 10)}" for _ in range(10)],
+        "abstract_inverted_index": generate_abstract_inverted_index(rng, rng.randint(50, 300))
+        if rng.random() < abstract_probability else None,
+        "counts_by_year": [{"year": y, "cited_by_count": rng.randint(0, 50)} for y in range(2020, 2025)],
+        "updated_date": "2024-06-01T00:00:00.000000",
+        "created_date": "2023-01-01",
+    }
+
+
+def generate_works(nb_works: int, seed: int = 42, first_work_id: int = 1, **kwargs):
+    """
+    Generate synthetic works with the shape of OpenAlex works.
+    :param nb_works: The number of works.
+    :param seed: The seed of the random generator.
+    :param first_work_id: The number used in the id of the first work.
+    :param kwargs: Passed to generate_work.
+    :return: A generator of works.
+    """
+    rng = random.Random(seed)
+    for work_id in range(first_work_id, first_work_id + nb_works):
+        yield generate_work(rng, work_id, **kwargs)
+
+
+def write_works_file(file_path: str, nb_works: int, seed: int = 42, first_work_id: int = 1, **kwargs):
+    """
+    Write a synthetic gzip JSONL file of works, like the files of the OpenAlex snapshot.
+    :param file_path: The path of the file.
+    :param nb_works: The number of works.
+    :param seed: The seed of the random generator.
+    :param first_work_id: The number used in the id of the first work.
+    :param kwargs: Passed to generate_work.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    with gzip.open(file_path, 'wt') as f:
+        for work in generate_works(nb_works, seed, first_work_id, **kwargs):
+            f.write(json.dumps(work) + "\n")
+
+
+def write_snapshot(
+        data_path: str,
+        entity: str = "works",
+        nb_partitions: int = 2,
+        nb_files_per_partition: int = 2,
+        nb_works_per_file: int = 1000,
+        seed: int = 42,
+        **kwargs
+    ) -> list[str]:
+    """
+    Write a synthetic snapshot of works with the layout of the OpenAlex snapshot
+    (<data_path>/<entity>/updated_date=<date>/part_<n>.gz and <data_path>/<entity>/manifest).
+    :param data_path: The folder containing the folders of each entity.
+    :param entity: The folder of the entity.
+    :param nb_partitions: The number of updated_date folders.
+    :param nb_files_per_partition: The number of files per updated_date folder.
+    :param nb_works_per_file: The number of works per file.
+    :param seed: The seed of the random generator.
+    :param kwargs: Passed to generate_work.
+    :return: The paths of the files.
+    """
+    file_paths = []
+    manifest_entries = []
+    for partition in range(nb_partitions):
+        for part in range(nb_files_per_partition):
+            updated_date = f"2024-{partition % 12 + 1:02d}-{partition // 12 + 1:02d}"
+            file_path = os.path.join(data_path, entity, f"updated_date={updated_date}", f"part_{part:03d}.gz")
+            first_work_id = 1 + len(file_paths) * nb_works_per_file
+            write_works_file(file_path, nb_works_per_file, seed + len(file_paths), first_work_id, **kwargs)
+            file_paths.append(file_path)
+            manifest_entries.append({
+                "url": f"s3://openalex/data/{entity}/updated_date={updated_date}/part_{part:03d}.gz",
+                "meta": {"content_length": os.path.getsize(file_path), "record_count": nb_works_per_file},
+            })
+    # manifest of the entity, like in the OpenAlex snapshot
+    with open(os.path.join(data_path, entity, "manifest"), 'w') as f:
+        json.dump({
+            "entries": manifest_entries,
+            "meta": {
+                "content_length": sum(entry["meta"]["content_length"] for entry in manifest_entries),
+                "record_count": sum(entry["meta"]["record_count"] for entry in manifest_entries),
+            },
+        }, f, indent=2)
+    return file_paths
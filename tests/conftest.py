@@ -0,0 +1,12 @@
+import os
+import sys
+
+# the modules are at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the variables without default value (see .env.template), the tests don't connect to Elasticsearch
+for name, value in [("ELASTICSEARCH_URL", "http://localhost:9200"), ("ELASTIC_PASSWORD", "tests"),
+                    ("INFERENCE_CHUNK_SIZE", "2000"), ("INGESTION_CHUNK_SIZE", "200"),
+                    ("INGESTION_REQUEST_TIMEOUT", "1000"), ("NB_INGESTION_PROCESSES", "1"),
+                    ("INGESTION_FILTER_FILE_PATH", "ingestion_filter_template"), ("LOG_LEVEL", "WARNING")]:
+    os.environ.setdefault(name, value)
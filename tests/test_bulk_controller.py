@@ -0,0 +1,157 @@
+import json
+
+import pytest
+from elastic_transport import ApiResponseMeta, HttpHeaders, JsonSerializer, NodeConfig
+from elasticsearch import ApiError, ConnectionError
+
+from bulk_controller import AdaptiveBulkController
+from ingestion_metrics import IngestionMetrics
+
+
+def api_error(status: int) -> ApiError:
+    meta = ApiResponseMeta(status=status, http_version="1.1", headers=HttpHeaders(), duration=0.,
+                           node=NodeConfig("http", "localhost", 9200))
+    return ApiError(f"status {status}", meta, {})
+
+
+class StubSerializers:
+    def get_serializer(self, mimetype):
+        return JsonSerializer()
+
+
+class StubTransport:
+    serializers = StubSerializers()
+
+
+class StubClient:
+    """
+    Client answering the bulk requests with the responses of respond(attempt, _id) for each document: a status code,
+    or an exception raised for the whole request.
+    """
+
+    transport = StubTransport()
+
+    def __init__(self, respond=lambda attempt, _id: 201):
+        self.respond = respond
+        # _ids of the documents of each request
+        self.requests = []
+
+    def options(self, request_timeout=None):
+        return self
+
+    def bulk(self, operations):
+        ids = []
+        for line in operations:
+            action = json.loads(line)
+            if len(action) == 1 and next(iter(action)) in ("index", "create", "delete", "update"):
+                ids.append(next(iter(action.values()))["_id"])
+        self.requests.append(ids)
+        attempt = sum(ids[0] in request for request in self.requests) - 1
+        items = []
+        for _id in ids:
+            status = self.respond(attempt, _id)
+            if isinstance(status, Exception):
+                raise status
+            item = {"_id": _id, "status": status}
+            if status >= 300:
+                item["error"] = {"type": "error"}
+            items.append({"index": item})
+        return {"errors": any(item["index"]["status"] >= 300 for item in items), "items": items}
+
+
+def actions(nb_docs: int, size: int = 10):
+    for i in range(nb_docs):
+        yield {"_index": "works", "_id": f"W{i}", "_source": {"abstract": "a" * size}}
+
+
+def create_controller(client, **kwargs) -> AdaptiveBulkController:
+    kwargs = {"initial_bytes": 10 ** 6, "min_bytes": 10 ** 3, "max_bytes": 10 ** 7, "max_docs": 1000,
+              "target_latency": 10., "max_in_flight": 1, "max_retries": 3, "retry_backoff": 0.,
+              "metrics": IngestionMetrics(), **kwargs}
+    return AdaptiveBulkController(client, **kwargs)
+
+
+def get_results(controller, nb_docs: int) -> dict:
+    return {next(iter(item.values()))["_id"]: (ok, next(iter(item.values()))["status"])
+            for ok, item in controller.run(actions(nb_docs))}
+
+
+def test_rejected_documents_are_retried():
+    # W1 is rejected twice
+    client = StubClient(lambda attempt, _id: 429 if _id == "W1" and attempt < 2 else 201)
+    controller = create_controller(client)
+    results = get_results(controller, 3)
+    assert results == {"W0": (True, 201), "W1": (True, 201), "W2": (True, 201)}
+    assert client.requests == [["W0", "W1", "W2"], ["W1"], ["W1"]]
+    assert controller.metrics.counters["bulk_rejections"] == 2
+    # the size of the requests is halved after the rejections
+    assert controller.target_bytes == 10 ** 6 // 2
+
+
+def test_rejected_documents_fail_after_max_retries():
+    client = StubClient(lambda attempt, _id: 429 if _id == "W1" else 201)
+    results = get_results(create_controller(client, max_retries=2), 2)
+    assert results == {"W0": (True, 201), "W1": (False, 429)}
+    assert len(client.requests) == 3
+
+
+@pytest.mark.parametrize("error", [api_error(429), api_error(503), ConnectionError("connection refused")])
+def test_failed_requests_are_retried(error):
+    client = StubClient(lambda attempt, _id: error if attempt == 0 else 201)
+    results = get_results(create_controller(client), 2)
+    assert results == {"W0": (True, 201), "W1": (True, 201)}
+    assert client.requests == [["W0", "W1"], ["W0", "W1"]]
+
+
+def test_client_errors_are_not_retried():
+    client = StubClient(lambda attempt, _id: api_error(400))
+    results = get_results(create_controller(client), 2)
+    assert results == {"W0": (False, 400), "W1": (False, 400)}
+    assert len(client.requests) == 1
+
+
+def test_failed_requests_fail_after_max_retries():
+    client = StubClient(lambda attempt, _id: api_error(502))
+    results = get_results(create_controller(client, max_retries=2), 2)
+    assert results == {"W0": (False, 502), "W1": (False, 502)}
+    assert len(client.requests) == 3
+
+
+def test_failed_items_are_reported_without_retry():
+    client = StubClient(lambda attempt, _id: 400 if _id == "W1" else 201)
+    results = get_results(create_controller(client), 3)
+    assert results == {"W0": (True, 201), "W1": (False, 400), "W2": (True, 201)}
+    assert len(client.requests) == 1
+
+
+def test_requests_are_split_by_size_and_number_of_documents():
+    client = StubClient()
+    controller = create_controller(client)
+    action_bytes = sum(len(line) + 1 for line in controller._serialize(next(actions(1)))[2])
+    # two actions per request
+    controller.target_bytes = 2 * action_bytes + action_bytes // 2
+    get_results(controller, 5)
+    assert [len(request) for request in client.requests] == [2, 2, 1]
+    client = StubClient()
+    get_results(create_controller(client, max_docs=3), 5)
+    assert [len(request) for request in client.requests] == [3, 2]
+
+
+def test_size_of_the_requests_adapts_to_the_latency():
+    controller = create_controller(StubClient(), initial_bytes=10 ** 4, target_latency=1.)
+    # fast and full requests: grown up to max_bytes
+    controller._adapt(0.1, 0, 100, 10 ** 4)
+    assert controller.target_bytes == 12500
+    controller.target_bytes = 9 * 10 ** 6
+    controller._adapt(0.1, 0, 100, 9 * 10 ** 6)
+    assert controller.target_bytes == 10 ** 7
+    # fast requests smaller than the target are not a reason to grow
+    controller._adapt(0.1, 0, 100, 10 ** 3)
+    assert controller.target_bytes == 10 ** 7
+    # slow requests: shrunk down to min_bytes
+    controller._adapt(2., 0, 100, 10 ** 7)
+    assert controller.target_bytes == 8 * 10 ** 6
+    controller.target_bytes = 1100
+    controller._adapt(2., 0, 100, 1100)
+    assert controller.target_bytes == 10 ** 3
+    assert controller.metrics.counters["bulk_requests"] == 5
@@ -0,0 +1,83 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import config
+from embedding_cache import EmbeddingCache
+
+
+@pytest.fixture(autouse=True)
+def nb_ingestion_processes(monkeypatch):
+    monkeypatch.setattr(config, "nb_ingestion_processes", 1)
+
+
+def put_texts(cache: EmbeddingCache, texts: list[str], dims: int = 4) -> np.ndarray:
+    embeddings = np.random.default_rng(len(texts)).standard_normal((len(texts), dims)).astype(np.float32)
+    cache.put(cache.get_keys(texts), embeddings)
+    return embeddings
+
+
+def get_size(directory) -> int:
+    return sum(os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory))
+
+
+def test_embeddings_are_found_in_the_segments(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), model_key="model").open()
+    first_embeddings = put_texts(cache, ["a", "b", "c"])
+    # a new segment for a new run
+    cache = EmbeddingCache(str(tmp_path), model_key="model").open()
+    second_embeddings = put_texts(cache, ["d", "e"])
+
+    cache = EmbeddingCache(str(tmp_path), model_key="model").open()
+    assert len(cache.segments) == 2
+    embeddings = cache.get(cache.get_keys(["e", "missing", "a", "c"]))
+    np.testing.assert_array_equal(embeddings[0], second_embeddings[1])
+    assert embeddings[1] is None
+    np.testing.assert_array_equal(embeddings[2], first_embeddings[0])
+    np.testing.assert_array_equal(embeddings[3], first_embeddings[2])
+
+
+def test_keys_depend_on_the_model(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), model_key="model:torch:default:float32").open()
+    put_texts(cache, ["a"])
+    cache = EmbeddingCache(str(tmp_path), model_key="model:torch:default:float16").open()
+    assert cache.get(cache.get_keys(["a"])) == [None]
+
+
+def test_truncated_segment_is_loaded(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), model_key="model").open()
+    embeddings = put_texts(cache, ["a", "b"])
+    # interrupted while writing the vector of "b"
+    vectors_path = next(tmp_path.glob("*.f32"))
+    os.truncate(vectors_path, os.path.getsize(vectors_path) - 1)
+    cache = EmbeddingCache(str(tmp_path), model_key="model").open()
+    found = cache.get(cache.get_keys(["a", "b"]))
+    np.testing.assert_array_equal(found[0], embeddings[0])
+    assert found[1] is None
+
+
+def test_oldest_segments_are_evicted(tmp_path):
+    for texts in [["a"], ["b"], ["c"]]:
+        put_texts(EmbeddingCache(str(tmp_path), model_key="model").open(), texts)
+        time.sleep(0.01)
+    segment_size = get_size(tmp_path) // 3
+    cache = EmbeddingCache(str(tmp_path), model_key="model")
+    assert cache.evict(2 * segment_size) == 2 * segment_size
+    cache.open()
+    assert [embedding is not None for embedding in cache.get(cache.get_keys(["a", "b", "c"]))] == [False, True, True]
+
+
+def test_size_limit_is_enforced_during_a_run(tmp_path):
+    previous_embeddings = put_texts(EmbeddingCache(str(tmp_path), model_key="model").open(), ["previous"])
+    time.sleep(0.01)
+    cache = EmbeddingCache(str(tmp_path), model_key="model", max_bytes=2000).open()
+    for i in range(100):
+        put_texts(cache, [f"{i}-{j}" for j in range(10)])
+    # the segment of the previous run is evicted, then the process stops caching once its segment is full (10 keys
+    # and vectors of 16 bytes per put)
+    assert get_size(tmp_path) <= 2000 + 10 * (16 + 16)
+    assert len(list(tmp_path.glob("*.keys"))) == 1
+    # the loaded segments stay readable
+    np.testing.assert_array_equal(cache.get(cache.get_keys(["previous"]))[0], previous_embeddings[0])
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from embedding_format import MEDIA_TYPES, decode_embeddings, encode_embeddings, get_binary_format
+
+
+def test_float32_round_trip_is_exact():
+    embeddings = np.random.default_rng(0).standard_normal((3, 8)).astype(np.float32)
+    decoded = decode_embeddings(encode_embeddings(embeddings, "float32"))
+    assert decoded.dtype == np.float32
+    np.testing.assert_array_equal(decoded, embeddings)
+
+
+def test_float16_round_trip_is_rounded():
+    embeddings = np.random.default_rng(0).standard_normal((3, 8)).astype(np.float32)
+    content = encode_embeddings(embeddings, "float16")
+    assert len(content) == 16 + 3 * 8 * 2
+    decoded = decode_embeddings(content)
+    assert decoded.dtype == np.float32
+    np.testing.assert_allclose(decoded, embeddings, rtol=1e-3)
+
+
+def test_lists_and_empty_embeddings():
+    decoded = decode_embeddings(encode_embeddings([[1., 2.], [3., 4.]]))
+    np.testing.assert_array_equal(decoded, [[1., 2.], [3., 4.]])
+    assert decode_embeddings(encode_embeddings([])).shape == (0, 0)
+
+
+def test_invalid_content_is_rejected():
+    content = bytearray(encode_embeddings([[1., 2.]]))
+    content[:4] = b"JSON"
+    with pytest.raises(ValueError):
+        decode_embeddings(bytes(content))
+
+
+@pytest.mark.parametrize("accept, binary_format", [
+    (None, None),
+    ("application/json", None),
+    (f"{MEDIA_TYPES['float16']}, application/json;q=0.5", "float16"),
+    (f"application/json, {MEDIA_TYPES['float32']}", "float32"),
+])
+def test_binary_format_is_negotiated(accept, binary_format):
+    assert get_binary_format(accept) == binary_format
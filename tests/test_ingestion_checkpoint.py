@@ -0,0 +1,60 @@
+import pytest
+
+import config
+from ingestion_checkpoint import FileCheckpoint
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "ingestion_checkpoint_path", str(tmp_path))
+    # the checkpoints are only saved explicitly
+    monkeypatch.setattr(config, "ingestion_checkpoint_interval", float("inf"))
+
+
+def test_interrupted_file_is_resumed_without_double_counting():
+    # lines 0 to 9, the document of line 4 fails
+    checkpoint = FileCheckpoint.load("works/part_000.gz", 100, 1.)
+    for line in range(10):
+        checkpoint.add(line, f"W{line}")
+    # acknowledged out of order, the lines 3 and 7 are not acknowledged when the ingestion is interrupted
+    for line in [0, 1, 2, 4, 5, 6, 8, 9]:
+        checkpoint.ack(f"W{line}", line != 4)
+    checkpoint.save()
+
+    resumed_checkpoint = FileCheckpoint.load("works/part_000.gz", 100, 1.)
+    assert resumed_checkpoint.start_line == 3
+    assert (resumed_checkpoint.resumed_nb_successes, resumed_checkpoint.resumed_nb_errors) == (3, 0)
+    # the lines from the checkpoint are sent again
+    for line in range(3, 10):
+        resumed_checkpoint.add(line, f"W{line}")
+    for line in range(3, 10):
+        resumed_checkpoint.ack(f"W{line}", line != 4)
+    resumed_checkpoint.save(complete=True)
+    assert (resumed_checkpoint.nb_successes, resumed_checkpoint.nb_errors) == (9, 1)
+
+    completed_checkpoint = FileCheckpoint.load("works/part_000.gz", 100, 1.)
+    assert completed_checkpoint.complete
+    assert (completed_checkpoint.nb_successes, completed_checkpoint.nb_errors) == (9, 1)
+
+
+def test_ignored_lines_are_acknowledged():
+    checkpoint = FileCheckpoint.load("works/part_001.gz", 100, 1.)
+    checkpoint.add(0, "W0")
+    checkpoint.add(1)
+    checkpoint.add(2, "W2")
+    checkpoint.ack("W2", True)
+    checkpoint.save()
+    assert FileCheckpoint.load("works/part_001.gz", 100, 1.).start_line == 0
+    checkpoint.ack("W0", True)
+    checkpoint.save()
+    resumed_checkpoint = FileCheckpoint.load("works/part_001.gz", 100, 1.)
+    assert (resumed_checkpoint.start_line, resumed_checkpoint.nb_successes) == (3, 2)
+
+
+def test_changed_file_is_ingested_from_the_beginning():
+    checkpoint = FileCheckpoint.load("works/part_002.gz", 100, 1.)
+    checkpoint.add(0, "W0")
+    checkpoint.ack("W0", True)
+    checkpoint.save()
+    resumed_checkpoint = FileCheckpoint.load("works/part_002.gz", 200, 2.)
+    assert (resumed_checkpoint.start_line, resumed_checkpoint.nb_successes) == (0, 0)
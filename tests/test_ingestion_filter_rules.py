@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import ingestion_filter_rules
+from ingestion_filter_rules import FilterRules, get_filter_rules
+
+# the English articles published since 2015
+RULE = {"all": [{"field": "publication_year", "gte": 2015}, {"field": "type", "in": ["article"]},
+                {"field": "language", "eq": "en"}]}
+
+
+def to_line(doc: dict) -> bytes:
+    return json.dumps(doc).encode()
+
+
+def test_line_is_decided_without_parsing_the_document():
+    rules = FilterRules({"field": "publication_year", "gte": 2015})
+    # the rest of the line isn't valid JSON, only the value of the key is decoded
+    assert rules.match_line(b'{"publication_year": 2020, "title": not json') is True
+    assert rules.match_line(b'{"publication_year": 2010, "title": not json') is False
+    assert rules.match_line(b'{"publication_year": null, "title": not json') is False
+
+
+def test_nested_values_are_decoded_from_the_line():
+    rules = FilterRules({"field": "primary_topic.domain.id", "eq": "D1"})
+    assert rules.match_line(to_line({"id": "W1", "primary_topic": {"domain": {"id": "D1"}}})) is True
+    assert rules.match_line(to_line({"id": "W1", "primary_topic": {"domain": {"id": "D2"}}})) is False
+
+
+def test_key_appearing_more_than_once_falls_back_to_the_document():
+    rules = FilterRules(RULE)
+    # "type" is also the key of the nested objects
+    doc = {"publication_year": 2020, "language": "en", "type": "article",
+           "locations": [{"source": {"type": "journal"}}]}
+    assert rules.match_line(to_line(doc)) is None
+    assert rules.match_document(doc) is True
+    doc["type"] = "book"
+    assert rules.match_line(to_line(doc)) is None
+    assert rules.match_document(doc) is False
+
+
+def test_line_is_decided_by_another_predicate_despite_an_undecided_one():
+    rules = FilterRules(RULE)
+    doc = {"publication_year": 2010, "language": "en", "type": "article",
+           "locations": [{"source": {"type": "journal"}}]}
+    # "all" is False as soon as a predicate is False
+    assert rules.match_line(to_line(doc)) is False
+    rules = FilterRules({"any": [{"field": "publication_year", "gte": 2015}, {"field": "type", "eq": "article"}]})
+    doc["publication_year"] = 2020
+    # "any" is True as soon as a predicate is True
+    assert rules.match_line(to_line(doc)) is True
+
+
+@pytest.mark.parametrize("rule, kept", [
+    ({"field": "language", "eq": "en"}, True),
+    ({"field": "language", "ne": "en"}, False),
+    ({"field": "type", "in": ["article", "review"]}, True),
+    ({"field": "type", "not_in": ["article", "review"]}, False),
+    ({"field": "publication_year", "gt": 2020}, False),
+    ({"field": "publication_year", "lte": 2020}, True),
+    ({"field": "abstract_inverted_index", "exists": True}, False),
+    ({"field": "abstract_inverted_index", "exists": False}, True),
+    # a predicate on a list matches if one of its values matches
+    ({"field": "topics.id", "eq": "T2"}, True),
+    ({"field": "topics.id", "ne": "T2"}, False),
+    ({"field": "topics.id", "not_in": ["T3"]}, True),
+    # the booleans are not compared as numbers
+    ({"field": "is_retracted", "gte": 0}, False),
+    ({"not": {"field": "language", "eq": "en"}}, False),
+    ({"any": [{"field": "language", "eq": "fr"}, {"field": "publication_year", "lt": 2021}]}, True),
+    ({"all": [{"field": "language", "eq": "en"}, {"field": "publication_year", "lt": 2020}]}, False),
+])
+def test_keep_and_reject(rule, kept):
+    doc = {"id": "https://openalex.org/W1", "publication_year": 2020, "language": "en", "type": "article",
+           "is_retracted": False, "abstract_inverted_index": None, "topics": [{"id": "T1"}, {"id": "T2"}]}
+    rules = FilterRules(rule)
+    assert rules.match_line(to_line(doc)) is kept
+    assert rules.match_document(doc) is kept
+
+
+def test_invalid_rules_are_rejected():
+    with pytest.raises(ValueError):
+        FilterRules({"field": "language", "like": "en"})
+    with pytest.raises(ValueError):
+        FilterRules({"field": "language", "eq": "en", "ne": "fr"})
+    with pytest.raises(ValueError):
+        FilterRules({"language": "en"})
+
+
+def test_rules_are_loaded_per_entity(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingestion_filter_rules, "_rules", None)
+    rules_path = tmp_path / "rules.json"
+    rules_path.write_text(json.dumps({"works": RULE}))
+    assert get_filter_rules("works", str(rules_path)).match_document(
+        {"publication_year": 2020, "language": "en", "type": "article"})
+    assert get_filter_rules("authors", str(rules_path)) is None
@@ -0,0 +1,28 @@
+import pytest
+
+from normalization import _sort_abstract, invert_abstract
+
+
+@pytest.mark.parametrize("inv_index", [
+    {"Hello": [0], "world": [1]},
+    {"a": [0, 2], "b": [1]},
+    # duplicated positions
+    {"a": [0], "b": [0], "c": [2]},
+    {"a": [0, 1], "b": [1]},
+    # gaps
+    {"a": [0], "b": [5]},
+    {"a": [3], "b": [1], "c": [10]},
+    # negative positions
+    {"a": [-1], "b": [0]},
+    {"a": [1], "b": [-2], "c": [0]},
+    {},
+])
+def test_invert_abstract_matches_sort(inv_index):
+    assert invert_abstract(inv_index) == _sort_abstract(inv_index)
+
+
+def test_invert_abstract():
+    assert invert_abstract(None) is None
+    assert invert_abstract({"a": [0], "b": [0], "c": [2]}) == "a b c"
+    assert invert_abstract({"a": [0, 1], "b": [1]}) == "a a b"
+    assert invert_abstract({"a": [-1], "b": [0]}) == "a b"
@@ -1,18 +1,36 @@
 import os
 from datetime import datetime
-import gzip
+from collections import Counter
 import json
-from multiprocessing import Process, Value
+import tempfile
 import time
-import requests
-
-from elasticsearch.helpers import streaming_bulk, scan
-from rich.progress import Progress
-import pandas as pd
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from contextlib import nullcontext
+from typing import TYPE_CHECKING
 
 import config
-from config import client, inference_chunk_size
+from bulk_controller import AdaptiveBulkController
+from bulk_load import bulk_load_mode
+from config import inference_chunk_size
+from decode import iter_lines, get_json_parser
+from embedding_cache import open_embedding_cache, get_embedding_cache
+from embedding_client import create_embeddings, EmbeddingPipeline, LocalEmbeddingServer, init_local_embedding_client
+from ingested_files_ledger import IngestedFilesLedger
+from ingestion_checkpoint import FileCheckpoint, remove_checkpoint, remove_all_checkpoints
+from ingestion_filter_rules import get_filter_rules
+from ingestion_metrics import IngestionMetrics, MetricsCollector, push_metrics, start_metrics_server
 from log_config import log
+from normalization import format_entity_data, log_fixes
+from snapshot_sync import list_files_to_sync, update_high_water_marks, apply_merged_ids, create_sync_state_index
+from vector_mapping import get_works_index_body
+from works_partitions import get_partition, create_works_partitions, delete_from_other_partitions
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def get_dataset_relative_file_path(path):
@@ -26,10 +44,11 @@ def get_dataset_relative_file_path(path):
 
 
 def get_if_file_already_ingested(file_path: str):
-    resp = client.search(
+    # single lookup, use IngestedFilesLedger to check many files
+    resp = config.client.search(
         index=config.ingested_files_index,
         query={
-            "match": {
+            "term": {
                 "file": file_path
             }
         },
@@ -52,277 +71,533 @@ def get_directory_size(start_path):
     return total_size
 
 
-def invert_abstract(inv_index):
-    if inv_index is not None:
-        l_inv = [(w, p) for w, pos in inv_index.items() for p in pos]
-        return " ".join(map(lambda x: x[0], sorted(l_inv, key=lambda x: x[1])))
-
-
-def format_entity_data(entity, data):
-    # needed to avoid the error: BadRequestError(400, 'illegal_argument_exception', 'mapper
-    # [summary_stats.2yr_mean_citedness] cannot be changed from type [long] to [float]')
-    # this fix is needed for authors and concepts
-    if entity == "authors" or entity == "concepts":
-        data['summary_stats']['2yr_mean_citedness'] = float(data['summary_stats']['2yr_mean_citedness'])
-    if entity == "concepts":
-        data['summary_stats']['oa_percent'] = float(data['summary_stats']['oa_percent'])
-    if entity == "works":
-        data['abstract'] = invert_abstract(data['abstract_inverted_index'])
-        # fix errors in OpenAlex dataset
-        if 'topics' in data.keys():
-            for topic in data['topics']:
-                if 'subfield' in topic.keys() and type(topic['subfield']['id']) is not str:
-                    log.warning(f"Fixing format of topic subfield ({topic['subfield']['id']}) from int to str")
-                    topic['subfield']['id'] = "https://openalex.org/subfield/" + str(topic['subfield']['id'])
-                if 'field' in topic.keys() and type(topic['field']['id']) is not str:
-                    log.warning(f"Fixing format of topic field ({topic['field']['id']}) from int to str")
-                    topic['field']['id'] = "https://openalex.org/field/" + str(topic['field']['id'])
-                if 'domain' in topic.keys() and type(topic['domain']['id']) is not str:
-                    log.warning(f"Fixing format of topic domain ({topic['domain']['id']}) from int to str")
-                    topic['domain']['id'] = "https://openalex.org/domains/" + str(topic['domain']['id'])
-        if 'primary_topic' in data.keys() and data['primary_topic'] is not None:
-            if 'subfield' in data['primary_topic'].keys() and type(data['primary_topic']['subfield']['id']) is not str:
-                log.warning(f"Fixing format of primary_topic subfield ({data['primary_topic']['subfield']['id']}) from int to str")
-                data['primary_topic']['subfield']['id'] = "https://openalex.org/subfield/" + str(data['primary_topic']['subfield']['id'])
-            if 'field' in data['primary_topic'].keys() and type(data['primary_topic']['field']['id']) is not str:
-                log.warning(f"Fixing format of primary_topic field ({data['primary_topic']['field']['id']}) from int to str")
-                data['primary_topic']['field']['id'] = "https://openalex.org/field/" + str(data['primary_topic']['field']['id'])
-            if 'domain' in data['primary_topic'].keys() and type(data['primary_topic']['domain']['id']) is not str:
-                log.warning(f"Fixing format of primary_topic domain ({data['primary_topic']['domain']['id']}) from int to str")
-                data['primary_topic']['domain']['id'] = "https://openalex.org/domain/" + str(data['primary_topic']['domain']['id'])
-        del data['abstract_inverted_index']
-        # the embeddings are computed and added later
-    return data
-
-
-def data_for_bulk_ingest(index, file_path):
-    def yield_buff(buff):
-        if len(buff) > 0:
-            for k in range(len(buff)):
-                yield {
-                    "_index": index,
-                    "_id":buff[k]['id'][21:],
-                    # "_type": "doc",
-                    "_source": buff[k]
-                }
-
-    def infer_chunk(buff):
-        # infer the buffer before yielding it
-        if index == "works":
-            # create a list with the doc having an abstract to infer
-            log.debug(f"Inferring {len(buff)} documents")
-            buff_with_abstract = [doc for doc in inference_buff if doc['abstract'] is not None]
-            log.debug(f"{len(buff_with_abstract)} documents with an abstract")
-            # create a list with the doc not having an abstract to infer
-            buff_without_abstract = [doc for doc in inference_buff if doc['abstract'] is None]
-            log.debug(f"{len(buff_without_abstract)} documents without an abstract")
-            # if there are abstracts to infer
-            if len(buff_with_abstract) > 0:
-                abstract_list = [doc['abstract'] for doc in buff_with_abstract]
-                # infer the embeddings using the API
-                abstracts_embeddings = requests.post(
-                    url=config.api_create_embeddings_endpoint,
-                    json=abstract_list
-                ).json()
-                abstracts_embeddings = [vec['vector'] for vec in abstracts_embeddings]
-                # save the embeddings with the docs
-                for j in range(len(buff_with_abstract)):
-                    buff_with_abstract[j]['abstract_embeddings'] = abstracts_embeddings[j]
-            # yield the data previously loaded and inferred
-            yield from yield_buff(buff_with_abstract)
-            yield from yield_buff(buff_without_abstract)
+def embed_chunk(index, buff, metrics: IngestionMetrics = None):
+    """
+    Create the embeddings of the abstracts of a chunk of documents. The embeddings in the embedding cache (see
+    embedding_cache.py) are not created again.
+    :param index: The index (entity) of the documents, only the works are embedded.
+    :param buff: The documents.
+    :param metrics: The metrics of the embedding stage (latency, embedding_cache_hits, embedding_cache_misses).
+    :return: The documents, the ones with an abstract first.
+    """
+    if index != "works":
+        return buff
+    if metrics is None:
+        metrics = IngestionMetrics()
+
+    def create_embeddings_timed(texts):
+        started = time.perf_counter()
+        embeddings = create_embeddings(texts)
+        latency = time.perf_counter() - started
+        metrics.add_stage("embedding", latency, len(texts), sum(map(len, texts)))
+        metrics.observe("embedding_latency_seconds", latency)
+        return embeddings
+
+    # create a list with the doc having an abstract to infer
+    log.debug(f"Inferring {len(buff)} documents")
+    buff_with_abstract = [doc for doc in buff if doc['abstract'] is not None]
+    log.debug(f"{len(buff_with_abstract)} documents with an abstract")
+    # create a list with the doc not having an abstract to infer
+    buff_without_abstract = [doc for doc in buff if doc['abstract'] is None]
+    log.debug(f"{len(buff_without_abstract)} documents without an abstract")
+    # if there are abstracts to infer
+    if len(buff_with_abstract) > 0:
+        abstracts = [doc['abstract'] for doc in buff_with_abstract]
+        embedding_cache = get_embedding_cache()
+        if embedding_cache is None:
+            # infer the embeddings using the API
+            abstracts_embeddings = create_embeddings_timed(abstracts)
         else:
-            yield from yield_buff(buff)
+            with metrics.time_stage("embedding_cache", len(abstracts)):
+                keys = embedding_cache.get_keys(abstracts)
+                abstracts_embeddings = embedding_cache.get(keys)
+            misses = [j for j, embedding in enumerate(abstracts_embeddings) if embedding is None]
+            metrics.increment('embedding_cache_hits', len(abstracts) - len(misses))
+            metrics.increment('embedding_cache_misses', len(misses))
+            if len(misses) > 0:
+                # infer the embeddings not in the cache using the API
+                new_embeddings = create_embeddings_timed([abstracts[j] for j in misses])
+                embedding_cache.put(keys[misses], new_embeddings)
+                for j, embedding in zip(misses, new_embeddings):
+                    abstracts_embeddings[j] = embedding
+        # save the embeddings with the docs
+        for j in range(len(buff_with_abstract)):
+            buff_with_abstract[j]['abstract_embeddings'] = abstracts_embeddings[j]
+    return buff_with_abstract + buff_without_abstract
+
+
+def data_for_bulk_ingest(index, file_path, metrics: IngestionMetrics = None, checkpoint: FileCheckpoint = None):
+    """
+    Read a gzip file of the dataset and yield the bulk actions indexing its documents.
+    :param index: The index (entity) to ingest the file into. The works are routed to their partition if
+    WORKS_PARTITIONED (see works_partitions.py), and deleted from the other partitions.
+    :param file_path: The path of the file.
+    :param metrics: The metrics of the stages (decompression, parsing, format, filter, embedding) and the counters
+    (nb_ingested_documents, nb_ignored_documents, nb_prefiltered_documents, nb_resumed_lines, embedding_cache_hits,
+    embedding_cache_misses) of the file.
+    :param checkpoint: The checkpoint of the file, the lines before checkpoint.start_line are skipped (only
+    decompressed) and the lines read are added to the checkpoint.
+    """
+    if metrics is None:
+        metrics = IngestionMetrics()
+    start_line = checkpoint.start_line if checkpoint is not None else 0
+    partitioned = index == "works" and config.works_partitioned
 
-    with gzip.open(file_path,'r') as f:
+    def yield_buff(buff):
+        actions = [{
+            "_index": get_partition(doc.get('publication_year')) if partitioned else index,
+            "_id": doc['id'][21:],
+            # "_type": "doc",
+            "_source": doc
+        } for doc in buff]
+        if partitioned and len(actions) > 0:
+            # a work whose publication year moved to another bucket must not stay in its previous partition
+            delete_from_other_partitions(actions)
+        yield from actions
+
+    # the embeddings of the next chunks are created while the documents of the previous chunk are indexed
+    with EmbeddingPipeline(partial(embed_chunk, index, metrics=metrics)) as pipeline:
         # we will read the file per inference chunk
-        i_inferred = 0
-        inference_buff = [None]*inference_chunk_size
+        inference_buff = []
         # for each document (one work, one institution...)
         i = 0 # counter of ingested documents
         ignored_doc = 0
-        for line in f:
-            # condition to start reading a new inference chunk
-            if i_inferred <= i:
-                i_inferred += inference_chunk_size
+        # the fixes of the format are counted and logged once for the file
+        fixes = Counter()
+        # time spent in each stage, added to the metrics at the end of the file
+        decompress_seconds = parse_seconds = format_seconds = filter_seconds = 0.
+        nb_bytes = 0
+        parse = get_json_parser()
+        # the declarative rules are evaluated on the raw lines, then on the parsed documents if they are undecided, and
+        # the Python filter on the formatted documents kept by the rules
+        filter_rules = get_filter_rules(index)
+        ingest_entity = config.ingestion_filter.ingest_entity
+        nb_prefiltered_docs = 0
+        lines = iter_lines(file_path)
+        line_number = -1
+        if start_line > 0:
+            # the documents of these lines were already acknowledged
+            with metrics.time_stage("decompress"):
+                for line_number, _ in zip(range(start_line), lines):
+                    pass
+            metrics.increment('nb_resumed_lines', line_number + 1)
+        while True:
+            started = time.perf_counter()
+            line = next(lines, None)
+            decompressed = time.perf_counter()
+            if line is None:
+                decompress_seconds += decompressed - started
+                break
+            line_number += 1
+            nb_bytes += len(line)
+            decompress_seconds += decompressed - started
+            keep = filter_rules.match_line(line) if filter_rules is not None else True
+            prefiltered = time.perf_counter()
+            filter_seconds += prefiltered - decompressed
+            if keep is False:
+                # dropped without parsing the document
+                ignored_doc += 1
+                nb_prefiltered_docs += 1
+                if checkpoint is not None:
+                    checkpoint.add(line_number)
+                continue
             # read the line from the json file and format the data
-            entity = format_entity_data(index, json.loads(line))
-            # check if the entity should be ingested based on the function written in the filter file specified in .env
-            if config.ingestion_filter.ingest_entity(entity, index):
+            doc = parse(line)
+            parsed = time.perf_counter()
+            parse_seconds += parsed - prefiltered
+            if keep is None and not filter_rules.match_document(doc):
+                ingest = False
+                filter_seconds += time.perf_counter() - parsed
+            else:
+                entity = format_entity_data(index, doc, fixes)
+                formatted = time.perf_counter()
+                # check if the entity should be ingested based on the function written in the filter file specified in
+                # .env
+                ingest = ingest_entity(entity, index)
+                format_seconds += formatted - parsed
+                filter_seconds += time.perf_counter() - formatted
+            if ingest:
                 # we index the entity
                 # add the document in the buffer for later inference and increment the counter of ingested documents
-                inference_buff[i%inference_chunk_size] = entity
-                # if the buffer is full
-                if i >= i_inferred - 1:
-                    # infer the documents in the buffer
-                    yield from infer_chunk(inference_buff)
+                inference_buff.append(entity)
+                if checkpoint is not None:
+                    checkpoint.add(line_number, entity['id'][21:])
                 i += 1
+                # if the buffer is full, infer the documents in the buffer
+                if len(inference_buff) >= inference_chunk_size:
+                    for buff in pipeline.submit(inference_buff):
+                        yield from yield_buff(buff)
+                    inference_buff = []
             else:
                 # we don't ingest the entity
                 # we do nothing and don't increment the buffer counter of ingested documents
                 ignored_doc += 1
-        # crop the inference buff to keep only the last documents to infer
-        inference_buff = [doc for j, doc in enumerate(inference_buff) if j <= i - 1]
-        yield from infer_chunk(inference_buff)
-        log.info(f"ingested {i} documents and ignored {ignored_doc} documents (based on the filter)")
-
+                if checkpoint is not None:
+                    checkpoint.add(line_number)
+        nb_docs = i + ignored_doc
+        metrics.add_stage("decompress", decompress_seconds, nb_docs, nb_bytes)
+        metrics.add_stage("parse", parse_seconds, nb_docs - nb_prefiltered_docs, nb_bytes)
+        metrics.add_stage("format", format_seconds, nb_docs - nb_prefiltered_docs)
+        metrics.add_stage("filter", filter_seconds, nb_docs)
+        # infer the last documents
+        if len(inference_buff) > 0:
+            for buff in pipeline.submit(inference_buff):
+                yield from yield_buff(buff)
+        for buff in pipeline.drain():
+            yield from yield_buff(buff)
+        log_fixes(fixes, file_path)
+        metrics.increment('nb_ingested_documents', i)
+        metrics.increment('nb_ignored_documents', ignored_doc)
+        metrics.increment('nb_prefiltered_documents', nb_prefiltered_docs)
+        log.info(f"ingested {i} documents and ignored {ignored_doc} documents (based on the filter, "
+                 f"{nb_prefiltered_docs} before parsing)")
 
 
-def ingest_file_bulk(index, file_path, nb_running_processes = None):
+def ingest_file_bulk(index, file_path, check_if_ingested = True, record_ingested_file = True):
+    """
+    Ingest a gzip file of the dataset into an index.
+    :param index: The index (entity) to ingest the file into.
+    :param file_path: The path of the file.
+    :param check_if_ingested: Search the index of the ingested files to skip the file if it was already ingested. Set
+    to False when the caller already checked it with an IngestedFilesLedger.
+    :param record_ingested_file: Write the record of the ingested file in the index of the ingested files. Set to False
+    when the caller records it (e.g. in batches with an IngestedFilesLedger).
+    :return: The record of the ingested file, with the metrics of its ingestion (see IngestionMetrics.to_dict), None if
+    the file was skipped or if the ingestion failed.
+    """
     try:
-        if get_if_file_already_ingested(str(get_dataset_relative_file_path(file_path))): # redundant now
-            log.info(f"File already ingested: {str(get_dataset_relative_file_path(file_path))}")
-        else:
-            log.debug(f"Ingesting {file_path}...")
-            ingestion_started = datetime.now()
-            successes = 0
-            errors = 0
-            for status_ok, response in streaming_bulk(
-                client=client,
-                actions=data_for_bulk_ingest(index, file_path),
-                raise_on_error=False,
-                raise_on_exception=False,
-                # max_retries=5,
-                chunk_size=config.ingestion_chunk_size,
-                request_timeout=config.ingestion_request_timeout,
-            ):
-                successes += status_ok
-                if not status_ok:
-                    log.error(response)
-                    errors += 1
+        relative_file_path = str(get_dataset_relative_file_path(file_path))
+        if check_if_ingested and get_if_file_already_ingested(relative_file_path):
+            log.info(f"File already ingested: {relative_file_path}")
+            return None
+        log.debug(f"Ingesting {file_path}...")
+        file_size = os.path.getsize(file_path)
+        file_mtime = os.path.getmtime(file_path)
+        ingestion_started = datetime.now()
+        metrics = IngestionMetrics()
+        # the metrics are pushed to the parent process during the ingestion of the file
+        with push_metrics(metrics):
+            # resume the file from its last acknowledged line if it was interrupted
+            checkpoint = FileCheckpoint.load(relative_file_path, file_size, file_mtime)
+            if not checkpoint.complete:
+                # bulk requests sized in bytes, adapted to the latency and the rejections of the cluster
+                bulk_controller = AdaptiveBulkController(config.client, metrics=metrics)
+                actions = data_for_bulk_ingest(index, file_path, metrics, checkpoint)
+                for status_ok, response in bulk_controller.run(actions):
+                    if not status_ok:
+                        log.error(response)
+                    checkpoint.ack(next(iter(response.values())).get('_id'), status_ok)
+                # the file is not ingested again if it is not recorded (e.g. the ingestion is interrupted before the
+                # ledger is flushed)
+                checkpoint.save(complete=True)
+            successes = checkpoint.nb_successes
+            errors = checkpoint.nb_errors
             # warning : this doesn't display the number of failed document ingestion
             log.info(f"Successfully indexed {successes} {index} documents with {errors} errors.")
             ingestion_finished = datetime.now()
-
-            doc_ingested_file = {
-                'file': str(get_dataset_relative_file_path(file_path)),
-                'ingestion_started': ingestion_started,
-                'ingestion_finished': ingestion_finished,
-                'ingestion_duration_seconds': (ingestion_finished - ingestion_started).total_seconds(),
-                'nb_successes': successes,
-                'nb_errors': errors,
-            }
-            client.index(index=config.ingested_files_index, document=doc_ingested_file)
-            log.debug(f"Ingested {file_path}...")
+            # the metrics count the documents of this run
+            metrics.increment('nb_successes', successes - checkpoint.resumed_nb_successes)
+            metrics.increment('nb_errors', errors - checkpoint.resumed_nb_errors)
+
+        doc_ingested_file = {
+            'file': relative_file_path,
+            'file_size': file_size,
+            'file_mtime': file_mtime,
+            'ingestion_started': ingestion_started,
+            'ingestion_finished': ingestion_finished,
+            'ingestion_duration_seconds': (ingestion_finished - ingestion_started).total_seconds(),
+            # documents of the whole file, including the runs before it was resumed from resumed_from_line
+            'nb_successes': successes,
+            'nb_errors': errors,
+            'resumed_from_line': checkpoint.start_line,
+            'nb_resumed_successes': checkpoint.resumed_nb_successes,
+            'nb_resumed_errors': checkpoint.resumed_nb_errors,
+            # documents kept and dropped by the filters, read in this run from resumed_from_line
+            'nb_kept_documents': metrics.counters['nb_ingested_documents'],
+            'nb_dropped_documents': metrics.counters['nb_ignored_documents'],
+            'nb_prefiltered_documents': metrics.counters['nb_prefiltered_documents'],
+            'metrics': metrics.to_dict(),
+        }
+        nb_embeddings = metrics.counters['embedding_cache_hits'] + metrics.counters['embedding_cache_misses']
+        if nb_embeddings > 0:
+            doc_ingested_file['embedding_cache_hits'] = metrics.counters['embedding_cache_hits']
+            doc_ingested_file['embedding_cache_misses'] = metrics.counters['embedding_cache_misses']
+            doc_ingested_file['embedding_cache_hit_rate'] = metrics.counters['embedding_cache_hits'] / nb_embeddings
+        if record_ingested_file:
+            config.client.index(index=config.ingested_files_index, id=relative_file_path, document=doc_ingested_file)
+            remove_checkpoint(relative_file_path)
+        log.debug(f"Ingested {file_path}...")
+        return doc_ingested_file
     except Exception as e:
         log.error(f"Failed to ingest file {file_path}")
         log.error(e)
-    finally:
-        if nb_running_processes is not None:
-            # increment the number of running processes
-            with nb_running_processes.get_lock():
-                nb_running_processes.value -= 1
+        return None
+
+
+def list_files_to_ingest(
+        entities_to_ingest: list[str],
+        openalex_data_to_ingest_path: str,
+        ledger: IngestedFilesLedger
+    ) -> list[tuple[int, str, str]]:
+    """
+    List the gzip files of the entities which are not already ingested.
+    :param entities_to_ingest: List of the entities, the strings must correspond to their folder names.
+    :param openalex_data_to_ingest_path: Path of the folder containing the folders of each entity.
+    :param ledger: The ledger of the ingested files.
+    :return: A list of (size in bytes, entity, file path), sorted from the biggest to the smallest file.
+    """
+    files_to_ingest = []
+    for entity in entities_to_ingest:
+        entity_path = os.path.join(openalex_data_to_ingest_path, entity)
+        nb_files_already_ingested = 0
+        for updated_date_dir in sorted(os.listdir(entity_path)):
+            if not os.path.isdir(os.path.join(entity_path, updated_date_dir)):
+                continue
+            for filename in os.listdir(os.path.join(entity_path, updated_date_dir)):
+                file_path = os.path.join(entity_path, updated_date_dir, filename)
+                n_bytes_file = os.path.getsize(file_path)
+                relative_file_path = str(get_dataset_relative_file_path(file_path))
+                if ledger.is_ingested(relative_file_path, n_bytes_file, os.path.getmtime(file_path)):
+                    log.debug(f"File already ingested: {relative_file_path}")
+                    nb_files_already_ingested += 1
+                else:
+                    files_to_ingest.append((n_bytes_file, entity, file_path))
+        log.info(f"{nb_files_already_ingested} {entity} files already ingested.")
+    # We can ingest all dates in parallel as OpenAlex remove from the previous dataset the entity that were updated.
+    # The biggest files are started first so that the last running files are the small ones.
+    files_to_ingest.sort(key=lambda f: f[0], reverse=True)
+    return files_to_ingest
+
+
+def _init_ingestion_process(local_embedding_client_args: tuple | None):
+    """
+    Initialize an ingestion process (initializer of the pool): its own client of Elasticsearch (see config.get_client),
+    and its client of the local embedding server with EMBEDDING_BACKEND=local.
+    :param local_embedding_client_args: LocalEmbeddingServer.get_client_args(), None without local embedding server.
+    """
+    config.get_client()
+    if local_embedding_client_args is not None:
+        init_local_embedding_client(*local_embedding_client_args)
+
+
+def _ingest_files(files_to_ingest: list[tuple], local_embedding_client_args: tuple | None, on_file_ingested,
+                  on_file_failed) -> tuple[list[tuple], list[tuple]]:
+    """
+    Ingest files with a pool of NB_INGESTION_PROCESSES processes, until all the files are ingested or until an
+    ingestion process dies (e.g. killed by the OOM killer or SIGKILL), which breaks the pool.
+    :param files_to_ingest: List of (size in bytes, entity, file path), ingested in this order.
+    :param local_embedding_client_args: See _init_ingestion_process.
+    :param on_file_ingested: Called with the size in bytes of the file and the result of ingest_file_bulk.
+    :param on_file_failed: Called with the path of the file, its size in bytes and the exception.
+    :return: The files whose ingestion was interrupted by the death of a process, and the files not started yet.
+    """
+    files = iter(files_to_ingest)
+    # future -> file, at most one file per process is submitted so that the files left are known if the pool breaks
+    running = {}
+    interrupted_files = []
+
+    def handle_result(future):
+        n_bytes_file, entity, file_path = file = running.pop(future)
+        try:
+            doc_ingested_file = future.result()
+        except BrokenProcessPool:
+            interrupted_files.append(file)
+        except Exception as e:
+            on_file_failed(file_path, n_bytes_file, e)
+        else:
+            on_file_ingested(n_bytes_file, doc_ingested_file)
+
+    with ProcessPoolExecutor(
+        max_workers=config.nb_ingestion_processes,
+        # the processes inherit the ledger, the embedding cache and the queue of the metrics of the parent process
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_ingestion_process,
+        initargs=(local_embedding_client_args,),
+    ) as executor:
+        for n_bytes_file, entity, file_path in itertools.islice(files, config.nb_ingestion_processes):
+            running[executor.submit(ingest_file_bulk, entity, file_path, False, False)] = \
+                (n_bytes_file, entity, file_path)
+        while len(running) > 0:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle_result(future)
+            if len(interrupted_files) > 0:
+                # the other running files fail as well, their processes are terminated with the broken pool
+                for future in list(running):
+                    handle_result(future)
+                break
+            for n_bytes_file, entity, file_path in itertools.islice(files, len(done)):
+                running[executor.submit(ingest_file_bulk, entity, file_path, False, False)] = \
+                    (n_bytes_file, entity, file_path)
+    return interrupted_files, list(files)
 
 
 def ingest_list_of_entities(
         entities_to_ingest: list[str] = config.entities_to_ingest,
-        openalex_data_to_ingest_path: str = config.openalex_data_to_ingest_path
+        openalex_data_to_ingest_path: str = config.openalex_data_to_ingest_path,
+        incremental: bool = False
     ):
     """
     Ingest a list of entities into an Elasticsearch database. This optimized to use multiprocessing, you can configure
-    the number of processes (threads) to use with the environment variables defined in the file .env. If the indexes
-    don't already exist, they will be created
+    the number of processes (threads) to use with the environment variables defined in the file .env. The files of all
+    the entities are ingested by the same pool of processes, from the biggest to the smallest. If the indexes don't
+    already exist, they will be created
 
     :param entities_to_ingest: List of the entities to ingest into the Elasticsearch database. The entities strings must
     correspond to their folder names
     :param openalex_data_to_ingest_path: Path where the compressed (zipped) data to ingest is located. This path must
     correspond to the folder where you can find the folders of each entity (Works, Institutions...)
+    :param incremental: Only ingest the partitions of the manifests of the snapshot at or after the high-water mark of
+    each entity, then move the high-water marks, and delete the merged entities (see snapshot_sync.py).
     :return:
     """
     # create the index for the ingested files if it doesn't already exist
-    if not client.indices.exists(index=config.ingested_files_index):
+    if not config.client.indices.exists(index=config.ingested_files_index):
         create_ingested_files_index()
-
-    nb_running_processes = Value('i', 0)
-
-    # for each entity (e.g. works, institutions...)
+    # create an index for the documents of each entity if it doesn't already exist
     for entity in entities_to_ingest:
-        with Progress(expand=True) as progress:
-            task = progress.add_task(f"Ingesting {entity}...")
-            log.info(f"Ingesting {entity}...")
-            # create an index for the documents if it doesn't already exist
-            if not client.indices.exists(index=entity):
-                create_index(entity)
-            nb_dir = len(os.listdir(os.path.join(openalex_data_to_ingest_path, entity)))
-            log.info(f"{nb_dir} to ingest...")
-            nb_dir_ingested = Value('i', 0)
-            # get the size on disk of the data to ingest
-            n_bytes_to_ingest = get_directory_size(os.path.join(openalex_data_to_ingest_path, entity))
-            log.info(f"{n_bytes_to_ingest} Bytes to ingest...")
-            n_bytes_ingested = 0
-            # for each updated date, from the oldest to the most recent date
-            for updated_date_dir in sorted(os.listdir(os.path.join(openalex_data_to_ingest_path, entity))):
-                with nb_dir_ingested.get_lock():
-                    nb_dir_ingested.value += 1
-                log.info(f"Staring ingesting directory: {entity}/{updated_date_dir} ({nb_dir_ingested.value} "
-                         f"out of {nb_dir}) {nb_dir_ingested.value*100/nb_dir:.2f}%")
-                if os.path.isdir(os.path.join(openalex_data_to_ingest_path, entity, updated_date_dir)):
-                    # for each gzip file
-                    for filename in os.listdir(os.path.join(openalex_data_to_ingest_path, entity, updated_date_dir)):
-                        file_path = os.path.join(openalex_data_to_ingest_path, entity, updated_date_dir, filename)
-                        n_bytes_file = os.path.getsize(file_path)
-                        n_bytes_ingested += n_bytes_file
-                        progress.update(task, advance=n_bytes_file/n_bytes_to_ingest*100)
-                        # skip if file already ingested (avoid starting the process)
-                        if get_if_file_already_ingested(str(get_dataset_relative_file_path(file_path))):
-                            log.info(f"File already ingested: {str(get_dataset_relative_file_path(file_path))}")
+        if entity == "works" and config.works_partitioned:
+            # the missing partitions are created, e.g. after adding a year to WORKS_PARTITION_YEARS
+            create_works_partitions()
+        elif not config.client.indices.exists(index=entity):
+            create_index(entity)
+
+    if incremental:
+        if not config.client.indices.exists(index=config.sync_state_index):
+            create_sync_state_index()
+        apply_merged_ids(entities_to_ingest, openalex_data_to_ingest_path)
+
+    # read the ingested files once
+    ledger = IngestedFilesLedger.load()
+    # the ingestion processes inherit the embedding cache opened here (forked, see _ingest_files)
+    open_embedding_cache()
+    if incremental:
+        files_to_ingest = list_files_to_sync(entities_to_ingest, openalex_data_to_ingest_path, ledger)
+    else:
+        files_to_ingest = list_files_to_ingest(entities_to_ingest, openalex_data_to_ingest_path, ledger)
+    n_bytes_to_ingest = sum(n_bytes_file for n_bytes_file, _, _ in files_to_ingest)
+    log.info(f"{len(files_to_ingest)} files to ingest ({n_bytes_to_ingest} Bytes)...")
+
+    # metrics of all the ingestion processes, pushed by the processes during the ingestion of each file
+    metrics = IngestionMetrics()
+    metrics_collector = MetricsCollector(metrics)
+    metrics_collector.start()
+    metrics_server = None
+    if config.metrics_port > 0:
+        metrics_server = start_metrics_server(metrics, config.metrics_host, config.metrics_port)
+
+    # import here, the other commands don't need rich.progress
+    from rich.progress import Progress
+    with Progress(expand=True) as progress:
+        task = progress.add_task(f"Ingesting {', '.join(entities_to_ingest)}...", total=n_bytes_to_ingest)
+
+        # the callbacks are run in the parent process, when the result of each file is received
+        def on_file_ingested(n_bytes_file, doc_ingested_file):
+            if doc_ingested_file is not None:
+                ledger.record(doc_ingested_file)
+                metrics.increment('files_ingested')
+                metrics.increment('file_bytes_ingested', n_bytes_file)
+            else:
+                metrics.increment('files_failed')
+            progress.update(task, advance=n_bytes_file)
+
+        def on_file_failed(file_path, n_bytes_file, e):
+            log.error(f"Failed to ingest file {file_path}")
+            log.error(e)
+            metrics.increment('files_failed')
+            progress.update(task, advance=n_bytes_file)
+
+        # number of times the ingestion of each file was interrupted by the death of its ingestion process
+        nb_attempts = Counter()
+        remaining_files = files_to_ingest
+        try:
+            # the indexes can be set to no refresh, no replica and asynchronous translog during the ingestion
+            with bulk_load_mode(entities_to_ingest) if config.bulk_load_mode else nullcontext():
+                while len(remaining_files) > 0:
+                    local_embedding_server = None
+                    local_embedding_client_args = None
+                    if config.embedding_backend == "local":
+                        # a single process loads the model and creates the embeddings for all the ingestion processes,
+                        # restarted with the pool as the response queues of the dead processes can't be reused
+                        local_embedding_server = LocalEmbeddingServer(config.nb_ingestion_processes)
+                        local_embedding_server.start()
+                        local_embedding_client_args = local_embedding_server.get_client_args()
+                    try:
+                        interrupted_files, remaining_files = _ingest_files(
+                            remaining_files, local_embedding_client_args, on_file_ingested, on_file_failed
+                        )
+                    finally:
+                        if local_embedding_server is not None:
+                            local_embedding_server.stop()
+                    if len(interrupted_files) == 0:
+                        continue
+                    files_to_retry = []
+                    for n_bytes_file, entity, file_path in interrupted_files:
+                        nb_attempts[file_path] += 1
+                        if nb_attempts[file_path] >= config.ingestion_max_file_attempts:
+                            on_file_failed(file_path, n_bytes_file, RuntimeError(
+                                f"The process ingesting the file died {nb_attempts[file_path]} times"
+                            ))
                         else:
-                            # wait if too many processes are already running
-                            while nb_running_processes.value >= config.nb_ingestion_processes:
-                                time.sleep(0.01)
-                            # increment the number of running processes
-                            with nb_running_processes.get_lock():
-                                nb_running_processes.value += 1
-                            # start the process
-                            Process(target=ingest_file_bulk, args=(
-                                entity,
-                                file_path,
-                                nb_running_processes,
-                            )).start()
-
-            # We can ingest all dates in parallel as OpenAlex remove from the previous dataset the entity that were updated
-            while nb_running_processes.value > 0:
-                time.sleep(0.1)
+                            files_to_retry.append((n_bytes_file, entity, file_path))
+                    log.warning(f"An ingestion process died (e.g. killed by the OOM killer), restarting the pool to "
+                                f"ingest the {len(files_to_retry)} interrupted files again and the "
+                                f"{len(remaining_files)} files left")
+                    # the interrupted files are resumed from their checkpoints
+                    remaining_files = files_to_retry + remaining_files
+        finally:
+            metrics_collector.stop()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+    ledger.flush()
+    if incremental:
+        update_high_water_marks(entities_to_ingest, openalex_data_to_ingest_path, ledger)
+
 
 def create_index(index):
     if index == "authors":
         with open("authors_template.json") as f:
             authors_mapping = json.load(f)['template']['mappings']
         print(authors_mapping)
-        client.indices.create(
+        config.client.indices.create(
             index=index,
             mappings=authors_mapping,
         )
+    elif index == "works" and config.works_partitioned:
+        create_works_partitions()
+        return
     elif index == "works":
-        with open("works_template.json") as f:
-            works_template = json.load(f)['template']
-            works_mapping = works_template['mappings']
-            works_settings = works_template['settings']
-        client.indices.create(
+        # the mapping of the embeddings is built from the configuration
+        works_body = get_works_index_body()
+        config.client.indices.create(
             index=index,
-            settings=works_settings,
-            mappings=works_mapping,
+            settings=works_body['settings'],
+            mappings=works_body['mappings'],
             request_timeout=100
         )
     else:
-        client.indices.create(index=index)
+        config.client.indices.create(index=index)
     # we need to increase the number of fields in elasticsearch for institutions and concepts
     if index == "institutions" or index == "concepts":
-        client.indices.put_settings(index=index, settings={"mapping.total_fields.limit": 2000})
+        config.client.indices.put_settings(index=index, settings={"mapping.total_fields.limit": 2000})
     log.info(f"Created index: {index}.")
 
 
 def create_ingested_files_index():
-    # as the file paths contain special characters and as we want to be able to match the exact string, we set
-    # the analyzer to keyword for the field file.
-    resp = client.indices.create(
+    # the file paths are matched as exact strings (term query on a keyword field)
+    resp = config.client.indices.create(
         index=config.ingested_files_index,
         mappings={
             "properties": {
                 "file": {
-                    "type": "text",
-                    "analyzer": "keyword"
-                }
+                    "type": "keyword"
+                },
+                "file_size": {
+                    "type": "long"
+                },
+                "file_mtime": {
+                    "type": "double"
+                },
             }
         },
     )
@@ -343,62 +618,49 @@ def reset_indexes(
     # TODO : fix reset_ingested_files_index
     for entity in entities_list:
         log.info(f"Resetting index: {entity}...")
-        if client.indices.exists(index=entity):
-            client.indices.delete(index=entity)
-            log.info(f"Deleted index: {entity}.")
+        if config.client.indices.exists(index=entity):
+            # the indexes behind the alias of a partitioned entity
+            for index in config.client.indices.get_alias(index=entity).keys():
+                config.client.indices.delete(index=index)
+                log.info(f"Deleted index: {index}.")
         create_index(entity)
 
     if reset_ingested_files_index:
         log.info(f"Resetting the index with the ingested files: {config.ingested_files_index}...")
-        if client.indices.exists(index=config.ingested_files_index):
-            client.indices.delete(index=config.ingested_files_index)
+        if config.client.indices.exists(index=config.ingested_files_index):
+            config.client.indices.delete(index=config.ingested_files_index)
             log.info(f"Deleted index: {config.ingested_files_index}.")
         create_ingested_files_index()
+        remove_all_checkpoints()
+        # the high-water marks of the incremental sync refer to the ingested files
+        if config.client.indices.exists(index=config.sync_state_index):
+            config.client.indices.delete(index=config.sync_state_index)
+            log.info(f"Deleted index: {config.sync_state_index}.")
 
 
-def get_full_index(index: str, fields_to_export = None) -> pd.DataFrame:
+def get_full_index(index: str, fields_to_export = None) -> "pd.DataFrame":
     """
-    Download the full data from an index of an Elasticsearch instance.
+    Download the full data from an index of an Elasticsearch instance, with the export engine (see export.py). The
+    documents without some of the fields (e.g. without an abstract) are kept, with None values.
     :param index: The index to download.
     :param fields_to_export: The fields to export, default to ['id', 'display_name', 'abstract'].
-    :return: A dataframe containing the data.
+    :return: A dataframe containing the data, the vector fields are columns of float32 arrays.
     """
+    # import here, numpy and pyarrow are only needed by the exports
+    import numpy as np
+    from export import export_index, read_export
     if fields_to_export is None:
         fields_to_export = ['id', 'display_name', 'abstract']
 
-    # number of documents to download
-    count = int(client.cat.count(index=index, format="json")[0]["count"])
-    log.info(f"{count} documents to download.")
-
-    with Progress(expand=True) as progress:
-        task = progress.add_task(f"Downloading documents...", total=count)
-
-        es_response = scan(
-            client,
-            index=index,
-            query={"query": { "match_all" : {}}}
-        )
-        df = pd.DataFrame(columns=fields_to_export)
-        nb_articles_with_abstract = 0
-        nb_articles_without_abstract = 0
-        i = 0
-        buff = [None]*10000
-        for item in es_response:
-            i += 1
-            if 'abstract' not in item['_source'].keys() or item['_source']['abstract'] is None:
-                nb_articles_without_abstract += 1
-            else:
-                if nb_articles_with_abstract % 10000 == 0 and nb_articles_with_abstract != 0:
-                    df_buff = pd.DataFrame.from_records(buff)
-                    df = pd.concat([df, df_buff])
-                row = {}
-                for field in fields_to_export:
-                    row[field] = item['_source'][field]
-                buff[nb_articles_with_abstract % 10000] = row
-                nb_articles_with_abstract += 1
-            progress.update(task, advance=1)
-        df_buff = pd.DataFrame.from_records(buff[0:nb_articles_with_abstract % 10000])
-        df = pd.concat([df, df_buff])
-        log.info(f"Got {nb_articles_with_abstract} documents with an abstract and {nb_articles_without_abstract} without "
-                 f"an abstract.")
-    return df
+    os.makedirs(config.export_path, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=config.export_path) as output_path:
+        metadata = export_index(index, output_path, fields_to_export)
+        table, vectors = read_export(output_path)
+        df = table.to_pandas()
+        for field in metadata['json_fields']:
+            df[field] = [json.loads(value) if value is not None else None for value in df[field]]
+        for field, matrix in vectors.items():
+            # copy the vectors out of the export before it is deleted
+            df[field] = [None if np.isnan(vector).any() else vector for vector in np.array(matrix)]
+    log.info(f"Got {len(df.index)} documents.")
+    return df[fields_to_export]
@@ -0,0 +1,221 @@
+"""
+Mapping of the embeddings of the abstracts (dense_vector) built from the configuration (VECTOR_* variables), and
+migration of an existing works index to this mapping: the documents are reindexed into a new index, which replaces the
+old one behind the 'works' alias, or into the partitions of the works (see works_partitions.py).
+
+python vector_mapping.py migrate [--source works] [--target works-int8_hnsw] [--partitioned] [--delete-source]
+python vector_mapping.py show
+"""
+import argparse
+import copy
+import json
+import time
+from datetime import datetime
+
+import config
+from bulk_load import enter_bulk_load_mode, exit_bulk_load_mode
+from log_config import log
+
+VECTOR_FIELD = "abstract_embeddings"
+# bbq_hnsw and bbq_flat require Elasticsearch 8.16 or newer
+INDEX_TYPES = ["hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw", "flat", "int8_flat", "int4_flat", "bbq_flat"]
+SIMILARITIES = ["dot_product", "cosine", "l2_norm", "max_inner_product"]
+# dimension of the embeddings of the common sentence-transformers models, VECTOR_DIMS must be set for the other ones
+MODEL_DIMS = {
+    "all-MiniLM-L6-v2": 384,
+    "all-MiniLM-L12-v2": 384,
+    "paraphrase-MiniLM-L6-v2": 384,
+    "multi-qa-MiniLM-L6-cos-v1": 384,
+    "paraphrase-multilingual-MiniLM-L12-v2": 384,
+    "all-distilroberta-v1": 768,
+    "all-mpnet-base-v2": 768,
+    "multi-qa-mpnet-base-dot-v1": 768,
+    "paraphrase-multilingual-mpnet-base-v2": 768,
+    "allenai-specter": 768,
+}
+
+
+def get_vector_dims(model_name: str = config.text_encoding_model_name) -> int:
+    """
+    :return: The dimension of the embeddings: VECTOR_DIMS if set, else the dimension of the model in MODEL_DIMS
+    (without loading the model nor requesting the embedding API).
+    """
+    if config.vector_dims > 0:
+        return config.vector_dims
+    # e.g. sentence-transformers/all-MiniLM-L6-v2
+    dims = MODEL_DIMS.get((model_name or "").rsplit("/", 1)[-1])
+    if dims is None:
+        raise ValueError(f"The dimension of the embeddings of the model '{model_name}' is unknown, set VECTOR_DIMS")
+    return dims
+
+
+def get_vector_mapping(
+        dims: int = None,
+        similarity: str = config.vector_similarity,
+        index_type: str = config.vector_index_type,
+        m: int = config.vector_hnsw_m,
+        ef_construction: int = config.vector_hnsw_ef_construction,
+        confidence_interval: float = config.vector_confidence_interval
+    ) -> dict:
+    """
+    Build the mapping of the embeddings.
+    :param dims: The dimension of the embeddings, see get_vector_dims if None.
+    :param similarity: One of SIMILARITIES, dot_product requires normalized embeddings (like all-MiniLM-L6-v2).
+    :param index_type: One of INDEX_TYPES, the quantization of the vectors in memory (int8, int4, bbq: 1 bit) and the
+    kind of index (HNSW graph or flat for brute force search).
+    :param m: Number of neighbors of each node of the HNSW graph.
+    :param ef_construction: Number of candidates when building the HNSW graph.
+    :param confidence_interval: Quantile of the int8 and int4 quantization, None for the default of Elasticsearch.
+    :return: The mapping of the field.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"VECTOR_INDEX_TYPE must be one of {INDEX_TYPES}, not '{index_type}'")
+    if similarity not in SIMILARITIES:
+        raise ValueError(f"VECTOR_SIMILARITY must be one of {SIMILARITIES}, not '{similarity}'")
+    index_options = {"type": index_type}
+    if index_type.endswith("hnsw"):
+        index_options["m"] = m
+        index_options["ef_construction"] = ef_construction
+    if confidence_interval is not None and index_type.startswith(("int8", "int4")):
+        index_options["confidence_interval"] = confidence_interval
+    return {
+        "type": "dense_vector",
+        "dims": dims if dims is not None else get_vector_dims(),
+        "index": True,
+        "similarity": similarity,
+        "index_options": index_options,
+    }
+
+
+def get_works_index_body(dims: int = None) -> dict:
+    """
+    :return: The settings and the mappings of a works index (works_template.json), with the mapping of the embeddings
+    built from the configuration.
+    """
+    with open("works_template.json") as f:
+        works_template = json.load(f)['template']
+    mappings = copy.deepcopy(works_template['mappings'])
+    mappings['properties'][VECTOR_FIELD] = get_vector_mapping(dims)
+    return {"settings": works_template['settings'], "mappings": mappings}
+
+
+def estimate_vector_memory(nb_vectors: int, dims: int, index_type: str, m: int = config.vector_hnsw_m) -> int:
+    """
+    Estimate the off-heap memory in bytes needed to search the vectors without reading the disk (page cache), with the
+    formulas of the Elasticsearch documentation.
+    """
+    if index_type.startswith("int8"):
+        vector_bytes = dims + 4
+    elif index_type.startswith("int4"):
+        vector_bytes = dims / 2 + 4
+    elif index_type.startswith("bbq"):
+        vector_bytes = dims / 8 + 14
+    else:
+        vector_bytes = dims * 4
+    graph_bytes = 4 * m if index_type.endswith("hnsw") else 0
+    return int(nb_vectors * (vector_bytes + graph_bytes))
+
+
+def _resolve_index(index: str) -> list[str]:
+    """
+    :return: The concrete indexes of an index or alias.
+    """
+    return list(config.client.indices.get_alias(index=index).keys())
+
+
+def migrate_index(source: str = "works", target: str = None, alias: str = "works", delete_source: bool = False,
+                  requests_per_second: float = None, poll_interval: float = 30, partitioned: bool = False):
+    """
+    Reindex an index into a new index with the current mapping of the embeddings, then point the alias to the new
+    index. The new index is in bulk load mode (see bulk_load.py) during the reindex.
+    :param source: The index (or alias) to migrate.
+    :param target: The new index, default to <alias>-<index type>-<date>. Ignored if partitioned.
+    :param alias: The alias of the new index. If the alias is the name of the source index (an index created before
+    the aliases), the source index is deleted in the same atomic operation as the creation of the alias, which
+    requires delete_source.
+    :param delete_source: Delete the source index after the migration, else it is kept (e.g. to roll back).
+    :param requests_per_second: Throttling of the reindex, None for no throttling.
+    :param poll_interval: Interval in seconds between the checks of the reindex task.
+    :param partitioned: Reindex into the partitions of the works (see works_partitions.py), which must not exist,
+    each document being routed to its partition.
+    :return: The names of the new indexes.
+    """
+    # import here as works_partitions imports this module
+    from works_partitions import get_partitions, get_routing_script, create_works_partitions
+    source_indexes = _resolve_index(source)
+    alias_is_index = alias in source_indexes
+    if alias_is_index and not delete_source:
+        raise ValueError(f"The alias {alias} is the name of the index {alias}, which must be deleted to create the "
+                         f"alias: use delete_source")
+    if partitioned:
+        targets = get_partitions()
+        existing_targets = [index for index in targets if config.client.indices.exists(index=index)]
+        if len(existing_targets) > 0:
+            raise ValueError(f"The partitions {existing_targets} already exist")
+        # the partitions are added to the alias after the reindex
+        create_works_partitions(alias=None)
+        reindex_kwargs = {"dest": {"index": targets[0]}, "script": get_routing_script()}
+    else:
+        if target is None:
+            target = f"{alias}-{config.vector_index_type.replace('_', '-')}-{datetime.now():%Y%m%d%H%M%S}"
+        targets = [target]
+        body = get_works_index_body()
+        log.info(f"Creating the index {target} with the mapping {body['mappings']['properties'][VECTOR_FIELD]}")
+        config.client.indices.create(index=target, settings=body['settings'], mappings=body['mappings'])
+        reindex_kwargs = {"dest": {"index": target}}
+
+    enter_bulk_load_mode(targets)
+    try:
+        task_id = config.client.reindex(
+            source={"index": source, "size": config.bulk_max_docs},
+            slices="auto",
+            wait_for_completion=False,
+            requests_per_second=requests_per_second if requests_per_second is not None else -1,
+            **reindex_kwargs,
+        )['task']
+        log.info(f"Reindexing {source} into {', '.join(targets)} (task {task_id})...")
+        while True:
+            task = config.client.tasks.get(task_id=task_id)
+            status = task['task']['status']
+            log.info(f"Reindexed {status['created'] + status['updated']} out of {status['total']} documents.")
+            if task['completed']:
+                break
+            time.sleep(poll_interval)
+        response = task.get('response', {})
+        if task.get('error') or response.get('failures'):
+            raise RuntimeError(f"The reindex of {source} into {', '.join(targets)} failed: "
+                               f"{task.get('error') or response['failures'][:10]}")
+    finally:
+        exit_bulk_load_mode(targets)
+
+    # the alias is moved in a single atomic operation, the searches always find an index
+    actions = [{"add": {"index": target, "alias": alias}} for target in targets]
+    if alias_is_index:
+        actions.append({"remove_index": {"index": alias}})
+    else:
+        actions.extend({"remove": {"index": index, "alias": alias}} for index in source_indexes
+                       if config.client.indices.exists_alias(index=index, name=alias))
+    config.client.indices.update_aliases(actions=actions)
+    log.info(f"The alias {alias} points to {', '.join(targets)}.")
+    if delete_source and not alias_is_index:
+        for index in source_indexes:
+            config.client.indices.delete(index=index)
+            log.info(f"Deleted index: {index}.")
+    return targets
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["migrate", "show"])
+    parser.add_argument("--source", default="works")
+    parser.add_argument("--target")
+    parser.add_argument("--alias", default="works")
+    parser.add_argument("--delete-source", action="store_true")
+    parser.add_argument("--partitioned", action="store_true", help="reindex into the partitions of the works")
+    parser.add_argument("--requests-per-second", type=float)
+    args = parser.parse_args()
+    if args.command == "show":
+        print(json.dumps(get_vector_mapping(), indent=2))
+    else:
+        migrate_index(args.source, args.target, args.alias, args.delete_source, args.requests_per_second,
+                      partitioned=args.partitioned)
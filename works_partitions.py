@@ -0,0 +1,153 @@
+"""
+Partitioned layout of the works (WORKS_PARTITIONED): the works are stored in one index per bucket of publication years,
+works-year-<first year of the bucket>, created from the index template works_partitions and searched through the alias
+works. The buckets start at the years of WORKS_PARTITION_YEARS, the first one (works-year-0000) also stores the works
+without publication year. Each partition has its own primary shards, so the bulk requests are indexed by several shards
+in parallel, and the searches filtered on the publication year only search the HNSW graphs of the matching partitions.
+
+A work whose publication year moves to another bucket in a later snapshot is deleted from its previous partition when it
+is ingested into the new one (see delete_from_other_partitions), so it isn't returned twice by the alias.
+"""
+import bisect
+from collections import defaultdict
+
+import config
+from log_config import log
+from vector_mapping import get_works_index_body
+
+WORKS_ALIAS = "works"
+PARTITION_PREFIX = "works-year-"
+TEMPLATE_NAME = "works_partitions"
+# painless script routing the documents of a reindex to their partition, like get_partition
+ROUTING_SCRIPT = """
+def year = ctx._source.publication_year;
+int start = 0;
+if (year != null) {
+  for (def boundary : params.boundaries) {
+    if (((Number) year).intValue() >= boundary) {
+      start = boundary;
+    }
+  }
+}
+String name = Integer.toString(start);
+while (name.length() < 4) {
+  name = '0' + name;
+}
+ctx._index = params.prefix + name;
+"""
+
+
+def get_partition_start_years(boundaries: list[int] = config.works_partition_years) -> list[int]:
+    return [0] + [year for year in sorted(boundaries) if year > 0]
+
+
+def get_partition(publication_year: int | None, boundaries: list[int] = config.works_partition_years) -> str:
+    """
+    :return: The partition of a work.
+    """
+    start_years = get_partition_start_years(boundaries)
+    start = 0
+    if publication_year is not None:
+        start = start_years[max(bisect.bisect_right(start_years, publication_year) - 1, 0)]
+    return f"{PARTITION_PREFIX}{start:04d}"
+
+
+def get_partitions(boundaries: list[int] = config.works_partition_years) -> list[str]:
+    return [f"{PARTITION_PREFIX}{start:04d}" for start in get_partition_start_years(boundaries)]
+
+
+def get_partitions_for_years(year_min: int = None, year_max: int = None,
+                             boundaries: list[int] = config.works_partition_years) -> list[str]:
+    """
+    :return: The partitions which can contain works published between year_min and year_max (included).
+    """
+    start_years = get_partition_start_years(boundaries)
+    partitions = []
+    for i, start in enumerate(start_years):
+        end = start_years[i + 1] if i + 1 < len(start_years) else None
+        # the first partition also contains the years before 0
+        if (year_max is None or i == 0 or start <= year_max) and (year_min is None or end is None or end > year_min):
+            partitions.append(f"{PARTITION_PREFIX}{start:04d}")
+    return partitions
+
+
+def get_routing_script(boundaries: list[int] = config.works_partition_years) -> dict:
+    """
+    :return: The script of a reindex routing the works to their partition.
+    """
+    return {
+        "source": ROUTING_SCRIPT,
+        "params": {"boundaries": get_partition_start_years(boundaries)[1:], "prefix": PARTITION_PREFIX},
+    }
+
+
+def delete_from_other_partitions(actions: list[dict]) -> int:
+    """
+    Delete the works of bulk actions from the partitions other than the partition of the action (_index), e.g. the
+    previous partition of a work whose publication year moved to another bucket, or a partition removed from
+    WORKS_PARTITION_YEARS. A single delete by query request is sent for all the actions, before they are indexed. The
+    delete by query requests only see the refreshed documents, the copies indexed since the last refresh are kept.
+    :param actions: The bulk actions indexing the works into their partition.
+    :return: The number of deleted documents.
+    """
+    ids_by_partition = defaultdict(list)
+    for action in actions:
+        ids_by_partition[action['_index']].append(action['_id'])
+    resp = config.client.options(request_timeout=config.ingestion_request_timeout).delete_by_query(
+        index=f"{PARTITION_PREFIX}*",
+        query={"bool": {
+            "should": [
+                {"bool": {"filter": [{"ids": {"values": ids}}], "must_not": [{"term": {"_index": partition}}]}}
+                for partition, ids in ids_by_partition.items()
+            ],
+            "minimum_should_match": 1,
+        }},
+        conflicts="proceed",
+    )
+    if len(resp['failures']) > 0:
+        raise RuntimeError(f"Failed to delete {len(resp['failures'])} works from their previous partition: "
+                           f"{resp['failures'][:10]}")
+    if resp['deleted'] > 0:
+        log.debug(f"Deleted {resp['deleted']} works from their previous partition.")
+    return resp['deleted']
+
+
+def put_works_template():
+    """
+    Create or update the index template of the partitions, with the settings and mappings of works_template.json and
+    the mapping of the embeddings built from the configuration.
+    """
+    works_body = get_works_index_body()
+    config.client.indices.put_index_template(
+        name=TEMPLATE_NAME,
+        index_patterns=[f"{PARTITION_PREFIX}*"],
+        template={"settings": works_body['settings'], "mappings": works_body['mappings']},
+        priority=100,
+    )
+    log.info(f"Saved the index template {TEMPLATE_NAME}.")
+
+
+def create_works_partitions(alias: str | None = WORKS_ALIAS) -> list[str]:
+    """
+    Create the missing partitions from the index template (updated first).
+    :param alias: The alias added to the partitions, None to create them without alias (e.g. before a reindex).
+    :return: The created partitions.
+    """
+    if alias is not None and config.client.indices.exists(index=alias) \
+            and not config.client.indices.exists_alias(name=alias):
+        raise ValueError(f"The index {alias} isn't partitioned, move it to the partitions with 'python "
+                         f"vector_mapping.py migrate --partitioned --delete-source'")
+    put_works_template()
+    partitions = get_partitions()
+    existing_partitions = set(config.client.indices.get(index=f"{PARTITION_PREFIX}*").keys())
+    for partition in sorted(existing_partitions.difference(partitions)):
+        log.warning(f"The partition {partition} isn't in WORKS_PARTITION_YEARS, its works are moved to the new "
+                    f"partitions only when they are ingested again (e.g. by a full ingestion), then it can be deleted")
+    created_partitions = []
+    for partition in partitions:
+        if partition in existing_partitions:
+            continue
+        config.client.indices.create(index=partition, aliases={alias: {}} if alias is not None else None)
+        created_partitions.append(partition)
+        log.info(f"Created index: {partition}.")
+    return created_partitions